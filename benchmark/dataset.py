@@ -0,0 +1,131 @@
+import random
+from datetime import date, datetime, timedelta, timezone
+
+INVOICE_ID_BASE = 10_000_000
+COMPANY_ID_BASE = 20_000_000
+CONTACT_ID_BASE = 30_000_000
+LINE_ITEM_ID_BASE = 40_000_000
+MAX_LINE_ITEMS = 4
+
+FIRST_INVOICE_DATE = date(2024, 1, 1)
+FIRST_MODIFICATION = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _timestamp(moment: datetime):
+    return moment.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+class Dataset:
+    """A generated HubSpot portal of `size` invoices.
+
+    Every object is derived from its index and the seed when it is asked for, so even 100k invoices
+    take no memory and the same size and seed always give the same invoices. Invoice n was modified
+    n seconds after FIRST_MODIFICATION, so the modification order is the index order.
+    """
+
+    def __init__(self, size: int, seed: int = 0, companies: int | None = None, skus: int | None = None,
+                 paid_ratio: float = 0.3, skipped_ratio: float = 0.1, price_spread: float = 0.0):
+        self.size = size
+        self.seed = seed
+        self.companies = companies or max(1, size // 20)
+        self.contacts = self.companies
+        self.skus = skus or max(10, size // 50)
+        self.paid_ratio = paid_ratio
+        # drafts and voided invoices, which the sync skips
+        self.skipped_ratio = skipped_ratio
+        # how far the price of a line may differ from the price of its SKU, as a fraction
+        self.price_spread = price_spread
+
+    def _random(self, kind, index):
+        return random.Random(f"{self.seed}:{kind}:{index}")
+
+    def invoice_index(self, invoice_id):
+        index = int(invoice_id) - INVOICE_ID_BASE
+        return index if 0 <= index < self.size else None
+
+    def modified_at(self, index):
+        return FIRST_MODIFICATION + timedelta(seconds=index)
+
+    def invoice(self, index):
+        rng = self._random("invoice", index)
+        draw = rng.random()
+        if draw < self.skipped_ratio:
+            status = "draft" if draw < self.skipped_ratio / 2 else "voided"
+        else:
+            status = "paid" if draw < self.skipped_ratio + self.paid_ratio else "open"
+        invoice_date = FIRST_INVOICE_DATE + timedelta(days=index % 365)
+        amount = round(rng.uniform(10, 5000), 2)
+        return {
+            "hs_object_id": str(INVOICE_ID_BASE + index),
+            "hs_number": f"BENCH-{index:06d}",
+            "hs_invoice_status": status,
+            "hs_amount_billed": str(amount),
+            "hs_balance_due": "0",
+            "hs_invoice_date": invoice_date.isoformat(),
+            "hs_due_date": (invoice_date + timedelta(days=30)).isoformat(),
+            "hs_lastmodifieddate": _timestamp(self.modified_at(index)),
+            "betreft_factuurniveau": f"benchmark invoice {index}",
+            "hs_total_discount": "0",
+        }
+
+    def associations(self, invoice_id, to_object_type):
+        """The ids of the objects of `to_object_type` associated with an invoice."""
+        index = self.invoice_index(invoice_id)
+        if index is None:
+            return []
+        rng = self._random("associations", index)
+        company = rng.randrange(self.companies)
+        line_items = rng.randint(1, MAX_LINE_ITEMS)
+        if to_object_type == "companies":
+            return [str(COMPANY_ID_BASE + company)]
+        if to_object_type == "contacts":
+            return [str(CONTACT_ID_BASE + company)]
+        if to_object_type == "line_items":
+            return [str(LINE_ITEM_ID_BASE + index * MAX_LINE_ITEMS + line) for line in range(line_items)]
+        return []
+
+    def company(self, company_id):
+        index = int(company_id) - COMPANY_ID_BASE
+        if not 0 <= index < self.companies:
+            return None
+        return {
+            "hs_object_id": company_id,
+            "relatie_nummer": f"R{index:06d}",
+            "name": f"Benchmark company {index}",
+            "address": f"Teststraat {index % 200 + 1}",
+            "zip": "1234 AB",
+            "city": "Utrecht",
+            "email": f"finance{index}@example.com",
+            "land": "NL",
+        }
+
+    def contact(self, contact_id):
+        index = int(contact_id) - CONTACT_ID_BASE
+        if not 0 <= index < self.contacts:
+            return None
+        return {"hs_object_id": contact_id, "lastname": f"Contact {index}"}
+
+    def line_item(self, line_item_id):
+        index = int(line_item_id) - LINE_ITEM_ID_BASE
+        if not 0 <= index < self.size * MAX_LINE_ITEMS:
+            return None
+        rng = self._random("line_item", index)
+        sku = rng.randrange(self.skus)
+        # without a spread the price of a SKU is the same on every invoice, so products only change when the data does
+        price = self._random("sku", sku).uniform(1, 500)
+        quantity = rng.randint(1, 10)
+        if self.price_spread:
+            price *= 1 + rng.uniform(-self.price_spread, self.price_spread)
+        price = round(price, 2)
+        return {
+            "hs_object_id": line_item_id,
+            "hs_sku": f"SKU-{sku:05d}",
+            "name": f"Product {sku}",
+            "price": str(price),
+            "quantity": str(quantity),
+            "amount": str(round(price * quantity, 2)),
+            "btw": "0.21",
+            "discount": "0",
+            "hs_discount_percentage": "0",
+            "kostenplaats": "100",
+        }
@@ -0,0 +1,100 @@
+"""Benchmark `main.main()` against the local fake HubSpot and WeFact servers.
+
+    python -m benchmark.run --invoices 10000 --latency 0.05 --hubspot-rate-limit 100/10 -- --concurrency 8
+
+Everything after `--` is passed to main.py. The run uses a fresh state database in a temporary
+directory and prints one JSON line with invoices per second and calls per invoice.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from benchmark.dataset import Dataset
+from benchmark.servers import Faults, FakeHubSpot, FakeWeFact
+
+DATASET_SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000}
+# the request budget of the governor when the fake HubSpot has no rate limit
+UNLIMITED = (1_000_000, 1.0)
+
+
+def _size(value):
+    return DATASET_SIZES.get(value) or int(value)
+
+
+def _rate_limit(value):
+    max_requests, interval = value.split("/")
+    return int(max_requests), float(interval)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the sync against local fake HubSpot and WeFact servers")
+    parser.add_argument("--invoices", type=_size, default=DATASET_SIZES["1k"],
+                        help="size of the generated dataset: 1k, 10k, 100k or a number (default: 1k)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the dataset and of the injected faults")
+    parser.add_argument("--latency", type=float, default=0.0, help="response time of both servers in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random deviation of the response time in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of requests answered with a server error (500 for HubSpot, 503 for WeFact)")
+    parser.add_argument("--hubspot-rate-limit", type=_rate_limit, default=None, metavar="REQUESTS/SECONDS",
+                        help="answer HubSpot requests beyond this budget with 429, e.g. 100/10")
+    parser.add_argument("--wefact-rate-limit", type=_rate_limit, default=None, metavar="REQUESTS/SECONDS",
+                        help="answer WeFact requests beyond this budget with 429")
+    parser.add_argument("--log-level", default="WARNING", help="log level of the sync during the run")
+    parser.add_argument("sync_args", nargs="*", help="arguments for main.py, after --")
+    return parser.parse_args(argv)
+
+
+def run_benchmark(dataset, hubspot_faults=Faults(), wefact_faults=Faults(), sync_args=(), log_level="WARNING"):
+    """Sync the dataset once from a fresh state database and return the measurements."""
+    hubspot = FakeHubSpot(dataset, hubspot_faults).start()
+    wefact = FakeWeFact(wefact_faults).start()
+    data_path = tempfile.mkdtemp(prefix="hubspot-wefact-benchmark-")
+    # the clients read their configuration when they are imported
+    os.environ.update({"HUBSPOT_API_URL": hubspot.url, "WEFACT_API_URL": wefact.url, "APPDATA": data_path,
+                       "HUBSPOT_ACCESS_TOKEN": os.getenv("HUBSPOT_ACCESS_TOKEN", "benchmark"),
+                       "WEFACT_API_KEY": os.getenv("WEFACT_API_KEY", "benchmark")})
+    # start the governor at the budget of the fake, like HUBSPOT_RATE_LIMIT_* does for a real portal
+    max_requests, interval = hubspot_faults.rate_limit or UNLIMITED
+    os.environ.setdefault("HUBSPOT_RATE_LIMIT_MAX", str(max_requests))
+    os.environ.setdefault("HUBSPOT_RATE_LIMIT_INTERVAL", str(interval))
+    import main
+
+    logging.getLogger().setLevel(log_level)
+    try:
+        started = time.perf_counter()
+        main.main(["--full", *sync_args])
+        elapsed = time.perf_counter() - started
+    finally:
+        hubspot.stop()
+        wefact.stop()
+    hubspot_stats, wefact_stats = hubspot.stats(), wefact.stats()
+    return {
+        "invoices": dataset.size,
+        "seed": dataset.seed,
+        "sync_args": list(sync_args),
+        "seconds": round(elapsed, 3),
+        "invoices_per_second": round(dataset.size / elapsed, 2),
+        "hubspot_calls_per_invoice": round(hubspot_stats["calls"] / dataset.size, 3),
+        "wefact_calls_per_invoice": round(wefact_stats["calls"] / dataset.size, 3),
+        "wefact_invoices": len(wefact.objects["invoice"]),
+        "hubspot": hubspot_stats,
+        "wefact": wefact_stats,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    dataset = Dataset(args.invoices, seed=args.seed)
+    hubspot_faults = Faults(args.latency, args.jitter, args.error_rate, args.hubspot_rate_limit, args.seed)
+    wefact_faults = Faults(args.latency, args.jitter, args.error_rate, args.wefact_rate_limit, args.seed)
+    result = run_benchmark(dataset, hubspot_faults, wefact_faults, args.sync_args, args.log_level)
+    json.dump(result, sys.stdout)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
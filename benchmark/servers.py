@@ -0,0 +1,391 @@
+import base64
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import date, datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmark.dataset import Dataset
+
+# the search API refuses to page beyond this many results, like HubSpot does
+SEARCH_RESULTS_LIMIT = 10000
+DEFAULT_PAGE_SIZE = 10
+
+FAKE_PDF = b"%PDF-1.4\n% benchmark invoice\n" + b"0" * 20_000 + b"\n%%EOF\n"
+
+# latency and jitter in seconds; `error_rate` is the share of requests answered with a server error;
+# with `rate_limit` (requests, seconds) requests beyond that budget are answered with 429
+Faults = namedtuple("faults", ["latency", "jitter", "error_rate", "rate_limit", "seed"],
+                    defaults=[0.0, 0.0, 0.0, None, 0])
+
+
+class _Budget:
+    """Fixed window request budget that answers 429 once it is used up, like HubSpot's secondly limit."""
+
+    def __init__(self, max_requests, interval, clock=time.monotonic):
+        self.max_requests = max_requests
+        self.interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._window = clock()
+        self._used = 0
+
+    def take(self):
+        """Return (allowed, remaining, seconds until the window resets)."""
+        with self._lock:
+            now = self._clock()
+            if now - self._window >= self.interval:
+                self._window = now
+                self._used = 0
+            reset = self.interval - (now - self._window)
+            if self._used >= self.max_requests:
+                return False, 0, reset
+            self._used += 1
+            return True, self.max_requests - self._used, reset
+
+
+class FakeServer(ThreadingHTTPServer):
+    """Local HTTP stand-in for an API, with the latency, errors and rate limit of `faults`."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, handler, faults: Faults):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.faults = faults
+        self.budget = _Budget(*faults.rate_limit) if faults.rate_limit else None
+        self.calls = Counter()
+        self.throttled = 0
+        self.errors = 0
+        self._random = random.Random(faults.seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def draw(self):
+        """Return (delay, fail) for the next request; the seed makes the sequence repeatable."""
+        with self._lock:
+            delay = max(0.0, self.faults.latency + self._random.uniform(-1, 1) * self.faults.jitter)
+            return delay, self._random.random() < self.faults.error_rate
+
+    def count(self, endpoint, outcome):
+        with self._lock:
+            self.calls[endpoint] += 1
+            if outcome == "throttled":
+                self.throttled += 1
+            elif outcome == "error":
+                self.errors += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def stats(self):
+        return {"calls": sum(self.calls.values()), "throttled": self.throttled, "errors": self.errors,
+                "endpoints": dict(sorted(self.calls.items()))}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, so do not wait for the ACK of the headers
+    disable_nagle_algorithm = True
+    error_status = 500
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        path = urlparse(self.path).path
+        body = self._body()
+        endpoint = f"{method} {self.endpoint(path, body)}"
+        delay, fail = self.server.draw()
+        time.sleep(delay)
+        headers = {}
+        if self.server.budget is not None:
+            allowed, remaining, reset = self.server.budget.take()
+            headers = self.rate_limit_headers(remaining)
+            if not allowed:
+                self.server.count(endpoint, "throttled")
+                self._send(429, self.throttled_payload(), headers | {"Retry-After": max(1, round(reset))})
+                return
+        if fail:
+            self.server.count(endpoint, "error")
+            self._send(self.error_status, {"status": "error", "message": "injected failure"}, headers)
+            return
+        self.server.count(endpoint, "ok")
+        status, payload = self.route(method, path, parse_qs(urlparse(self.path).query), body)
+        self._send(status, payload, headers)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def endpoint(self, path, body):
+        return path
+
+    def rate_limit_headers(self, remaining):
+        return {}
+
+    def throttled_payload(self):
+        return {"status": "error", "message": "rate limit exceeded"}
+
+    def route(self, method, path, query, body):
+        raise NotImplementedError
+
+
+def _hubspot_object(object_id, properties):
+    return {"id": str(object_id), "properties": properties, "createdAt": "2024-01-01T00:00:00.000Z",
+            "updatedAt": properties.get("hs_lastmodifieddate", "2024-01-01T00:00:00.000Z"), "archived": False}
+
+
+def _date_ms(value):
+    return int(datetime.combine(date.fromisoformat(value), datetime.min.time(), timezone.utc).timestamp() * 1000)
+
+
+def _in_range(value, low, high):
+    return (low is None or value >= low) and (high is None or value <= high)
+
+
+def _batch(results):
+    return {"status": "COMPLETE", "results": results, "startedAt": "2024-01-01T00:00:00.000Z",
+            "completedAt": "2024-01-01T00:00:00.000Z"}
+
+
+class HubSpotHandler(_Handler):
+    """The CRM endpoints the sync uses: invoice paging and search, associations, objects, files, notes and tasks."""
+
+    dataset: Dataset = None
+
+    def endpoint(self, path, body):
+        return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+    def rate_limit_headers(self, remaining):
+        budget = self.server.budget
+        return {"X-HubSpot-RateLimit-Max": budget.max_requests,
+                "X-HubSpot-RateLimit-Interval-Milliseconds": int(budget.interval * 1000),
+                "X-HubSpot-RateLimit-Remaining": remaining}
+
+    def throttled_payload(self):
+        return {"status": "error", "message": "You have reached your secondly limit.", "category": "RATE_LIMITS"}
+
+    def _invoice_page(self, start, stop, limit, after_offset=0):
+        end = min(stop, start + limit)
+        invoices = [self.dataset.invoice(index) for index in range(start, end)]
+        results = [_hubspot_object(invoice["hs_object_id"], invoice) for invoice in invoices]
+        page = {"results": results}
+        if end < stop:
+            page["paging"] = {"next": {"after": str(after_offset + end - start)}}
+        return page
+
+    def _matcher(self, filters):
+        """The first index an invoice can have and a test for the other filters of one filter group."""
+        dataset = self.dataset
+        first = 0
+        tests = []
+        for search_filter in filters:
+            name, operator = search_filter["propertyName"], search_filter["operator"]
+            if name == "hs_lastmodifieddate" and operator == "GTE":
+                # invoice n was modified n seconds after the first modification
+                first_ms = int(dataset.modified_at(0).timestamp() * 1000)
+                first = max(first, -(-(int(search_filter["value"]) - first_ms) // 1000))
+            elif operator in ("IN", "NOT_IN"):
+                tests.append(lambda invoice, name=name, operator=operator, values=search_filter["values"]:
+                             (invoice.get(name) in values) == (operator == "IN"))
+            elif name == "associations.company" and operator == "EQ":
+                tests.append(lambda invoice, value=search_filter["value"]:
+                             value in dataset.associations(invoice["hs_object_id"], "companies"))
+            elif name == "hs_invoice_date":
+                low = int(search_filter["value"]) if operator in ("GTE", "BETWEEN") else None
+                high = int(search_filter["highValue" if operator == "BETWEEN" else "value"]) \
+                    if operator in ("LTE", "BETWEEN") else None
+                tests.append(lambda invoice, low=low, high=high: _in_range(_date_ms(invoice["hs_invoice_date"]),
+                                                                           low, high))
+        return first, lambda invoice: all(test(invoice) for test in tests)
+
+    def _search_page(self, filter_groups, after, limit):
+        matchers = [self._matcher(group.get("filters", [])) for group in filter_groups] or [self._matcher([])]
+
+        def matching():
+            # the filter groups are OR-ed
+            for index in range(min(first for first, _ in matchers), self.dataset.size):
+                invoice = self.dataset.invoice(index)
+                if any(index >= first and matches(invoice) for first, matches in matchers):
+                    yield invoice
+
+        # one more than the page, to know whether there is a next page
+        invoices = list(itertools.islice(matching(), after, after + limit + 1))
+        page = {"results": [_hubspot_object(invoice["hs_object_id"], invoice) for invoice in invoices[:limit]]}
+        if len(invoices) > limit:
+            page["paging"] = {"next": {"after": str(after + limit)}}
+        return page
+
+    def route(self, method, path, query, body):
+        dataset = self.dataset
+        if method == "GET" and path == "/crm/v3/objects/invoices":
+            start = int(query.get("after", ["0"])[0])
+            limit = int(query.get("limit", [DEFAULT_PAGE_SIZE])[0])
+            return 200, self._invoice_page(start, dataset.size, limit, start)
+        if method == "POST" and path == "/crm/v3/objects/invoices/search":
+            request = json.loads(body)
+            after = int(request.get("after") or 0)
+            if after >= SEARCH_RESULTS_LIMIT:
+                return 400, {"status": "error", "message": "paging beyond 10000 results is not supported"}
+            return 200, self._search_page(request.get("filterGroups", []), after,
+                                          int(request.get("limit") or DEFAULT_PAGE_SIZE))
+        if method == "POST" and path == "/crm/v3/objects/invoices/batch/read":
+            results = []
+            for item in json.loads(body)["inputs"]:
+                index = dataset.invoice_index(item["id"])
+                if index is not None:
+                    results.append(_hubspot_object(item["id"], dataset.invoice(index)))
+            return 200, _batch(results)
+        match = re.fullmatch(r"/crm/v3/associations/invoices?/(\w+)/batch/read", path)
+        if match:
+            to_object_type = match.group(1)
+            results = []
+            for item in json.loads(body)["inputs"]:
+                to = dataset.associations(item["id"], to_object_type)
+                if to:
+                    results.append({"from": {"id": item["id"]},
+                                    "to": [{"id": to_id, "type": f"invoice_to_{to_object_type}"} for to_id in to]})
+            return 200, _batch(results)
+        if method == "POST" and path == "/crm/v3/objects/line_items/batch/read":
+            results = []
+            for item in json.loads(body)["inputs"]:
+                line_item = dataset.line_item(item["id"])
+                if line_item is not None:
+                    results.append(_hubspot_object(item["id"], line_item))
+            return 200, _batch(results)
+        match = re.fullmatch(r"/crm/v3/objects/(companies|contacts)/(\d+)", path)
+        if method == "GET" and match:
+            load = dataset.company if match.group(1) == "companies" else dataset.contact
+            properties = load(match.group(2))
+            if properties is None:
+                return 404, {"status": "error", "message": "Object not found"}
+            return 200, _hubspot_object(match.group(2), properties)
+        if method == "POST" and path == "/files/v3/files":
+            file_id = str(self.server.next_id())
+            return 200, {"id": file_id, "url": f"{self.server.url}/files/{file_id}.pdf", "access": "PUBLIC_INDEXABLE",
+                         "createdAt": "2024-01-01T00:00:00.000Z", "updatedAt": "2024-01-01T00:00:00.000Z",
+                         "archived": False}
+        if method == "POST" and path in ("/crm/v3/objects/notes", "/crm/v3/objects/tasks"):
+            return 201, _hubspot_object(self.server.next_id(), json.loads(body)["properties"])
+        if method == "GET" and path == "/tax-rates/v1/tax-rates":
+            return 200, {"results": [{"id": "1", "name": "BTW hoog", "percentageRate": 21, "label": "21%"}]}
+        return 404, {"status": "error", "message": f"no fake for {method} {path}"}
+
+
+class FakeHubSpot(FakeServer):
+    def __init__(self, dataset: Dataset, faults: Faults = Faults()):
+        handler = type("BoundHubSpotHandler", (HubSpotHandler,), {"dataset": dataset})
+        super().__init__(handler, faults)
+        self._ids = iter(range(90_000_000, 100_000_000))
+        self._ids_lock = threading.Lock()
+
+    def next_id(self):
+        with self._ids_lock:
+            return next(self._ids)
+
+
+class WeFactHandler(_Handler):
+    """The /v2/ controller API: invoice, debtor and product show, add, edit and list, and invoice download."""
+
+    error_status = 503
+    # the code that identifies an object in requests, and the key of its list
+    CONTROLLERS = {"invoice": ("InvoiceCode", "invoices"), "debtor": ("DebtorCode", "debtors"),
+                   "product": ("ProductCode", "products")}
+
+    def endpoint(self, path, body):
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return path
+        return f"{path} {request.get('controller')}.{request.get('action')}"
+
+    def _amount(self, invoice_lines):
+        """The amount of an invoice like WeFact adds it up: a line without a price has the price of its product."""
+        products = self.server.objects["product"]
+        return round(sum(float(line.get("PriceExcl", products.get(line["ProductCode"], {}).get("PriceExcl", 0)))
+                         * float(line["Number"]) for line in invoice_lines), 2)
+
+    def route(self, method, path, query, body):
+        request = json.loads(body)
+        controller, action = request.get("controller"), request.get("action")
+        if controller not in self.CONTROLLERS:
+            return 200, {"status": "error", "errors": [f"unknown controller {controller}"]}
+        code_key, list_key = self.CONTROLLERS[controller]
+        objects = self.server.objects[controller]
+        with self.server.objects_lock:
+            if action == "list":
+                offset, limit = int(request.get("offset", 0)), int(request.get("limit", 1000))
+                items = list(objects.values())
+                return 200, {"status": "success", "totalresults": len(items), list_key: items[offset:offset + limit]}
+            if action in ("show", "download"):
+                found = objects.get(request.get(code_key))
+                if found is None:
+                    return 200, {"status": "error", "errors": [f"{controller} not found"]}
+                if action == "download":
+                    return 200, {"status": "success", "invoice": {
+                        "Filename": f"{found[code_key]}.pdf", "Base64": base64.b64encode(FAKE_PDF).decode("ascii")}}
+                return 200, {"status": "success", controller: found}
+            if action == "add":
+                if request.get(code_key) in objects:
+                    return 200, {"status": "error", "errors": [f"{controller} already exists"]}
+                found = {key: value for key, value in request.items() if key not in ("api_key", "controller", "action")}
+                # like WeFact, the Identifier is a string
+                found["Identifier"] = str(len(objects) + 1)
+                if controller == "invoice":
+                    found["AmountExcl"] = self._amount(found.get("InvoiceLines", []))
+                objects[found[code_key]] = found
+                self.server.codes[controller][found["Identifier"]] = found[code_key]
+                return 200, {"status": "success", controller: found}
+            if action == "edit":
+                found = objects.get(self.server.codes[controller].get(str(request.get("Identifier"))))
+                if found is None:
+                    return 200, {"status": "error", "errors": [f"{controller} not found"]}
+                found.update({key: value for key, value in request.items()
+                              if key not in ("api_key", "controller", "action")})
+                return 200, {"status": "success", controller: found}
+        return 200, {"status": "error", "errors": [f"unknown action {action}"]}
+
+
+class FakeWeFact(FakeServer):
+    def __init__(self, faults: Faults = Faults()):
+        super().__init__(WeFactHandler, faults)
+        self.objects = {controller: {} for controller in WeFactHandler.CONTROLLERS}
+        self.codes = {controller: {} for controller in WeFactHandler.CONTROLLERS}
+        self.objects_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"{super().url}/v2/"
+
@@ -1,16 +1,25 @@
+import asyncio
 import json
 import logging
 import os
-from datetime import datetime, timedelta
-from pathlib import Path
+from datetime import date, datetime, time, timedelta, timezone
+from urllib.parse import urlparse
 
 import requests
 from hubspot import HubSpot
 from hubspot.crm.associations import BatchInputPublicObjectId
+from hubspot.discovery.discovery_base import DiscoveryBase
+from hubspot.crm.commerce.invoices import PublicObjectSearchRequest, FilterGroup, Filter, \
+    BatchReadInputSimplePublicObjectId as invoices_brispoi
+from hubspot.crm.line_items import BatchReadInputSimplePublicObjectId
 from hubspot.crm.objects.notes import SimplePublicObjectInputForCreate as notes_spoifc
 from hubspot.crm.objects.tasks import SimplePublicObjectInputForCreate as tasks_spoifc
 from urllib3 import Retry
 
+from hubspot_api.cache import TTLCache
+from hubspot_api.multipart import MultipartStream
+from hubspot_api.ratelimit import RateLimitGovernor
+from metrics import HUBSPOT_REQUESTS, HUBSPOT_REQUEST_SECONDS
 from models.company import Company
 from models.contact import Contact
 from models.invoice import Invoice
@@ -20,108 +29,251 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-INVOICES_BASE_PATH = Path(os.getenv("APPDATA", os.getenv("HOME", "/tmp"))) / "WeFactInvoices"
-os.makedirs(INVOICES_BASE_PATH, exist_ok = True)
+
+# another host than api.hubapi.com, e.g. the fake HubSpot server of the benchmarks
+HUBSPOT_API_URL = os.getenv("HUBSPOT_API_URL", "https://api.hubapi.com")
+# (connect, read) timeouts in seconds of the requests sent without the SDK, like the PDF uploads
+HUBSPOT_TIMEOUT = (float(os.getenv("HUBSPOT_CONNECT_TIMEOUT", "5")), float(os.getenv("HUBSPOT_READ_TIMEOUT", "60")))
+
+# companies and contacts are shared by many invoices, so keep them around for the duration of a run
+CACHE_MAXSIZE = int(os.getenv("HUBSPOT_CACHE_MAXSIZE", "2000"))
+CACHE_TTL = float(os.getenv("HUBSPOT_CACHE_TTL", "3600"))
+COMPANY_CACHE = TTLCache("companies", CACHE_MAXSIZE, CACHE_TTL)
+CONTACT_CACHE = TTLCache("contacts", CACHE_MAXSIZE, CACHE_TTL)
+
+# private apps start at 100 requests per 10 seconds; the governor adjusts itself to the response headers
+RATE_LIMIT_GOVERNOR = RateLimitGovernor(
+    max_requests=int(os.getenv("HUBSPOT_RATE_LIMIT_MAX", "100")),
+    interval=float(os.getenv("HUBSPOT_RATE_LIMIT_INTERVAL", "10")),
+)
 
 
 def get_access_token_hubspot():
     return os.environ["HUBSPOT_ACCESS_TOKEN"]
 
 
+def _endpoint(url):
+    # object ids would give every object its own time series
+    return "/".join("{id}" if segment.isdigit() else segment for segment in urlparse(url).path.split("/"))
+
+
+def _observed(method, url, send):
+    """Send a HubSpot request, counting it and recording its duration per endpoint."""
+    endpoint = _endpoint(url)
+    status = "exception"
+    try:
+        with HUBSPOT_REQUEST_SECONDS.time(method=method, endpoint=endpoint):
+            response = send()
+        status = getattr(response, "status", None) or getattr(response, "status_code", None)
+        return response
+    finally:
+        HUBSPOT_REQUESTS.inc(method=method, endpoint=endpoint, status=status)
+
+
+def _governed_api_factory(api_client_package, api_name, config):
+    """Build the SDK api as usual, but send all of its HTTP requests through the rate limit governor."""
+    api = DiscoveryBase._default_api_factory(api_client_package, api_name, config)
+    pool_manager = api.api_client.rest_client.pool_manager
+    send = pool_manager.request
+    pool_manager.request = lambda method, url, *args, **kwargs: RATE_LIMIT_GOVERNOR.call(
+        lambda: _observed(method, url, lambda: send(method, url, *args, **kwargs)))
+    return api
+
+
 def get_api_client():
     retry = Retry(
         total=3,
         backoff_factor=1,
         status_forcelist=(500, 502, 504),
     )
-    api_client = HubSpot(access_token=get_access_token_hubspot(), retry=retry)
+    api_client = HubSpot(access_token=get_access_token_hubspot(), retry=retry, api_factory=_governed_api_factory,
+                         host=HUBSPOT_API_URL)
     return api_client
 
 
 def get_taxes(api_client):
-    endpoint = "https://api.hubapi.com/tax-rates/v1/tax-rates"
+    endpoint = f"{HUBSPOT_API_URL}/tax-rates/v1/tax-rates"
     headers = {"Authorization": "Bearer " + get_access_token_hubspot()}
-    response = requests.get(endpoint, headers=headers)
+    response = RATE_LIMIT_GOVERNOR.call(
+        lambda: _observed("GET", endpoint, lambda: requests.get(endpoint, headers=headers, timeout=HUBSPOT_TIMEOUT)))
     return {tax["id"]: {"name": tax["name"], "percentageRate": tax["percentageRate"], "id": tax["id"],
                         "label": tax["label"]}
             for tax in response.json()["results"]}
 
 
-def upload_invoice(api_client, filename, data):
-    file_path = INVOICES_BASE_PATH / filename
-    with open(file_path, "wb") as file:
-        file.write(data)
+def upload_invoice(api_client, filename, stream):
+    """Upload the PDF in the binary `stream` to the invoices folder, without writing it to disk first.
+
+    The SDK only uploads files from a path, so the multipart request is sent here.
+    """
+    endpoint = f"{HUBSPOT_API_URL}/files/v3/files"
     options = json.dumps({"access": "PUBLIC_INDEXABLE", "overwrite": True})
-    response = api_client.files.files_api.upload(
-        file=file_path,
-        file_name=filename,
-        folder_path="/invoices",
-        options=options
-    )
-    if response is None:
-        return {"id": None, "url": None}
-    return {"id": response.id, "url": response.url}
+    body = MultipartStream({"fileName": filename, "folderPath": "/invoices", "options": options}, "file", filename,
+                           stream, "application/pdf")
+    headers = {"Authorization": "Bearer " + get_access_token_hubspot(), "Content-Type": body.content_type}
+    response = RATE_LIMIT_GOVERNOR.call(
+        lambda: _observed("POST", endpoint, lambda: requests.post(endpoint, headers=headers, data=body,
+                                                                  timeout=HUBSPOT_TIMEOUT)))
+    response.raise_for_status()
+    result = response.json()
+    return {"id": result.get("id"), "url": result.get("url")}
 
 
 def associate_file_to_company(api_client, company_id, title, file_id):
     return create_note(api_client, company_id, title, file_id)
 
 
+INVOICE_PROPERTIES = [
+    "hs_invoice_status",
+    "hs_amount_billed",
+    "hs_balance_due",
+    "hs_invoice_date",
+    "hs_due_date",
+    "hs_number",
+    "hs_lastmodifieddate",
+    "betreft_factuurniveau",
+    "referentie_wefact__factuur_",
+    "organisatie__factuur_",
+    "ter_attentie_van__factuur_",
+    "adres__factuur_",
+    "postcode__factuur_",
+    "plaats__factuur_",
+    "land__factuur_",
+    "hs_total_discount",
+    "hs_discount_percentage",
+    "relatienummer_factuur"
+]
+
+# the CRM search API refuses to page beyond this many results for a single query
+SEARCH_RESULTS_LIMIT = 10000
+SEARCH_PAGE_SIZE = 100
+# a filter takes at most 100 values and a filter group at most 6 filters; the modification date and
+# status filters leave 4 filters for excluded invoice numbers
+SEARCH_FILTER_VALUES_LIMIT = 100
+SEARCH_EXCLUDED_NUMBERS_LIMIT = 4 * SEARCH_FILTER_VALUES_LIMIT
+# selected numbers take a filter group (OR) per 100 of them; a search takes at most 18 filters over all
+# groups, and a selection adds up to three filters (modification, company, invoice date) to each group
+SEARCH_SELECTED_NUMBERS_LIMIT = 3 * SEARCH_FILTER_VALUES_LIMIT
+
+
+def _date_value(day: date):
+    # date properties are compared as milliseconds since the epoch at midnight UTC
+    return str(int(datetime.combine(day, time(), tzinfo=timezone.utc).timestamp() * 1000))
+
+
+def _build_invoice(invoice):
+    logger.info(
+        f"invoice {invoice.properties['hs_number']}[{invoice.id}] was retrieved"
+    )
+    last_modified = invoice.properties.get("hs_lastmodifieddate")
+    return Invoice(id=invoice.id,
+                   number=invoice.properties["hs_number"],
+                   status=invoice.properties["hs_invoice_status"],
+                   amount_billed=invoice.properties["hs_amount_billed"],
+                   invoice_date=datetime.fromisoformat(
+                       str(invoice.properties["hs_invoice_date"])
+                   ).date(),
+                   due_date=datetime.fromisoformat(
+                       str(invoice.properties["hs_due_date"])
+                   ).date(),
+                   last_modified=datetime.fromisoformat(str(last_modified)) if last_modified else None,
+                   betreft = invoice.properties.get("betreft_factuurniveau"),
+                   referentie = invoice.properties.get("referentie_wefact__factuur_"),
+                   organisatie = invoice.properties.get("organisatie__factuur_"),
+                   ter_attentie_van = invoice.properties.get("ter_attentie_van__factuur_"),
+                   adres = invoice.properties.get("adres__factuur_"),
+                   postcode = invoice.properties.get("postcode__factuur_"),
+                   plaats = invoice.properties.get("plaats__factuur_"),
+                   land = invoice.properties.get("land__factuur_"),
+                   korting = invoice.properties.get("hs_total_discount", 0.0),
+                   relatienummer = invoice.properties.get("relatienummer_factuur")
+                   )
+
+
 def get_invoices(api_client: HubSpot, after):
     api_invoices = api_client.crm.commerce.invoices.basic_api
-    properties = [
-        "hs_invoice_status",
-        "hs_amount_billed",
-        "hs_balance_due",
-        "hs_invoice_date",
-        "hs_due_date",
-        "hs_number",
-        "betreft_factuurniveau",
-        "referentie_wefact__factuur_",
-        "organisatie__factuur_",
-        "ter_attentie_van__factuur_",
-        "adres__factuur_",
-        "postcode__factuur_",
-        "plaats__factuur_",
-        "land__factuur_",
-        "hs_total_discount",
-        "hs_discount_percentage",
-        "relatienummer_factuur"
-    ]
-
-    invoices_hubspot = api_invoices.get_page(after=after, properties=properties)
-    for invoice in invoices_hubspot.results:
-        logger.info(
-            f"invoice {invoice.properties['hs_number']}[{invoice.id}] was retrieved"
-        )
-    invoices = [Invoice(id=invoice.id,
-                        number=invoice.properties["hs_number"],
-                        status=invoice.properties["hs_invoice_status"],
-                        amount_billed=invoice.properties["hs_amount_billed"],
-                        invoice_date=datetime.fromisoformat(
-                            str(invoice.properties["hs_invoice_date"])
-                        ).date(),
-                        due_date=datetime.fromisoformat(
-                            str(invoice.properties["hs_due_date"])
-                        ).date(),
-                        betreft = invoice.properties.get("betreft_factuurniveau"),
-                        referentie = invoice.properties.get("referentie_wefact__factuur_"),
-                        organisatie = invoice.properties.get("organisatie__factuur_"),
-                        ter_attentie_van = invoice.properties.get("ter_attentie_van__factuur_"),
-                        adres = invoice.properties.get("adres__factuur_"),
-                        postcode = invoice.properties.get("postcode__factuur_"),
-                        plaats = invoice.properties.get("plaats__factuur_"),
-                        land = invoice.properties.get("land__factuur_"),
-                        korting = invoice.properties.get("hs_total_discount", 0.0),
-                        relatienummer = invoice.properties.get("relatienummer_factuur")
-                    )
-        for invoice in invoices_hubspot.results]
+    invoices_hubspot = api_invoices.get_page(after=after, properties=INVOICE_PROPERTIES)
+    invoices = [_build_invoice(invoice) for invoice in invoices_hubspot.results]
 
     after = invoices_hubspot.paging.next.after if invoices_hubspot.paging else None
 
     return invoices, after
 
 
+def search_invoices(api_client: HubSpot, after, modified_since: datetime | None = None, statuses=None,
+                    excluded_numbers=(), numbers=(), company_id=None, invoice_date_from: date | None = None,
+                    invoice_date_to: date | None = None):
+    """Page through the invoices matching the filters, oldest modification first.
+
+    Uses the CRM search API so only the invoices that need work are transferred: the ones modified at
+    or after `modified_since`, with one of the `statuses` and whose number is not in `excluded_numbers`
+    (at most SEARCH_EXCLUDED_NUMBERS_LIMIT). A selection restricts them further to `numbers` (at most
+    SEARCH_SELECTED_NUMBERS_LIMIT), the invoices of company `company_id` and an invoice date between
+    `invoice_date_from` and `invoice_date_to`, both inclusive. The `after` token works like the one
+    returned by `get_invoices`.
+    """
+    filters = []
+    if modified_since is not None:
+        filters.append(Filter(property_name="hs_lastmodifieddate", operator="GTE",
+                              value=str(int(modified_since.timestamp() * 1000))))
+    if statuses:
+        filters.append(Filter(property_name="hs_invoice_status", operator="IN", values=list(statuses)))
+    excluded_numbers = list(excluded_numbers)[:SEARCH_EXCLUDED_NUMBERS_LIMIT]
+    for start in range(0, len(excluded_numbers), SEARCH_FILTER_VALUES_LIMIT):
+        filters.append(Filter(property_name="hs_number", operator="NOT_IN",
+                              values=excluded_numbers[start:start + SEARCH_FILTER_VALUES_LIMIT]))
+    if company_id is not None:
+        filters.append(Filter(property_name="associations.company", operator="EQ", value=str(company_id)))
+    if invoice_date_from is not None and invoice_date_to is not None:
+        filters.append(Filter(property_name="hs_invoice_date", operator="BETWEEN",
+                              value=_date_value(invoice_date_from), high_value=_date_value(invoice_date_to)))
+    elif invoice_date_from is not None:
+        filters.append(Filter(property_name="hs_invoice_date", operator="GTE", value=_date_value(invoice_date_from)))
+    elif invoice_date_to is not None:
+        filters.append(Filter(property_name="hs_invoice_date", operator="LTE", value=_date_value(invoice_date_to)))
+    numbers = list(numbers)
+    if len(numbers) > SEARCH_SELECTED_NUMBERS_LIMIT:
+        raise ValueError(f"at most {SEARCH_SELECTED_NUMBERS_LIMIT} invoice numbers can be selected")
+    # the groups are OR-ed, so every group repeats the other filters
+    filter_groups = [FilterGroup(filters=[*filters, Filter(property_name="hs_number", operator="IN",
+                                                           values=numbers[start:start + SEARCH_FILTER_VALUES_LIMIT])])
+                     for start in range(0, len(numbers), SEARCH_FILTER_VALUES_LIMIT)]
+    if not filter_groups and filters:
+        filter_groups = [FilterGroup(filters=filters)]
+    api_invoices = api_client.crm.commerce.invoices.search_api
+    search_request = PublicObjectSearchRequest(
+        filter_groups=filter_groups,
+        sorts=[{"propertyName": "hs_lastmodifieddate", "direction": "ASCENDING"}],
+        properties=INVOICE_PROPERTIES,
+        limit=SEARCH_PAGE_SIZE,
+        after=after,
+    )
+    invoices_hubspot = api_invoices.do_search(public_object_search_request=search_request)
+    invoices = [_build_invoice(invoice) for invoice in invoices_hubspot.results]
+
+    after = invoices_hubspot.paging.next.after if invoices_hubspot.paging else None
+
+    return invoices, after
+
+
+INVOICE_BATCH_SIZE = 100
+
+
+def read_invoices(api_client: HubSpot, invoice_ids):
+    """Read the invoices with the given ids, at most 100 per batch call; unknown ids are left out."""
+    api_invoices = api_client.crm.commerce.invoices.batch_api
+    invoices = []
+    for start in range(0, len(invoice_ids), INVOICE_BATCH_SIZE):
+        batch_read = invoices_brispoi(
+            inputs=[{"id": invoice_id} for invoice_id in invoice_ids[start:start + INVOICE_BATCH_SIZE]],
+            properties=INVOICE_PROPERTIES,
+            properties_with_history=[],
+        )
+        response = api_invoices.read(batch_read_input_simple_public_object_id=batch_read)
+        invoices.extend(_build_invoice(invoice) for invoice in response.results)
+    return invoices
+
+
 LINE_ITEM_PROPERTIES = [
     "hs_sku",
     "amount",
@@ -157,7 +309,7 @@ def _read_first_association_id(api_client, invoice_id, to_object_type):
     return associations.results[0].to[0].id
 
 
-def _fetch_company(api_companies, company_id):
+def _read_company(api_companies, company_id):
     company_hubspot = api_companies.get_by_id(
         company_id=company_id, properties=["relatie_nummer", "name", "address", "zip", "city", "email", "mailadres_factuur", "land"]
     )
@@ -172,7 +324,7 @@ def _fetch_company(api_companies, company_id):
     return Company(**company_args)
 
 
-def _fetch_contact(api_contacts, contact_id):
+def _read_contact(api_contacts, contact_id):
     contact_hubspot = api_contacts.get_by_id(
         contact_id=contact_id, properties=["lastname", "factuur_toelichting"]
     )
@@ -183,6 +335,14 @@ def _fetch_contact(api_contacts, contact_id):
     return Contact(**contact_args)
 
 
+def _fetch_company(api_companies, company_id):
+    return COMPANY_CACHE.get_or_load(company_id, lambda: _read_company(api_companies, company_id))
+
+
+def _fetch_contact(api_contacts, contact_id):
+    return CONTACT_CACHE.get_or_load(contact_id, lambda: _read_contact(api_contacts, contact_id))
+
+
 def _build_line_item(line_item_args):
     # fix types
     quantity = int(line_item_args["quantity"])
@@ -200,8 +360,50 @@ def _build_line_item(line_item_args):
     return LineItem(**line_item_args)
 
 
-def _fetch_line_items(api_client, api_line_items, invoice_id):
+LINE_ITEM_BATCH_SIZE = 100
+
+
+def read_line_items(api_client, line_item_ids):
+    """Map each line item id to its properties, reading at most 100 line items per batch call."""
+    api_line_items = api_client.crm.line_items.batch_api
+    line_items = {}
+    for start in range(0, len(line_item_ids), LINE_ITEM_BATCH_SIZE):
+        batch_read = BatchReadInputSimplePublicObjectId(
+            inputs=[{"id": line_item_id} for line_item_id in line_item_ids[start:start + LINE_ITEM_BATCH_SIZE]],
+            properties=LINE_ITEM_PROPERTIES,
+            properties_with_history=[],
+        )
+        response = api_line_items.read(batch_read_input_simple_public_object_id=batch_read)
+        for line_item in response.results:
+            line_items[line_item.id] = {key: line_item.properties[key] for key in line_item.properties.keys()}
+    return line_items
+
+
+def _build_line_items(line_item_ids, line_item_properties):
     line_items, errors = [], []
+    for line_item_id in line_item_ids:
+        line_item_args = line_item_properties.get(line_item_id)
+        if line_item_args is None:
+            message = f"line item {line_item_id} could not be read, skipping invoice line item"
+            logger.error(message)
+            errors.append(message)
+        elif line_item_args.get("hs_sku") is not None:
+            # work on a copy, the properties may be shared with other invoices on the page
+            line_items.append(_build_line_item(dict(line_item_args)))
+        else:
+            message = "SKU is NOT set, skipping invoice line item"
+            logger.error(message)
+            errors.append(message)
+    return line_items, errors
+
+
+def distinct_line_items(line_item_ids, line_item_properties):
+    """Build the line items with a SKU among the ids, one per SKU (the last one wins)."""
+    line_items, _ = _build_line_items(line_item_ids, line_item_properties)
+    return list({line_item.hs_sku: line_item for line_item in line_items}.values())
+
+
+def _fetch_line_items(api_client, invoice_id):
     batch_ids = BatchInputPublicObjectId([{"id": invoice_id}])
     invoice_line_items = api_client.crm.associations.batch_api.read(
         from_object_type="invoice",
@@ -209,33 +411,90 @@ def _fetch_line_items(api_client, api_line_items, invoice_id):
         batch_input_public_object_id=batch_ids,
     )
     if len(invoice_line_items.results) == 0:
-        return line_items, errors
-    for line_item_ref in invoice_line_items.results[0].to:
-        line_item = api_line_items.get_by_id(
-            line_item_id=line_item_ref.id, properties=LINE_ITEM_PROPERTIES
+        return [], []
+    line_item_ids = [line_item_ref.id for line_item_ref in invoice_line_items.results[0].to]
+    return _build_line_items(line_item_ids, read_line_items(api_client, line_item_ids))
+
+
+ASSOCIATION_BATCH_SIZE = 100
+INVOICE_ASSOCIATION_TYPES = ["companies", "contacts", "line_items"]
+
+
+def read_associations(api_client, invoice_ids, to_object_type):
+    """Map each invoice id to the ids of its associated objects, using one batch call per 100 invoices.
+
+    Invoices without any association of this type are left out of the result.
+    """
+    associated = {}
+    for start in range(0, len(invoice_ids), ASSOCIATION_BATCH_SIZE):
+        batch_ids = BatchInputPublicObjectId(
+            [{"id": invoice_id} for invoice_id in invoice_ids[start:start + ASSOCIATION_BATCH_SIZE]]
         )
-        line_item_args = {key: line_item.properties[key] for key in line_item.properties.keys()}
-        if line_item_args.get("hs_sku") is not None:
-            line_items.append(_build_line_item(line_item_args))
-        else:
-            message = "SKU is NOT set, skipping invoice line item"
-            logger.error(message)
-            errors.append(message)
-    return line_items, errors
+        associations = api_client.crm.associations.batch_api.read(
+            from_object_type="invoice",
+            to_object_type=to_object_type,
+            batch_input_public_object_id=batch_ids,
+        )
+        associations_dict = associations.to_dict()
+        if (associations_dict.get("num_errors") or 0) > 0:
+            error_messages = [error['message'] for error in associations_dict['errors']]
+            logger.error(f"{' - \n'.join(error_messages)}")
+        for result in associations.results:
+            associated[result._from.id] = [to.id for to in result.to]
+    return associated
+
+
+def resolve_invoice_associations(api_client, invoices):
+    """Read the companies, contacts and line items of a whole page of invoices up front.
+
+    The result maps each association type to a dict of invoice id -> associated ids and can be
+    passed to `get_invoice_details` to avoid per-invoice association reads.
+    """
+    invoice_ids = [invoice.id for invoice in invoices]
+    return {to_object_type: read_associations(api_client, invoice_ids, to_object_type)
+            for to_object_type in INVOICE_ASSOCIATION_TYPES}
 
 
-def get_invoice_details(api_client, invoice: Invoice):
+def _first_associated_id(associations, to_object_type, invoice_id):
+    associated_ids = associations[to_object_type].get(invoice_id) or [None]
+    return associated_ids[0]
+
+
+async def resolve_invoice_associations_async(api_client, invoices):
+    return await asyncio.to_thread(resolve_invoice_associations, api_client, invoices)
+
+
+async def read_line_items_async(api_client, line_item_ids):
+    return await asyncio.to_thread(read_line_items, api_client, line_item_ids)
+
+
+def associated_line_item_ids(associations):
+    """Return the distinct ids of all line items in resolved associations, for `read_line_items`."""
+    return list(dict.fromkeys(line_item_id for line_item_ids in associations["line_items"].values()
+                              for line_item_id in line_item_ids))
+
+
+def get_invoice_details(api_client, invoice: Invoice, associations=None, line_item_properties=None):
     api_companies = api_client.crm.companies.basic_api
     api_contacts = api_client.crm.contacts.basic_api
-    api_line_items = api_client.crm.line_items.basic_api
 
-    company_id = _read_first_association_id(api_client, invoice.id, "companies")
-    company = _fetch_company(api_companies, company_id) if company_id is not None else None
+    if associations is None:
+        company_id = _read_first_association_id(api_client, invoice.id, "companies")
+        contact_id = _read_first_association_id(api_client, invoice.id, "contacts")
+    else:
+        company_id = _first_associated_id(associations, "companies", invoice.id)
+        contact_id = _first_associated_id(associations, "contacts", invoice.id)
 
-    contact_id = _read_first_association_id(api_client, invoice.id, "contacts")
+    company = _fetch_company(api_companies, company_id) if company_id is not None else None
     contact = _fetch_contact(api_contacts, contact_id) if contact_id is not None else None
 
-    line_items, errors = _fetch_line_items(api_client, api_line_items, invoice.id)
+    if associations is None:
+        line_items, errors = _fetch_line_items(api_client, invoice.id)
+    else:
+        line_item_ids = associations["line_items"].get(invoice.id, [])
+        if line_item_properties is None:
+            line_item_properties = read_line_items(api_client, line_item_ids)
+        line_items, errors = _build_line_items(line_item_ids, line_item_properties)
     invoice.line_items.extend(line_items)
 
     return company, contact, errors
@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded object id -> value cache; entries expire after `ttl` seconds, the least recently used is evicted first.
+
+    Safe to share between the worker threads of a concurrent run.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float, clock=time.time):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _is_expired(self, stored_at):
+        return self._clock() - stored_at >= self.ttl
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING or self._is_expired(entry[1]):
+                if entry is not _MISSING:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, stored_at: float | None = None):
+        with self._lock:
+            self._entries[key] = (value, self._clock() if stored_at is None else stored_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, load):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = load()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def dump(self):
+        """Return the (key, value, stored_at) tuples that have not expired yet, oldest use first."""
+        with self._lock:
+            return [(key, value, stored_at) for key, (value, stored_at) in self._entries.items()
+                    if not self._is_expired(stored_at)]
+
+    def load(self, entries):
+        for key, value, stored_at in entries:
+            if not self._is_expired(stored_at):
+                self.put(key, value, stored_at)
+
+    def stats(self):
+        return {"name": self.name, "size": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,39 @@
+import os
+import uuid
+
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartStream:
+    """A multipart/form-data body whose file part is read from a binary stream while it is sent.
+
+    requests sends an iterable with a length as it is iterated, with a Content-Length header, so the
+    file is never copied into one big body. Every iteration starts at the beginning of the stream,
+    so a request that is sent again (e.g. after a 429) sends the whole file again.
+    """
+
+    def __init__(self, fields: dict, file_field: str, filename: str, stream, content_type="application/octet-stream"):
+        self.boundary = uuid.uuid4().hex
+        self.stream = stream
+        parts = [f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+                 for name, value in fields.items()]
+        parts.append(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                     f'filename="{filename}"\r\nContent-Type: {content_type}\r\n\r\n')
+        self._head = "".join(parts).encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("ascii")
+        stream.seek(0, os.SEEK_END)
+        self._size = stream.tell()
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return len(self._head) + self._size + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        self.stream.seek(0)
+        while chunk := self.stream.read(CHUNK_SIZE):
+            yield chunk
+        yield self._tail
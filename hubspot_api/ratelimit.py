@@ -0,0 +1,95 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+HTTP_TOO_MANY_REQUESTS = 429
+
+HEADER_MAX = "X-HubSpot-RateLimit-Max"
+HEADER_INTERVAL = "X-HubSpot-RateLimit-Interval-Milliseconds"
+HEADER_REMAINING = "X-HubSpot-RateLimit-Remaining"
+HEADER_DAILY_REMAINING = "X-HubSpot-RateLimit-Daily-Remaining"
+HEADER_RETRY_AFTER = "Retry-After"
+
+
+class RateLimitGovernor:
+    """Token bucket shared by every HubSpot call.
+
+    The bucket holds `max_requests` tokens that refill evenly over `interval` seconds. After each
+    response the budget is corrected from HubSpot's X-HubSpot-RateLimit headers, and a 429 blocks all
+    callers for the Retry-After period before the request is sent again.
+    """
+
+    def __init__(self, max_requests: int = 100, interval: float = 10.0, max_retries: int = 5,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.max_requests = max_requests
+        self.interval = interval
+        self.max_retries = max_retries
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(max_requests)
+        self._updated = clock()
+        self._blocked_until = 0.0
+        self.daily_remaining: int | None = None
+        self.throttled = 0
+
+    def _refill(self, now):
+        rate = self.max_requests / self.interval
+        self._tokens = min(float(self.max_requests), self._tokens + (now - self._updated) * rate)
+        self._updated = now
+
+    def acquire(self):
+        """Block until a request may be sent and take a token for it."""
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._blocked_until - now,
+                           (1 - self._tokens) * self.interval / self.max_requests)
+            self._sleep(wait)
+
+    def update(self, headers):
+        """Adjust the budget to the remaining quota reported by HubSpot."""
+        if headers is None:
+            return
+        with self._lock:
+            self._refill(self._clock())
+            if headers.get(HEADER_MAX) and headers.get(HEADER_INTERVAL):
+                self.max_requests = int(headers[HEADER_MAX])
+                self.interval = int(headers[HEADER_INTERVAL]) / 1000
+            if headers.get(HEADER_REMAINING) is not None:
+                # other clients may use the same quota, so the server's count wins when it is lower
+                self._tokens = min(self._tokens, float(headers[HEADER_REMAINING]))
+            if headers.get(HEADER_DAILY_REMAINING) is not None:
+                self.daily_remaining = int(headers[HEADER_DAILY_REMAINING])
+
+    def back_off(self, headers):
+        """Stop all callers for the Retry-After period (or one interval when HubSpot does not say)."""
+        retry_after = (headers or {}).get(HEADER_RETRY_AFTER)
+        delay = float(retry_after) if retry_after else self.interval
+        with self._lock:
+            self._tokens = 0.0
+            self._blocked_until = max(self._blocked_until, self._clock() + delay)
+            self.throttled += 1
+        logger.warning(f"HubSpot rate limit reached, pausing requests for {delay} seconds")
+
+    def call(self, send):
+        """Send a request through the governor; `send` returns a urllib3 or requests response."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            response = send()
+            headers = getattr(response, "headers", None)
+            self.update(headers)
+            status = getattr(response, "status", None) or getattr(response, "status_code", None)
+            if status != HTTP_TOO_MANY_REQUESTS or attempt == self.max_retries:
+                return response
+            self.back_off(headers)
+        return response
+
+    def stats(self):
+        return {"throttled": self.throttled, "daily_remaining": self.daily_remaining}
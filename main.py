@@ -1,15 +1,54 @@
+import argparse
+import asyncio
+import hashlib
 import logging
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict, namedtuple
+from datetime import date, datetime, timedelta, timezone
+from functools import partial
+from pathlib import Path
 
 from dotenv import load_dotenv
 
 from hubspot_api.api import get_api_client, get_invoices, get_invoice_details, create_task, upload_invoice, \
-    associate_file_to_company
-from state.db import init_db, save_invoice_id_in_db, determine_db_status, INVOICE_STATUS_OPEN, INVOICE_STATUS_PAID, \
-    INVOICE_STATUS_UNKNOWN, ACTION_OPEN, ACTION_PAID, ACTION_PROCESSED, ACTION_SKIP
-from wefact_api.invoice import generate_invoice, invoice_update_paid
+    associate_file_to_company, search_invoices, read_invoices, SEARCH_RESULTS_LIMIT, SEARCH_EXCLUDED_NUMBERS_LIMIT, \
+    SEARCH_SELECTED_NUMBERS_LIMIT, \
+    resolve_invoice_associations, read_line_items, associated_line_item_ids, distinct_line_items, resolve_invoice_associations_async, read_line_items_async, COMPANY_CACHE, CONTACT_CACHE, \
+    RATE_LIMIT_GOVERNOR
+from models.company import Company
+from models.contact import Contact
+from metrics import INVOICE_SYNC_SECONDS, SYNC_CYCLE_SECONDS, REGISTRY
+from pipeline import Pipeline, Stage
+from state.db import init_db, determine_db_status, determine_db_statuses, INVOICE_STATUS_OPEN, INVOICE_STATUS_PAID, \
+    INVOICE_STATUS_UNKNOWN, ACTION_OPEN, ACTION_PAID, ACTION_PROCESSED, ACTION_SKIP, get_watermark, save_watermark, \
+    load_cached_objects, save_cached_objects, load_wefact_index, save_wefact_index, clear_wefact_index, commit_page, \
+    LedgerEntry, record_invoice_ledger, get_checkpoint, save_checkpoint, clear_checkpoint, get_paid_invoice_numbers, \
+    sync_lock, SyncLockedError, get_invoice_ledger, record_wefact_push, mark_invoice_for_retry, clear_invoice_retry, get_invoices_to_retry, \
+    replay_intent_log
+from state.archive import archive_pdf, pdf_digest
+from wefact_api.api import WeFactBase, DebtorClient, ProductClient
+from wefact_api.debtor import DEBTOR_CODE_KEY
+from wefact_api.index import WeFactIndex, index_from_list
+from wefact_api.invoice import generate_invoice, invoice_update_paid, sync_products
+from wefact_api.product import PRODUCT_CODE_KEY
 
 GROOTBOEKREKENING_DEBITEUREN = "1300"
 
+# picked up by the node exporter's textfile collector and served by the service's /metrics endpoint
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", str(Path(os.getenv("APPDATA", "data")) / "hubspot-wefact.prom"))
+# seconds between the starts of two cycles of the daemon
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", "300"))
+# exit code when another process is syncing with the same state database (EX_TEMPFAIL)
+EXIT_SYNC_LOCKED = 75
+# seconds the HubSpot search index may lag behind a modification; the saved watermark stays this far before
+# the start of the run
+SEARCH_INDEX_LAG = float(os.getenv("SEARCH_INDEX_LAG", "60"))
+
 load_dotenv()
 
 logging.basicConfig(level=logging.DEBUG,
@@ -19,14 +58,439 @@ logging.basicConfig(level=logging.DEBUG,
 logger = logging.getLogger(__name__)
 
 
-def main():
-    with (init_db() as connection):
-        api_client = get_api_client()
+Shard = namedtuple("shard", ["index", "count"])
+
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"shard must look like K/N, not {value!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard {index} does not exist in {count} shards")
+    return Shard(index, count)
+
+
+def shard_scope(shard):
+    return f"shard-{shard.index}-of-{shard.count}" if shard is not None else None
+
+
+def in_shard(shard, invoice_number):
+    """Tell whether the invoice belongs to the shard; the same number always lands in the same shard."""
+    if shard is None:
+        return True
+    digest = hashlib.sha256(invoice_number.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard.count == shard.index - 1
+
+
+def parse_ids(value):
+    return [part.strip() for part in value.split(",") if part.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Synchronise HubSpot invoices to WeFact")
+    parser.add_argument("--full", action="store_true",
+                        help="walk every invoice in HubSpot instead of only the ones modified since the last run")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="number of invoices to sync at the same time (default: one after the other)")
+    parser.add_argument("--batch-writes", action="store_true",
+                        help="save the state of a page of invoices in one transaction instead of one per invoice")
+    parser.add_argument("--reset-checkpoint", action="store_true",
+                        help="forget the paging position of an unfinished run and start from the beginning")
+    parser.add_argument("--server-filter", action="store_true",
+                        help="let HubSpot only return open and paid invoices, leaving out recent ones that are paid "
+                             "according to the ledger")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="fetch, enrich, push and upload in overlapping stages, --concurrency workers per stage")
+    parser.add_argument("--shard", type=parse_shard, default=None, metavar="K/N",
+                        help="only sync the invoices whose number hashes into shard K of N (1 <= K <= N); "
+                             "every shard keeps its own watermark and checkpoint")
+    parser.add_argument("--metrics-file", default=METRICS_TEXTFILE,
+                        help="where to write the Prometheus metrics of the run (default: %(default)s)")
+    parser.add_argument("--persist-cache", action="store_true",
+                        help="keep the HubSpot company and contact cache in the state database between runs")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and start a sync every --interval seconds, reusing the connections, "
+                             "caches and WeFact indexes of the previous one")
+    parser.add_argument("--interval", type=float, default=SYNC_INTERVAL,
+                        help="seconds between the starts of two syncs of the daemon (default: %(default)s)")
+    parser.add_argument("--invoice-ids", type=parse_ids, default=None, metavar="ID,ID,...",
+                        help="only sync the HubSpot invoices with these object ids, leaving the watermark and "
+                             "checkpoint alone; used by the service for webhook events")
+    selection = parser.add_argument_group(
+        "selection", "only sync the invoices matching all of these, leaving the watermark and checkpoint alone")
+    selection.add_argument("--invoice-numbers", type=parse_ids, default=None, metavar="NUMBER,NUMBER,...",
+                           help=f"invoices with these numbers, at most {SEARCH_SELECTED_NUMBERS_LIMIT}")
+    selection.add_argument("--company", default=None, metavar="ID", help="invoices of this HubSpot company")
+    selection.add_argument("--invoice-date-from", type=date.fromisoformat, default=None, metavar="YYYY-MM-DD",
+                           help="invoices dated on or after this day")
+    selection.add_argument("--invoice-date-to", type=date.fromisoformat, default=None, metavar="YYYY-MM-DD",
+                           help="invoices dated on or before this day")
+    args = parser.parse_args(argv)
+    if args.daemon and (args.invoice_ids or selection_filters(args)):
+        parser.error("--invoice-ids and a selection sync once and cannot be combined with --daemon")
+    if args.invoice_ids and selection_filters(args):
+        parser.error("--invoice-ids cannot be combined with a selection")
+    if args.invoice_numbers and len(args.invoice_numbers) > SEARCH_SELECTED_NUMBERS_LIMIT:
+        parser.error(f"--invoice-numbers takes at most {SEARCH_SELECTED_NUMBERS_LIMIT} numbers")
+    return args
+
+
+def selection_filters(args):
+    """The search filters of the selection of a run, None when it syncs everything."""
+    filters = {
+        "numbers": args.invoice_numbers,
+        "company_id": args.company,
+        "invoice_date_from": args.invoice_date_from,
+        "invoice_date_to": args.invoice_date_to,
+    }
+    filters = {name: value for name, value in filters.items() if value}
+    return filters or None
+
+
+OBJECT_CACHES = [(COMPANY_CACHE, Company), (CONTACT_CACHE, Contact)]
+
+
+def _load_object_caches(connection):
+    for cache, model in OBJECT_CACHES:
+        cache.load((object_id, model.model_validate_json(data), stored_at)
+                   for object_id, data, stored_at in load_cached_objects(connection, cache.name))
+
+
+def _save_object_caches(connection):
+    for cache, _ in OBJECT_CACHES:
+        save_cached_objects(connection, cache.name,
+                            [(object_id, value.model_dump_json(), stored_at) for object_id, value, stored_at in cache.dump()])
+
+
+def _parse_datetime(value):
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+def _newest_modification(watermark, invoices):
+    modifications = [invoice.last_modified for invoice in invoices if invoice.last_modified is not None]
+    if watermark is not None:
+        modifications.append(watermark)
+    return max(modifications, default=None)
+
+
+def _capped_watermark(watermark, started):
+    """The watermark to save after a run that started at `started`.
+
+    An invoice that changes while the run pages through the others was possibly read before the change,
+    so a newer modification on a later page must not move the watermark past it.
+    """
+    return min(watermark, started - timedelta(seconds=SEARCH_INDEX_LAG))
+
+
+def _load_wefact_index(connection, client, code_key, refresh):
+    """Load the index of a WeFact controller from the state database, listing it from WeFact when needed.
+
+    A refresh keeps the fingerprints of the objects, which no longer match when their Identifier changed.
+    """
+    known = WeFactIndex(client._controller, load_wefact_index(connection, client._controller))
+    if len(known) > 0 and not refresh:
+        return known
+    logger.info(f"building the WeFact {client._controller} index")
+    index = index_from_list(client, code_key)
+    for code, identifier, _ in index.pop_changes():
+        entry = known.get(code)
+        if entry is not None:
+            index.record(code, identifier, entry[1])
+    clear_wefact_index(connection, client._controller)
+    _save_wefact_index(connection, index)
+    return index
+
+
+def _save_wefact_index(connection, index):
+    save_wefact_index(connection, index.controller, index.pop_changes())
+
+
+Page = namedtuple("page", ["invoices", "watermark", "checkpoint"])
+
+
+def iterate_pages(api_client, run_id, modified_since, watermark, next_invoice, shard=None, search_filters=None,
+                  started=None, mode=None):
+    """Yield the pages of invoices to sync, starting at the `next_invoice` paging cursor.
+
+    Every page carries the watermark so far and the checkpoint to resume from after it (None for the last
+    page). Without `modified_since` all invoices are walked, otherwise only the ones modified since then.
+    `search_filters` are the keywords of `search_invoices`, to leave out invoices that need no work or
+    to sync a selection.
+    With a `shard` the pages only hold the invoices of that shard; the watermark still covers all of them.
+    `started` is when the run started, kept in the checkpoint for the watermark of a resumed run, and `mode`
+    the kind of run asked for, to only resume a checkpoint of the same kind.
+    """
+    searching = modified_since is not None or search_filters is not None
+    if modified_since is not None:
+        logger.info(f"running an incremental synchronisation of invoices modified since {modified_since.isoformat()}")
+    elif search_filters is None:
+        # no previous run to start from (or explicitly asked for): reconcile everything
+        logger.info("running a full synchronisation of all invoices")
+    if search_filters is not None:
+        logger.info(f"searching invoices with {_describe_filters(search_filters)}")
+    fetch_invoices = partial(search_invoices, modified_since=modified_since, **(search_filters or {})) \
+        if searching else get_invoices
+    # the invoices a new search returns again, with the modification they had when they were read
+    seen = {}
+    while True:
+        fetched, next_invoice = fetch_invoices(api_client, next_invoice)
+        invoices = [invoice for invoice in fetched
+                    if invoice.last_modified is None or seen.get(invoice.number) != invoice.last_modified]
+        watermark = _newest_modification(watermark, invoices)
+        invoices = [invoice for invoice in invoices if in_shard(shard, invoice.number)]
+        if not next_invoice:
+            yield Page(invoices, watermark, None)
+            return
+        if searching and watermark is not None and (modified_since is None or watermark > modified_since):
+            # the search results are sorted by modification date and an invoice modified while paging moves to
+            # their end, so the offset of the next page would skip an unread invoice; a new search starting
+            # from the newest modification seen so far does not
+            seen = {invoice.number: invoice.last_modified for invoice in fetched if invoice.last_modified == watermark}
+            modified_since = watermark
+            fetch_invoices = partial(search_invoices, modified_since=modified_since, **(search_filters or {}))
+            next_invoice = None
+        elif searching and int(next_invoice) >= SEARCH_RESULTS_LIMIT:
+            # a new search would return the same results again
+            raise RuntimeError(f"more than {SEARCH_RESULTS_LIMIT} invoices were modified at "
+                               f"{watermark.isoformat() if watermark else 'the same moment'}, "
+                               f"run a full synchronisation instead")
+        yield Page(invoices, watermark, {
+            "run_id": run_id,
+            "modified_since": modified_since.isoformat() if modified_since else None,
+            "watermark": watermark.isoformat() if watermark else None,
+            "after": next_invoice,
+            "search_filters": search_filters,
+            "started_at": started.isoformat() if started else None,
+            "mode": mode,
+        })
+
+
+def _describe_filters(search_filters):
+    return ", ".join(f"{name} {len(value)} values" if isinstance(value, list) and len(value) > 10 else f"{name} {value}"
+                     for name, value in search_filters.items())
+
+
+def _search_filters(connection, server_filter):
+    """The filters that make HubSpot only return open and paid invoices the ledger has not seen paid."""
+    if not server_filter:
+        return None
+    return {"statuses": [INVOICE_STATUS_OPEN, INVOICE_STATUS_PAID],
+            "excluded_numbers": get_paid_invoice_numbers(connection, SEARCH_EXCLUDED_NUMBERS_LIMIT)}
+
+
+def _complete_page(connection, page, debtor_index, product_index):
+    """Store everything learned while syncing the page in one commit, together with its checkpoint."""
+    _save_wefact_index(connection, debtor_index)
+    _save_wefact_index(connection, product_index)
+    if page.checkpoint is not None:
+        save_checkpoint(connection, page.checkpoint)
+    commit_page(connection)
+
+
+def _metrics_path(path, shard):
+    path = Path(path)
+    return path.with_stem(f"{path.stem}-{shard_scope(shard)}") if shard is not None else path
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.shard is not None:
+        logger.info(f"syncing shard {args.shard.index} of {args.shard.count}")
+        REGISTRY.const_labels = {"shard": f"{args.shard.index}/{args.shard.count}"}
+    if args.daemon:
+        run_daemon(args)
+        return
+    try:
+        run(args)
+    except SyncLockedError as e:
+        logger.error(f"not syncing, {e}")
+        sys.exit(EXIT_SYNC_LOCKED)
+    finally:
+        # also for a failed run, that is when the numbers are most interesting
+        _write_metrics(args)
+
+
+def _write_metrics(args):
+    try:
+        REGISTRY.write_textfile(_metrics_path(args.metrics_file, args.shard))
+    except OSError as e:
+        logger.warning(f"could not write the metrics to {args.metrics_file}: {e}")
+
+
+SyncContext = namedtuple("sync_context", ["connection", "api_client", "debtor_index", "product_index"])
+
+
+def open_sync(connection, args):
+    """Set up what every sync needs: the HubSpot client, the object caches and the WeFact indexes."""
+    api_client = get_api_client()
+    if args.persist_cache:
+        _load_object_caches(connection)
+    debtor_index = _load_wefact_index(connection, DebtorClient(), DEBTOR_CODE_KEY, refresh=args.full)
+    product_index = _load_wefact_index(connection, ProductClient(), PRODUCT_CODE_KEY, refresh=args.full)
+    return SyncContext(connection, api_client, debtor_index, product_index)
+
+
+def run(args):
+    with sync_lock(shard_scope(args.shard)), init_db(shard_scope(args.shard)) as connection:
+        context = open_sync(connection, args)
+        if args.invoice_ids:
+            sync_invoices(context, read_invoices(context.api_client, args.invoice_ids), args)
+        elif selection_filters(args) is not None:
+            sync_selection(context, selection_filters(args), args)
+        else:
+            sync_cycle(context, args)
+
+
+def run_daemon(args, stop=None):
+    """Sync every `args.interval` seconds until `stop` is set, by SIGTERM or SIGINT when not given.
+
+    The state database, the HTTP connections, the HubSpot caches and the WeFact indexes stay open between
+    the cycles. A failed cycle is logged, its statuses that were not committed are saved from the intent log
+    and the next one resumes from its checkpoint; a cycle is skipped
+    while another process syncs with the same state database. Only the first cycle honours
+    --reset-checkpoint, and --full holds until a cycle succeeded, so a failed full cycle is resumed as one.
+    """
+    if stop is None:
+        stop = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: stop.set())
+    logger.info(f"starting the sync daemon, a cycle every {args.interval} seconds")
+    with (init_db(shard_scope(args.shard)) as connection):
+        context = None
+        cycle = 0
+        while not stop.is_set():
+            cycle += 1
+            started = time.perf_counter()
+            outcome = "success"
+            try:
+                with sync_lock(shard_scope(args.shard)):
+                    # the statuses of a failed cycle were rolled back, but their invoices were pushed already
+                    replay_intent_log(connection)
+                    # the WeFact indexes are written while loading, so that waits for the lock as well
+                    context = context or open_sync(connection, args)
+                    sync_cycle(context, args)
+            except SyncLockedError as e:
+                logger.warning(f"skipping sync cycle {cycle}, {e}")
+                outcome = "skipped"
+            except Exception:
+                logger.exception(f"sync cycle {cycle} failed")
+                connection.rollback()
+                outcome = "failure"
+            elapsed = time.perf_counter() - started
+            SYNC_CYCLE_SECONDS.observe(elapsed, outcome=outcome)
+            logger.info(f"sync cycle {cycle} finished in {elapsed:.2f} seconds ({outcome})")
+            _write_metrics(args)
+            if outcome == "success":
+                args = argparse.Namespace(**{**vars(args), "full": False})
+            if outcome != "skipped":
+                args = argparse.Namespace(**{**vars(args), "reset_checkpoint": False})
+            stop.wait(max(0.0, args.interval - elapsed))
+    logger.info(f"stopped the sync daemon after {cycle} cycles")
+
+
+def sync_invoices(context, invoices, args):
+    """Sync just these invoices, outside the paging of a run."""
+    connection, api_client, debtor_index, product_index = context
+    logger.info(f"syncing {len(invoices)} selected invoices")
+    process_batch_of_invoices(api_client, connection, invoices, debtor_index, product_index, args.batch_writes)
+    _complete_page(connection, Page(invoices, None, None), debtor_index, product_index)
+
+
+def sync_selection(context, search_filters, args):
+    """Sync the invoices the search filters select, page by page, without a checkpoint to resume from."""
+    pages = iterate_pages(context.api_client, uuid.uuid4().hex, None, None, None, args.shard, search_filters)
+    for page in pages:
+        sync_invoices(context, page.invoices, args)
+
+
+def retry_failed_invoices(context, args):
+    """Sync the invoices that failed in earlier runs again once their backoff has passed.
+
+    An incremental run only sees invoices modified after the watermark, which moves past failed
+    invoices; a fix of e.g. their company does not modify the invoice itself.
+    """
+    connection, api_client = context.connection, context.api_client
+    retries = [invoice_id for invoice_id, number in get_invoices_to_retry(connection) if in_shard(args.shard, number)]
+    if len(retries) == 0:
+        return
+    logger.info(f"retrying {len(retries)} invoices whose sync failed before")
+    invoices = read_invoices(api_client, retries)
+    # invoices that were removed or need no work any more are not tried again
+    pending = {invoice.id for invoice, _ in _pending_invoices(connection, invoices)}
+    for invoice_id in retries:
+        if invoice_id not in pending:
+            clear_invoice_retry(connection, invoice_id, commit=False)
+    sync_invoices(context, [invoice for invoice in invoices if invoice.id in pending], args)
+
+
+def _run_mode(args):
+    mode = "full" if args.full else "incremental"
+    return f"{mode} with server filter" if args.server_filter else mode
+
+
+def sync_cycle(context, args):
+    connection, api_client, debtor_index, product_index = context
+    mode = _run_mode(args)
+    if args.reset_checkpoint:
+        clear_checkpoint(connection)
+    checkpoint = get_checkpoint(connection)
+    if checkpoint is not None and checkpoint.get("mode") != mode:
+        logger.warning(f"not resuming run {checkpoint['run_id']}, a {checkpoint.get('mode') or 'earlier'} "
+                       f"synchronisation, as a {mode} synchronisation was asked for")
+        clear_checkpoint(connection)
+        checkpoint = None
+    if checkpoint is not None:
+        # continue where the previous run died, with the same query its paging cursor belongs to
+        run_id = checkpoint["run_id"]
+        modified_since = _parse_datetime(checkpoint["modified_since"])
+        watermark = _parse_datetime(checkpoint["watermark"])
+        next_invoice = checkpoint["after"]
+        search_filters = checkpoint.get("search_filters")
+        if modified_since is not None or search_filters is not None:
+            # invoices modified since the run died moved in the search results, so an offset into them would skip
+            # unread ones; search again from the newest modification seen instead
+            modified_since = watermark or modified_since
+            next_invoice = None
+        started = _parse_datetime(checkpoint.get("started_at")) or datetime.now(timezone.utc)
+        logger.info(f"resuming run {run_id} from paging cursor {next_invoice}" if next_invoice is not None
+                    else f"resuming run {run_id} from its watermark")
+    else:
+        run_id = uuid.uuid4().hex
+        started = datetime.now(timezone.utc)
+        modified_since = None if args.full else get_watermark(connection)
+        watermark = modified_since
         next_invoice = None
-        while True:
-            next_invoice = process_batch_of_invoices(api_client, connection, next_invoice)
-            if not next_invoice:
-                break
+        search_filters = _search_filters(connection, args.server_filter)
+        logger.info(f"starting run {run_id}")
+    if modified_since is not None:
+        # a full synchronisation visits the failed invoices anyway
+        retry_failed_invoices(context, args)
+    pages = iterate_pages(api_client, run_id, modified_since, watermark, next_invoice, args.shard, search_filters,
+                          started, mode)
+    if args.pipeline:
+        watermark = run_pipelined(api_client, connection, pages, debtor_index, product_index, args.concurrency,
+                                  args.batch_writes, watermark)
+    else:
+        for page in pages:
+            if args.concurrency > 1:
+                asyncio.run(process_batch_of_invoices_async(api_client, connection, page.invoices,
+                                                            args.concurrency, debtor_index, product_index,
+                                                            args.batch_writes))
+            else:
+                process_batch_of_invoices(api_client, connection, page.invoices, debtor_index, product_index,
+                                          args.batch_writes)
+            _complete_page(connection, page, debtor_index, product_index)
+            watermark = page.watermark
+    clear_checkpoint(connection)
+    if watermark is not None:
+        save_watermark(connection, _capped_watermark(watermark, started))
+    for cache, _ in OBJECT_CACHES:
+        logger.info(f"HubSpot cache statistics: {cache.stats()}")
+    logger.info(f"HubSpot rate limit statistics: {RATE_LIMIT_GOVERNOR.stats()}")
+    logger.info(f"WeFact connection statistics: {WeFactBase.connection_stats()}")
+    if args.persist_cache:
+        _save_object_caches(connection)
 
 
 def _determine_action(db_status, invoice):
@@ -47,11 +511,12 @@ def _determine_action(db_status, invoice):
     raise ValueError("error in processing invoice and db statuses")
 
 
-def process_batch_of_invoices(api_client, connection, next_invoice):
-    invoices, next_invoice = get_invoices(api_client, next_invoice)
+def _pending_invoices(connection, invoices):
+    pending = []
+    db_statuses = determine_db_statuses(connection, [invoice.number for invoice in invoices])
     for invoice in invoices:
         # verwerk alleen facturen met PAID of OPEN status
-        db_status = determine_db_status(connection, invoice)
+        db_status = db_statuses[invoice.number]
         action = _determine_action(db_status, invoice)
         if action == ACTION_SKIP:
             logger.debug(f"skipping invoice {invoice.number}[{invoice.id}]")
@@ -59,41 +524,270 @@ def process_batch_of_invoices(api_client, connection, next_invoice):
         if action == ACTION_PROCESSED:
             logger.info(f"invoice already processed, skipping invoice {invoice.number}[{invoice.id}]")
             continue
-        (company, contact, errors) = get_invoice_details(api_client, invoice)
-        if len(errors) > 0:
-            logger.error(f"invoice contains errors {errors}, skipping invoice {invoice.number}[{invoice.id}]")
-            create_task(api_client, company.id, "errors to be fixed", f"invoice details for {invoice.number} contain errors: {errors}")
-            continue
-        # verwerk alleen facturen met PAID of OPEN status
-        if action == INVOICE_STATUS_PAID:
-            result = invoice_update_paid(invoice.number)
-        elif action == INVOICE_STATUS_OPEN:
-            result = generate_invoice(invoice, company)
+        pending.append((invoice, action))
+    return pending
+
+
+class InvoiceJob:
+    """One invoice on its way through the sync steps, from HubSpot details to the PDF upload."""
+
+    def __init__(self, invoice, action, associations=None, line_item_properties=None, previous=None):
+        self.invoice = invoice
+        self.action = action
+        self.associations = associations
+        self.line_item_properties = line_item_properties
+        # the ledger row of an earlier sync of the invoice, to recognise a PDF that was uploaded already
+        self.previous = previous
+        self.company = None
+        self.result = None
+        self.ledger_entry = None
+        self.finished = False
+        self.started = time.perf_counter()
+
+
+def _observe_invoice(job: InvoiceJob):
+    INVOICE_SYNC_SECONDS.observe(time.perf_counter() - job.started, action=job.action,
+                                 outcome="synced" if job.ledger_entry is not None else "not_synced")
+
+
+def enrich_invoice(api_client, job: InvoiceJob):
+    invoice = job.invoice
+    (company, contact, errors) = get_invoice_details(api_client, invoice, job.associations, job.line_item_properties)
+    job.company = company
+    if len(errors) > 0:
+        logger.error(f"invoice contains errors {errors}, skipping invoice {invoice.number}[{invoice.id}]")
+        create_task(api_client, company.id, "errors to be fixed", f"invoice details for {invoice.number} contain errors: {errors}")
+        job.finished = True
+
+
+def push_invoice(job: InvoiceJob, debtor_index=None, product_index=None):
+    if job.finished:
+        return
+    invoice = job.invoice
+    # verwerk alleen facturen met PAID of OPEN status
+    if job.action == INVOICE_STATUS_PAID:
+        result = invoice_update_paid(invoice.number)
+    elif job.action == INVOICE_STATUS_OPEN:
+        result = generate_invoice(invoice, job.company, debtor_index, product_index, job.previous)
+    else:
+        # continue with any other status
+        logger.info(
+            f"invoice has a status we do not know about, skipping invoice {invoice.number}[{invoice.id}]"
+        )
+        job.finished = True
+        return
+    job.result = result
+    if result.persist:
+        job.ledger_entry = LedgerEntry(wefact_identifier=result.data.get("Identifier"))
+        job.finished = True
+        return
+    if len(result.errors) > 0:
+        logger.error(
+            f"HubSpot invoice {invoice.number}[{invoice.id}] with status {invoice.status} not saved in state database")
+        logger.error(f"error: {result.errors}")
+        job.finished = True
+
+
+def upload_invoice_pdf(api_client, job: InvoiceJob):
+    if job.finished:
+        return
+    result = job.result
+    if result.data.get("pdf") is None:
+        logger.error(f"no PDF of invoice {job.invoice.number}[{job.invoice.id}] to upload, it is tried again later")
+        job.finished = True
+        return
+    # the downloaded PDF, as a file that is closed once it is uploaded
+    with result.data["pdf"] as pdf:
+        pdf_hash = pdf_digest(pdf)
+        archive_pdf(pdf, pdf_hash)
+        previous = job.previous or {}
+        if previous.get("pdf_hash") == pdf_hash and previous.get("hubspot_file_id") is not None:
+            # HubSpot has this very PDF already, e.g. when an invoice is paid without changing its PDF
+            logger.info(f"PDF of invoice {job.invoice.number}[{job.invoice.id}] is unchanged, not uploaded again")
+            file_id, note_id = previous["hubspot_file_id"], previous.get("hubspot_note_id")
         else:
-            # continue with any other status
-            logger.info(
-                f"invoice has a status we do not know about, skipping invoice {invoice.number}[{invoice.id}]"
-            )
-            continue
-        if result.persist:
-            save_invoice_id_in_db(connection, invoice)
-            logger.info(f"HubSpot invoice {invoice.number}[{invoice.id}] with status {invoice.status} just saved in state database")
-            continue
-        if len(result.errors) > 0:
-            logger.error(
-                f"HubSpot invoice {invoice.number}[{invoice.id}] with status {invoice.status} not saved in state database")
-            logger.error(f"error: {result.errors}")
-            continue
-        pdf_data = result.data["pdf"]
-        save_invoice_pdf(api_client, company, invoice, pdf_data)
-        save_invoice_id_in_db(connection, invoice)
-    return next_invoice
+            file_id, note_id = save_invoice_pdf(api_client, job.company, job.invoice, pdf)
+    job.ledger_entry = LedgerEntry(wefact_identifier=result.data.get("Identifier"),
+                                   payload_hash=result.data.get("payload_hash"), pdf_hash=pdf_hash,
+                                   hubspot_file_id=file_id, hubspot_note_id=note_id)
+    job.finished = True
+
+
+def sync_invoice(api_client, invoice, action, associations=None, line_item_properties=None, debtor_index=None,
+                 product_index=None, previous=None):
+    """Push one invoice to WeFact and its PDF to HubSpot.
+
+    `previous` is the ledger row of the invoice, if any. Returns the job, whose ledger entry is the one
+    to save with the new status, or None when the status may not be saved.
+    """
+    job = InvoiceJob(invoice, action, associations, line_item_properties, previous)
+    enrich_invoice(api_client, job)
+    push_invoice(job, debtor_index, product_index)
+    upload_invoice_pdf(api_client, job)
+    _observe_invoice(job)
+    return job
+
+
+def _save_synced_invoice(connection, invoice, ledger_entry, batch_writes=False):
+    clear_invoice_retry(connection, invoice.id, commit=False)
+    record_invoice_ledger(connection, invoice, ledger_entry, commit=not batch_writes)
+    logger.info(f"HubSpot invoice {invoice.number}[{invoice.id}] with status {invoice.status} just saved in state database")
+
+
+def _save_sync_outcome(connection, job: InvoiceJob, batch_writes=False):
+    """Save a synced invoice, or remember a failed one, as the watermark moves past it anyway."""
+    invoice = job.invoice
+    if job.ledger_entry is not None:
+        _save_synced_invoice(connection, invoice, job.ledger_entry, batch_writes)
+        return
+    logger.warning(f"sync of invoice {invoice.number}[{invoice.id}] failed, it is tried again in a later run")
+    data = job.result.data if job.result is not None else {}
+    if data.get("Identifier") is not None and data.get("payload_hash") is not None:
+        # the invoice is in WeFact already, e.g. when only its PDF could not be downloaded
+        record_wefact_push(connection, invoice, LedgerEntry(wefact_identifier=data["Identifier"],
+                                                            payload_hash=data["payload_hash"]), commit=False)
+    mark_invoice_for_retry(connection, invoice, commit=not batch_writes)
+
+
+def sync_products_of_batch(pending, associations, line_item_properties, product_index):
+    """Push the products of all new invoices in a batch to WeFact before the invoices themselves.
+
+    Every SKU is pushed once, and only when it is new or changed according to the product index. With
+    different prices for a SKU in the batch, the product gets the price of its last line item; the
+    invoices carry the price of every line themselves, so the invoices that follow need no product calls.
+    """
+    line_item_ids = [line_item_id for invoice, action in pending if action == ACTION_OPEN
+                     for line_item_id in associations["line_items"].get(invoice.id, [])]
+    line_items = distinct_line_items(line_item_ids, line_item_properties)
+    logger.info(f"reconciling {len(line_items)} distinct products with WeFact")
+    sync_products(ProductClient(), line_items, product_index)
+
+
+def process_batch_of_invoices(api_client, connection, invoices, debtor_index=None, product_index=None,
+                              batch_writes=False):
+    pending = _pending_invoices(connection, invoices)
+    if len(pending) == 0:
+        return
+    # resolve the associations of all invoices that need work in one go instead of per invoice
+    associations = resolve_invoice_associations(api_client, [invoice for invoice, _ in pending])
+    line_item_properties = read_line_items(api_client, associated_line_item_ids(associations))
+    if product_index is not None:
+        sync_products_of_batch(pending, associations, line_item_properties, product_index)
+    for invoice, action in pending:
+        # read per invoice, as an earlier invoice of the batch may have the same number
+        job = sync_invoice(api_client, invoice, action, associations, line_item_properties, debtor_index,
+                           product_index, get_invoice_ledger(connection, invoice.number))
+        _save_sync_outcome(connection, job, batch_writes)
+
+
+async def process_batch_of_invoices_async(api_client, connection, invoices, concurrency, debtor_index=None,
+                                          product_index=None, batch_writes=False):
+    """Like `process_batch_of_invoices`, but syncs up to `concurrency` invoices at the same time.
+
+    The HTTP work of an invoice runs in a worker thread; the state database is only used from the
+    event loop. Invoices with the same number are handled one after the other, and their action is
+    determined again once it is their turn, so an OPEN transition is always saved before a PAID one.
+    """
+    pending = _pending_invoices(connection, invoices)
+    if len(pending) == 0:
+        return
+    associations = await resolve_invoice_associations_async(api_client, [invoice for invoice, _ in pending])
+    line_item_properties = await read_line_items_async(api_client, associated_line_item_ids(associations))
+    if product_index is not None:
+        await asyncio.to_thread(sync_products_of_batch, pending, associations, line_item_properties, product_index)
+    semaphore = asyncio.Semaphore(concurrency)
+    invoice_locks = defaultdict(asyncio.Lock)
+
+    async def process(invoice):
+        async with invoice_locks[invoice.number], semaphore:
+            action = _determine_action(determine_db_status(connection, invoice), invoice)
+            if action in (ACTION_SKIP, ACTION_PROCESSED):
+                return
+            job = await asyncio.to_thread(sync_invoice, api_client, invoice, action, associations,
+                                          line_item_properties, debtor_index, product_index,
+                                          get_invoice_ledger(connection, invoice.number))
+            _save_sync_outcome(connection, job, batch_writes)
+
+    await asyncio.gather(*(process(invoice) for invoice, _ in pending))
+
+
+def run_pipelined(api_client, connection, pages, debtor_index, product_index, concurrency, batch_writes, watermark):
+    """Sync the pages with the fetch, resolve, enrich, push and upload steps running side by side.
+
+    The state database is only used from the calling thread. An invoice number is never in two stages at
+    the same time: a page waits for earlier pages to finish invoices with the same number, and duplicates
+    within a page are synced after the rest of the page. Returns the watermark of the last finished page.
+    """
+    in_flight = set()
+    deferred = {}
+    completed = {"watermark": watermark}
+
+    def resolve(item):
+        pending, previous = item
+        associations = resolve_invoice_associations(api_client, [invoice for invoice, _ in pending])
+        line_item_properties = read_line_items(api_client, associated_line_item_ids(associations))
+        if product_index is not None:
+            sync_products_of_batch(pending, associations, line_item_properties, product_index)
+        return [InvoiceJob(invoice, action, associations, line_item_properties, previous.get(invoice.number))
+                for invoice, action in pending]
+
+    def enrich(job):
+        enrich_invoice(api_client, job)
+        return [job]
+
+    def push(job):
+        push_invoice(job, debtor_index, product_index)
+        return [job]
+
+    def upload(job):
+        upload_invoice_pdf(api_client, job)
+        return [job]
+
+    def dispatch(page):
+        numbers = {invoice.number for invoice in page.invoices}
+        pipeline.drain_until(lambda: in_flight.isdisjoint(numbers))
+        pending, duplicates = [], []
+        for invoice, action in _pending_invoices(connection, page.invoices):
+            if invoice.number in in_flight:
+                duplicates.append(invoice)
+                continue
+            in_flight.add(invoice.number)
+            pending.append((invoice, action))
+        deferred[id(page)] = duplicates
+        # the ledger is read here, as the stages may not use the state database
+        previous = {invoice.number: get_invoice_ledger(connection, invoice.number) for invoice, _ in pending}
+        return [(pending, previous)] if len(pending) > 0 else []
+
+    def sink(job):
+        _observe_invoice(job)
+        _save_sync_outcome(connection, job, batch_writes)
+        in_flight.discard(job.invoice.number)
+
+    def page_done(page):
+        duplicates = deferred.pop(id(page))
+        if len(duplicates) > 0:
+            process_batch_of_invoices(api_client, connection, duplicates, debtor_index, product_index, batch_writes)
+        _complete_page(connection, page, debtor_index, product_index)
+        completed["watermark"] = page.watermark
+
+    queue_size = 2 * concurrency
+    pipeline = Pipeline([
+        Stage("resolve", resolve),
+        Stage("enrich", enrich, concurrency, queue_size),
+        Stage("push", push, concurrency, queue_size),
+        Stage("upload", upload, concurrency, queue_size),
+    ], sink, page_done)
+    pipeline.run(pages, dispatch)
+    for stats in pipeline.stats():
+        logger.info(f"pipeline stage statistics: {stats}")
+    return completed["watermark"]
 
 
-def save_invoice_pdf(api_client, company, invoice, pdf_data):
+def save_invoice_pdf(api_client, company, invoice, pdf):
     filename = f"{invoice.number}.pdf"
-    result = upload_invoice(api_client, filename, pdf_data)
-    associate_file_to_company(api_client, company.id, f"{filename} {result['url']}", result["id"])
+    result = upload_invoice(api_client, filename, pdf)
+    note = associate_file_to_company(api_client, company.id, f"{filename} {result['url']}", result["id"])
+    return result["id"], getattr(note, "id", None)
 
 
 if __name__ == "__main__":
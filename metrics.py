@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+# upper bounds in seconds, from a cached lookup to a slow PDF upload
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count per combination of label values."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+
+    def samples(self, const_labels):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, {**const_labels, **dict(zip(self.labelnames, key))}, value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    """Observations per combination of label values, counted in cumulative `buckets` like Prometheus does."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(tuple(str(labels[name]) for name in self.labelnames), ([0], 0.0))
+        return counts[-1]
+
+    def samples(self, const_labels):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in values:
+            labels = {**const_labels, **dict(zip(self.labelnames, key))}
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, count
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, counts[-1]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Registry:
+    """The metrics of a run, rendered in the Prometheus text exposition format.
+
+    `const_labels` are added to every sample, e.g. the shard that produced them.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.const_labels = {}
+
+    def counter(self, name, help, labelnames=()):
+        return self.metrics.setdefault(name, Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples(self.const_labels):
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Write the metrics for the node exporter's textfile collector; the rename keeps partial files unseen."""
+        path = Path(path)
+        temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        temporary.write_text(self.render(), encoding="utf-8")
+        os.replace(temporary, path)
+
+    def clear(self):
+        for metric in self.metrics.values():
+            metric.clear()
+
+
+REGISTRY = Registry()
+
+HUBSPOT_REQUESTS = REGISTRY.counter(
+    "hubspot_requests_total", "HTTP requests sent to HubSpot", ["method", "endpoint", "status"])
+HUBSPOT_REQUEST_SECONDS = REGISTRY.histogram(
+    "hubspot_request_duration_seconds", "Duration of HTTP requests to HubSpot", ["method", "endpoint"])
+WEFACT_REQUESTS = REGISTRY.counter(
+    "wefact_requests_total", "Requests sent to the WeFact API", ["controller", "action", "status"])
+WEFACT_REQUEST_SECONDS = REGISTRY.histogram(
+    "wefact_request_duration_seconds", "Duration of requests to the WeFact API", ["controller", "action"])
+SQLITE_OPERATION_SECONDS = REGISTRY.histogram(
+    "state_db_operation_duration_seconds", "Duration of operations on the state database", ["operation"])
+INVOICE_SYNC_SECONDS = REGISTRY.histogram(
+    "invoice_sync_duration_seconds", "Time from starting an invoice to having it synced or given up",
+    ["action", "outcome"], buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+SYNC_CYCLE_SECONDS = REGISTRY.histogram(
+    "sync_cycle_duration_seconds", "Duration of a sync cycle of the daemon", ["outcome"],
+    buckets=(1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0))
+
+
+def timed(histogram, **labels):
+    """Decorator recording the duration of every call in the histogram."""
+
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
@@ -1,4 +1,4 @@
-from datetime import date
+from datetime import date, datetime
 
 from pydantic import BaseModel, Field
 
@@ -12,6 +12,7 @@ class Invoice(BaseModel):
     due_date: date
     invoice_date: date
     amount_billed: float
+    last_modified: datetime | None = None
     korting: float = 0.0
     line_items: list[LineItem] = Field(default_factory=list)
     betreft: str | None = None
@@ -0,0 +1,207 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class StageStats:
+    """Counts the items a stage handled and the time its workers were busy with them."""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, queue_depth: int = 0):
+        with self._lock:
+            self.items += 1
+            self.busy_seconds += seconds
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def report(self, elapsed: float):
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "items": self.items,
+            "items_per_second": round(self.items / elapsed, 2) if elapsed > 0 else 0.0,
+            "utilisation": round(self.busy_seconds / (elapsed * self.workers), 2) if elapsed > 0 else 0.0,
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+
+class Stage:
+    """A step of the pipeline; `handler(item)` returns the list of items for the next stage."""
+
+    def __init__(self, name: str, handler, workers: int = 1, queue_size: int = 4):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats = StageStats(name, workers)
+
+
+class Pipeline:
+    """Runs pages of work through stages of worker threads connected by bounded queues.
+
+    A fetch thread reads `pages` up to `prefetch` pages ahead. `dispatch(page)` turns a page into the
+    items of the first stage, and `sink(item)` receives the items leaving the last stage. Both run in
+    the thread that called `run`, just like `on_page_done(page)`, which is called in page order once
+    every item of a page has been sunk. A full queue blocks the stage before it, so a slow stage
+    slows down the whole pipeline instead of buffering work in memory. When a handler or the thread of
+    `run` fails, the remaining work is dropped and every thread is stopped before `run` raises.
+    """
+
+    def __init__(self, stages, sink, on_page_done, prefetch: int = 2):
+        self.stages = stages
+        self.sink = sink
+        self.on_page_done = on_page_done
+        self.fetch_stats = StageStats("fetch", 1)
+        self._pages = queue.Queue(maxsize=prefetch)
+        self._finished = queue.Queue()
+        self._lock = threading.Lock()
+        self._outstanding = {}
+        self._dispatched = {}
+        self._next_done = 0
+        self._started = None
+        self._stopping = threading.Event()
+
+    def _put(self, target, item):
+        """Put an item on a bounded queue, unless the pipeline stops while the queue is full."""
+        while not self._stopping.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _fetch(self, pages):
+        try:
+            iterator = iter(pages)
+            while True:
+                started = time.monotonic()
+                page = next(iterator, _STOP)
+                if page is _STOP:
+                    break
+                self.fetch_stats.record(time.monotonic() - started, self._pages.qsize())
+                if not self._put(self._pages, page):
+                    return
+        except BaseException as exc:
+            self._put(self._pages, exc)
+            return
+        self._put(self._pages, _STOP)
+
+    def _work(self, position):
+        stage = self.stages[position]
+        next_stage = self.stages[position + 1] if position + 1 < len(self.stages) else None
+        while True:
+            job = stage.queue.get()
+            if job is _STOP:
+                return
+            if self._stopping.is_set():
+                # keep taking items, so the stage before never waits for room
+                continue
+            sequence, item = job
+            started = time.monotonic()
+            try:
+                results = stage.handler(item)
+            except BaseException as exc:
+                self._finished.put(("error", sequence, exc))
+                continue
+            stage.stats.record(time.monotonic() - started, stage.queue.qsize())
+            with self._lock:
+                self._outstanding[sequence] += len(results) - 1
+            for result in results:
+                if next_stage is not None:
+                    self._put(next_stage.queue, (sequence, result))
+                else:
+                    self._finished.put(("result", sequence, result))
+            if len(results) == 0:
+                self._finished.put(("dropped", sequence, None))
+
+    def _handle_finished(self, block: bool):
+        try:
+            kind, sequence, item = self._finished.get(block=block)
+        except queue.Empty:
+            return False
+        if kind == "error":
+            raise item
+        if kind == "result":
+            self.sink(item)
+            with self._lock:
+                self._outstanding[sequence] -= 1
+        self._complete_pages()
+        return True
+
+    def _complete_pages(self):
+        while self._next_done in self._dispatched:
+            with self._lock:
+                if self._outstanding[self._next_done] > 0:
+                    return
+            self.on_page_done(self._dispatched.pop(self._next_done))
+            self._next_done += 1
+
+    def drain_until(self, predicate):
+        """Sink finished items on the calling thread until `predicate()` holds."""
+        while not predicate():
+            self._handle_finished(block=True)
+
+    def run(self, pages, dispatch):
+        self._started = time.monotonic()
+        threads = [threading.Thread(target=self._fetch, args=(pages,), name="pipeline-fetch", daemon=True)]
+        for position, stage in enumerate(self.stages):
+            threads.extend(threading.Thread(target=self._work, args=(position,), name=f"pipeline-{stage.name}",
+                                            daemon=True) for _ in range(stage.workers))
+        for thread in threads:
+            thread.start()
+        try:
+            self._run(dispatch)
+        finally:
+            self._stop(threads)
+
+    def _stop(self, threads):
+        """Stop the fetch thread and the workers, after the last page or a failure, and wait for them."""
+        self._stopping.set()
+        for stage in self.stages:
+            for _ in range(stage.workers):
+                stage.queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+
+    def _run(self, dispatch):
+        sequence = 0
+        while True:
+            page = self._pages.get()
+            if page is _STOP:
+                break
+            if isinstance(page, BaseException):
+                raise page
+            items = dispatch(page)
+            with self._lock:
+                self._outstanding[sequence] = len(items)
+            self._dispatched[sequence] = page
+            for item in items:
+                # sink what is finished while waiting for room in the first stage
+                while True:
+                    try:
+                        self.stages[0].queue.put((sequence, item), timeout=0.1)
+                        break
+                    except queue.Full:
+                        while self._handle_finished(block=False):
+                            pass
+            sequence += 1
+            while self._handle_finished(block=False):
+                pass
+            self._complete_pages()
+        self.drain_until(lambda: self._next_done == sequence)
+
+    def stats(self):
+        elapsed = time.monotonic() - self._started if self._started is not None else 0.0
+        return [self.fetch_stats.report(elapsed)] + [stage.stats.report(elapsed) for stage in self.stages]
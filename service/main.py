@@ -1,23 +1,51 @@
+import asyncio
+import json
 import os
-import uuid
-from typing import Dict, Optional
+import shlex
+import threading
+from datetime import date
+from pathlib import Path
+from typing import Annotated, Optional
 
 import docker
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Depends
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Depends, Header, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, StringConstraints
 
 from auth import verify_api_key
+from prometheus import merge_textfiles
+from scheduler import Scheduler
+from tasks import TaskStore, LogWriter, stream_task_logs, finished_status, STATUSES, STATUS_QUEUED, STATUS_RUNNING, \
+    STATUS_FAILED
+from webhooks import EventBatcher, valid_signature
 
 HOST_DATA_PATH = os.environ["HOST_DATA_PATH"]
 HUBSPOT_ACCESS_TOKEN = os.environ["HUBSPOT_ACCESS_TOKEN"]
 WEFACT_API_KEY = os.environ["WEFACT_API_KEY"]
 
 IMAGE = "creathlon/hubspot-wefact"
-
-STATUS_QUEUED = "queued"
-STATUS_RUNNING = "running"
-STATUS_COMPLETED = "completed"
-STATUS_FAILED = "failed"
+# the command of the image, extended with --shard K/N for a sharded run
+SYNC_COMMAND = "python main.py"
+MAX_SHARDS = int(os.getenv("MAX_SHARDS", "16"))
+# SEARCH_SELECTED_NUMBERS_LIMIT of the sync: the invoice numbers a search can select
+MAX_SELECTED_NUMBERS = 300
+# the data directory of the sync containers, where every run (or shard) leaves its metrics textfile
+METRICS_PATH = Path(os.getenv("METRICS_PATH", "/app/data"))
+# the client secret of the HubSpot app whose webhook subscriptions call /webhooks/hubspot
+HUBSPOT_CLIENT_SECRET = os.getenv("HUBSPOT_CLIENT_SECRET")
+# the URL as HubSpot calls it, which the signature covers; behind the proxy the request URL differs
+HUBSPOT_WEBHOOK_URL = os.getenv("HUBSPOT_WEBHOOK_URL")
+# how long to collect the events of a burst before syncing the invoices they touched
+WEBHOOK_COALESCE_SECONDS = float(os.getenv("WEBHOOK_COALESCE_SECONDS", "5"))
+# the tasks and their logs, on a volume of the service so they survive restarts
+TASK_DB_PATH = Path(os.getenv("TASK_DB_PATH", "/app/state/tasks.db"))
+# finished tasks are forgotten after this many days, or when more than TASK_HISTORY_LIMIT are kept
+TASK_RETENTION_DAYS = float(os.getenv("TASK_RETENTION_DAYS", "30"))
+TASK_HISTORY_LIMIT = int(os.getenv("TASK_HISTORY_LIMIT", "500"))
+# the last lines of the log returned as `output` by GET /tasks/{task_id}; the full log is streamed
+OUTPUT_TAIL_LINES = int(os.getenv("OUTPUT_TAIL_LINES", "100"))
 
 app = FastAPI()
 app.add_middleware(
@@ -30,73 +58,263 @@ app.add_middleware(
 
 client = docker.from_env()
 
-# In-memory store for task status (in production, use Redis or a database)
-tasks: Dict[str, dict] = {}
+task_store = TaskStore(TASK_DB_PATH)
+# the containers of tasks a previous process started are not followed anymore
+task_store.interrupt_unfinished("the service restarted before the task finished")
+
+webhook_events = EventBatcher()
+
+
+def _start_container(image: str, command: Optional[str]):
+    return client.containers.run(
+        image=image,
+        command=command,
+        environment={
+            "HUBSPOT_ACCESS_TOKEN": HUBSPOT_ACCESS_TOKEN,
+            "WEFACT_API_KEY": WEFACT_API_KEY,
+        },
+        detach=True,
+        volumes={
+            HOST_DATA_PATH: {
+                "bind": "/app/data",
+                "mode": "rw",
+            }
+        },
+    )
+
+
+def _shard_command(command: Optional[str], index: int, shards: int):
+    return f"{command or SYNC_COMMAND} --shard {index}/{shards}"
 
 
-def execute_docker_container(task_id: str, image: str, command: str):
+def _prune_tasks():
+    task_store.prune(TASK_RETENTION_DAYS * 24 * 3600, TASK_HISTORY_LIMIT)
+
+
+def _follow_logs(task_id: str, container, prefix: str):
+    """Store the output of the container line by line while it runs."""
+    writer = LogWriter(task_store, task_id, prefix)
+    try:
+        for chunk in container.logs(stream=True, follow=True):
+            writer.write(chunk)
+    finally:
+        writer.close()
+
+
+def execute_docker_container(task_id: str, image: str, command: str, shards: int = 1):
     """
     The worker function that runs in the background.
+
+    With more than one shard, a container per shard runs at the same time; the task fails with the
+    exit code of the first shard that failed. A task whose containers found the sync daemon (or another
+    run) syncing is skipped instead. The logs of every container are stored as they come, prefixed with
+    the shard.
     """
     try:
-        tasks[task_id]["status"] = STATUS_RUNNING
-
-        # Run the container
-        container = client.containers.run(
-            image=image,
-            command=command,
-            environment={
-                "HUBSPOT_ACCESS_TOKEN": HUBSPOT_ACCESS_TOKEN,
-                "WEFACT_API_KEY": WEFACT_API_KEY,
-            },
-            detach=True,
-            volumes={
-                HOST_DATA_PATH: {
-                    "bind": "/app/data",
-                    "mode": "rw",
-                }
-            },
-        )
-
-        # Wait for the result (this blocks the background thread, not the API)
-        result = container.wait()
-        logs = container.logs().decode("utf-8")
-
-        tasks[task_id].update(
-            {
-                "status": STATUS_COMPLETED,
-                "exit_code": result["StatusCode"],
-                "output": logs.strip(),
-            }
-        )
+        task_store.update(task_id, status=STATUS_RUNNING)
+
+        # Run the containers, all shards at once
+        if shards == 1:
+            containers = [(None, _start_container(image, command))]
+        else:
+            containers = [(f"{index}/{shards}", _start_container(image, _shard_command(command, index, shards)))
+                          for index in range(1, shards + 1)]
+        followers = [threading.Thread(target=_follow_logs, args=(task_id, container, f"[{shard}] " if shard else ""),
+                                      daemon=True)
+                     for shard, container in containers]
+        for follower in followers:
+            follower.start()
 
-        container.remove()
+        # Wait for the results (this blocks the background thread, not the API)
+        results = []
+        for (shard, container), follower in zip(containers, followers):
+            result = container.wait()
+            follower.join()
+            results.append({"shard": shard, "exit_code": result["StatusCode"]})
+            container.remove()
+
+        failed = [result for result in results if result["exit_code"] != 0]
+        details = {"shard_results": results} if shards > 1 else {}
+        task_store.update(task_id, status=finished_status(result["exit_code"] for result in results),
+                          exit_code=failed[0]["exit_code"] if failed else 0, **details)
     except Exception as e:
-        tasks[task_id].update({"status": STATUS_FAILED, "error": str(e)})
+        task_store.update(task_id, status=STATUS_FAILED, error=str(e))
+    finally:
+        _prune_tasks()
+
+
+class SyncSelection(BaseModel):
+    """Restricts a sync to the invoices matching all of the given fields, see the selection of main.py."""
+
+    invoice_numbers: Optional[list[Annotated[str, StringConstraints(pattern=r"^[^,\s]+$")]]] = \
+        Field(None, min_length=1, max_length=MAX_SELECTED_NUMBERS)
+    company_id: Optional[Annotated[str, StringConstraints(pattern=r"^\d+$")]] = None
+    invoice_date_from: Optional[date] = None
+    invoice_date_to: Optional[date] = None
+
+    def arguments(self):
+        """The command line options of main.py for the selection."""
+        arguments = []
+        if self.invoice_numbers:
+            arguments += ["--invoice-numbers", ",".join(self.invoice_numbers)]
+        if self.company_id is not None:
+            arguments += ["--company", self.company_id]
+        if self.invoice_date_from is not None:
+            arguments += ["--invoice-date-from", self.invoice_date_from.isoformat()]
+        if self.invoice_date_to is not None:
+            arguments += ["--invoice-date-to", self.invoice_date_to.isoformat()]
+        return " ".join(shlex.quote(argument) for argument in arguments)
+
+
+def run_task(task_id: str):
+    """Run a task of the scheduler; a webhook run gets the invoice ids collected until now."""
+    task = task_store.get(task_id)
+    command = task["command"]
+    if task.get("invoice_ids"):
+        command = f"{command or SYNC_COMMAND} --invoice-ids {','.join(task['invoice_ids'])}"
+    execute_docker_container(task_id, task["image"], command, task["shards"])
+
+
+# all containers share HOST_DATA_PATH, so one sync runs at a time
+scheduler = Scheduler(task_store, run_task)
+scheduler.resume(reversed(task_store.history(TASK_HISTORY_LIMIT, STATUS_QUEUED)))
 
 
 @app.post("/tasks", status_code=202)
 async def create_task(
-    background_tasks: BackgroundTasks,
     image: str = IMAGE,
     command: Optional[str] = None,
+    shards: int = 1,
+    selection: Optional[SyncSelection] = None,
     token: str = Depends(verify_api_key),
 ):
-    task_id = str(uuid.uuid4())
-    tasks[task_id] = {"status": STATUS_QUEUED, "image": image}
+    """
+    Starts a sync, or queues it while another one runs.
 
-    # Schedule the docker run to happen in the background
-    background_tasks.add_task(execute_docker_container, task_id, image, command)
+    With a selection in the body only the invoices it selects are synced. Requests for the same sync
+    while one is queued get the task id of the queued one.
+    """
+    if not 1 <= shards <= MAX_SHARDS:
+        raise HTTPException(status_code=400, detail=f"shards must be between 1 and {MAX_SHARDS}")
+    if selection is not None and selection.arguments():
+        command = f"{command or SYNC_COMMAND} {selection.arguments()}"
+    task_id, coalesced = await run_in_threadpool(scheduler.submit, image, command, shards)
 
+    if coalesced:
+        message = "Hubspot-Wefact execution already queued, joined it"
+    elif scheduler.active == task_id:
+        message = "Hubspot-Wefact execution started in background"
+    else:
+        message = "Hubspot-Wefact execution queued after the running one"
     return {
         "task_id": task_id,
-        "status": tasks[task_id]["status"],
-        "message": "Hubspot-Wefact execution started in background",
+        "status": STATUS_QUEUED,
+        "coalesced": coalesced,
+        "queue_depth": scheduler.queue_depth,
+        "message": message,
     }
 
 
+@app.get("/tasks/queue")
+async def get_queue(token: str = Depends(verify_api_key)):
+    """The running task and the tasks waiting for it, in the order they will run."""
+    return {"active": scheduler.active, "queued": scheduler.queued, "queue_depth": scheduler.queue_depth}
+
+
+@app.get("/tasks")
+async def list_tasks(limit: int = 50, status: Optional[str] = None, token: str = Depends(verify_api_key)):
+    """The most recent tasks first, without their logs."""
+    return await run_in_threadpool(task_store.history, limit, status)
+
+
 @app.get("/tasks/{task_id}")
 async def get_task_status(task_id: str, token: str = Depends(verify_api_key)):
-    if task_id not in tasks:
+    task = await run_in_threadpool(task_store.get, task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    task["output"] = "\n".join(await run_in_threadpool(task_store.tail, task_id, OUTPUT_TAIL_LINES))
+    return task
+
+
+@app.get("/tasks/{task_id}/logs")
+async def stream_task_logs_events(
+    task_id: str,
+    last_event_id: Optional[int] = Header(None),
+    token: str = Depends(verify_api_key),
+):
+    """
+    Streams the log of a task as Server-Sent Events while it runs, ending with an `end` event.
+
+    A reconnecting client sends the Last-Event-ID of the last line it got and continues after it.
+    """
+    if await run_in_threadpool(task_store.get, task_id) is None:
         raise HTTPException(status_code=404, detail="Task not found")
-    return tasks[task_id]
+    return StreamingResponse(
+        stream_task_logs(task_store, task_id, after=last_event_id or 0),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def sync_webhook_invoices():
+    """Wait for the burst to pass, then sync the invoices it touched in one container."""
+    await asyncio.sleep(WEBHOOK_COALESCE_SECONDS)
+    invoice_ids = webhook_events.take()
+    if invoice_ids:
+        await run_in_threadpool(scheduler.submit, IMAGE, None, 1, invoice_ids)
+
+
+@app.post("/webhooks/hubspot")
+async def receive_hubspot_webhook(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    x_hubspot_signature_v3: Optional[str] = Header(None),
+    x_hubspot_request_timestamp: Optional[str] = Header(None),
+):
+    """
+    Receives the invoice events of HubSpot's webhook subscriptions.
+
+    The events of a burst are collected for WEBHOOK_COALESCE_SECONDS and then synced with
+    `main.py --invoice-ids`, instead of waiting for the next run.
+    """
+    if not HUBSPOT_CLIENT_SECRET:
+        raise HTTPException(status_code=503, detail="Webhooks are not configured")
+    body = await request.body()
+    url = HUBSPOT_WEBHOOK_URL or str(request.url)
+    if not valid_signature(HUBSPOT_CLIENT_SECRET, request.method, url, body, x_hubspot_request_timestamp,
+                           x_hubspot_signature_v3):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+    try:
+        events = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Webhook body is not JSON")
+    if not isinstance(events, list):
+        raise HTTPException(status_code=400, detail="Webhook body must be a list of events")
+
+    if webhook_events.add(events):
+        background_tasks.add_task(sync_webhook_invoices)
+    return webhook_events.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(token: str = Depends(verify_api_key)):
+    """The metrics of the last sync run of every shard, plus the tasks of this service per status."""
+    texts = [path.read_text(encoding="utf-8") for path in sorted(METRICS_PATH.glob("hubspot-wefact*.prom"))]
+    counts = await run_in_threadpool(task_store.count_by_status)
+    texts.append(
+        "# HELP hubspot_wefact_tasks Tasks known to the service\n# TYPE hubspot_wefact_tasks gauge\n"
+        + "".join(f'hubspot_wefact_tasks{{status="{status}"}} {counts[status]}\n' for status in STATUSES)
+    )
+    texts.append(
+        "# HELP hubspot_wefact_queue_depth Syncs waiting for the running one\n"
+        f"# TYPE hubspot_wefact_queue_depth gauge\nhubspot_wefact_queue_depth {scheduler.queue_depth}\n"
+    )
+    webhook_stats = webhook_events.stats()
+    texts.append(
+        "# HELP hubspot_wefact_webhook_events_total Invoice events received by the webhook\n"
+        "# TYPE hubspot_wefact_webhook_events_total counter\n"
+        f'hubspot_wefact_webhook_events_total{{outcome="accepted"}} '
+        f'{webhook_stats["received"] - webhook_stats["duplicates"]}\n'
+        f'hubspot_wefact_webhook_events_total{{outcome="duplicate"}} {webhook_stats["duplicates"]}\n'
+    )
+    return merge_textfiles(texts)
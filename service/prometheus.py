@@ -0,0 +1,23 @@
+def merge_textfiles(texts):
+    """Merge Prometheus text expositions into one, e.g. the textfiles written by the shards of a run.
+
+    Every metric family keeps one HELP and TYPE line followed by the samples of all texts; the samples
+    of the shards differ in their shard label.
+    """
+    families = {}
+    current = None
+    for text in texts:
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                _, kind, name, *_ = line.split(" ", 3)
+                current = families.setdefault(name, {"HELP": None, "TYPE": None, "samples": []})
+                current[kind] = current[kind] or line
+            elif current is not None and not line.startswith("#"):
+                current["samples"].append(line)
+    lines = []
+    for family in families.values():
+        lines.extend(line for line in (family["HELP"], family["TYPE"]) if line is not None)
+        lines.extend(family["samples"])
+    return "\n".join(lines) + "\n" if lines else ""
@@ -0,0 +1,79 @@
+"""Replay HubSpot webhook events against a local service, signed like HubSpot signs them.
+
+    python replay.py --secret $HUBSPOT_CLIENT_SECRET events.json
+    python replay.py --secret $HUBSPOT_CLIENT_SECRET --invoice-ids 123,456 --value paid --repeat 3
+
+The events come from a JSON file (a list, as HubSpot posts them) or are generated for the given
+invoice ids. With --repeat every call is sent again, which shows the deduplication of the service.
+"""
+import argparse
+import json
+import sys
+import time
+import urllib.request
+import uuid
+
+from webhooks import INVOICE_OBJECT_TYPE, signature_v3
+
+DEFAULT_URL = "http://localhost:8000/webhooks/hubspot"
+
+
+def invoice_events(invoice_ids, property_name, property_value, occurred_at=None):
+    occurred_at = occurred_at or int(time.time() * 1000)
+    return [{
+        "eventId": uuid.uuid4().int >> 96,
+        "subscriptionId": 1,
+        "portalId": 1,
+        "appId": 1,
+        "occurredAt": occurred_at,
+        "subscriptionType": "object.propertyChange",
+        "attemptNumber": 0,
+        "objectId": int(invoice_id),
+        "objectTypeId": INVOICE_OBJECT_TYPE,
+        "propertyName": property_name,
+        "propertyValue": property_value,
+        "changeSource": "CRM_UI",
+    } for invoice_id in invoice_ids]
+
+
+def signed_request(url, secret, events, signed_url=None):
+    """A POST of the events with the X-HubSpot-Signature-v3 headers; `signed_url` is the URL HubSpot would call."""
+    body = json.dumps(events).encode("utf-8")
+    timestamp = str(int(time.time() * 1000))
+    return urllib.request.Request(url, data=body, method="POST", headers={
+        "Content-Type": "application/json",
+        "X-HubSpot-Request-Timestamp": timestamp,
+        "X-HubSpot-Signature-v3": signature_v3(secret, "POST", signed_url or url, body, timestamp),
+    })
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay signed HubSpot webhook events against the service")
+    parser.add_argument("events", nargs="?", help="JSON file with a list of events")
+    parser.add_argument("--url", default=DEFAULT_URL, help="where to post the events (default: %(default)s)")
+    parser.add_argument("--signed-url", default=None,
+                        help="the URL to sign, when the service checks against HUBSPOT_WEBHOOK_URL")
+    parser.add_argument("--secret", required=True, help="the client secret of the HubSpot app")
+    parser.add_argument("--invoice-ids", default=None, help="generate events for these invoice ids instead")
+    parser.add_argument("--property", default="hs_invoice_status", help="property of the generated events")
+    parser.add_argument("--value", default="paid", help="new value of the property in the generated events")
+    parser.add_argument("--repeat", type=int, default=1, help="send the same events this many times")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.invoice_ids:
+        events = invoice_events(args.invoice_ids.split(","), args.property, args.value)
+    elif args.events:
+        with open(args.events, encoding="utf-8") as events_file:
+            events = json.load(events_file)
+    else:
+        sys.exit("give a JSON file of events or --invoice-ids")
+    for _ in range(args.repeat):
+        with urllib.request.urlopen(signed_request(args.url, args.secret, events, args.signed_url)) as response:
+            print(response.status, response.read().decode("utf-8"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+from tasks import TaskStore
+
+
+class Scheduler:
+    """Runs the syncs of the service one at a time, as they all use the same data volume.
+
+    A request while a sync runs becomes a follow-up run. Later requests for the same run (image,
+    command and shards) coalesce into that follow-up and get its task id, so a burst of requests
+    costs one extra run. Webhook runs coalesce as well, with the invoice ids of all their requests.
+    Follow-ups start in the order they were first requested.
+    """
+
+    def __init__(self, store: TaskStore, execute):
+        self.store = store
+        # execute(task_id) runs the task and returns when it is finished
+        self.execute = execute
+        self._lock = threading.Lock()
+        self._active = None
+        self._queue = OrderedDict()
+
+    @staticmethod
+    def _key(image, command, shards, invoice_ids):
+        return (image, command, shards, invoice_ids is not None)
+
+    def submit(self, image: str, command: str | None, shards: int = 1, invoice_ids=None):
+        """Start a run, or queue it behind the active one; returns its task id and whether it already existed."""
+        key = self._key(image, command, shards, invoice_ids)
+        with self._lock:
+            queued = self._queue.get(key)
+            if queued is not None:
+                if invoice_ids is not None:
+                    pending = self.store.get(queued)["invoice_ids"]
+                    self.store.update(queued, invoice_ids=list(dict.fromkeys([*pending, *invoice_ids])))
+                return queued, True
+            task_id = str(uuid.uuid4())
+            details = {"invoice_ids": list(invoice_ids)} if invoice_ids is not None else {}
+            self.store.create(task_id, image=image, command=command, shards=shards, **details)
+            start = self._active is None
+            if start:
+                self._active = task_id
+            else:
+                self._queue[key] = task_id
+        if start:
+            self._start(task_id)
+        return task_id, False
+
+    def resume(self, tasks):
+        """Queue the tasks a previous process of the service left queued, oldest first."""
+        start = None
+        with self._lock:
+            for task in tasks:
+                if self._active is None:
+                    self._active = start = task["id"]
+                else:
+                    key = self._key(task["image"], task["command"], task["shards"], task.get("invoice_ids"))
+                    self._queue.setdefault(key, task["id"])
+        if start is not None:
+            self._start(start)
+
+    def _start(self, task_id):
+        threading.Thread(target=self._run, args=(task_id,), name=f"task-{task_id}", daemon=True).start()
+
+    def _run(self, task_id):
+        try:
+            self.execute(task_id)
+        finally:
+            with self._lock:
+                self._active = self._queue.popitem(last=False)[1] if self._queue else None
+                next_task_id = self._active
+            if next_task_id is not None:
+                self._start(next_task_id)
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def queued(self):
+        with self._lock:
+            return list(self._queue.values())
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
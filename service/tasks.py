@@ -0,0 +1,237 @@
+import asyncio
+import json
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+# the sync did not run, as another one (e.g. the sync daemon) held the lock of the state database
+STATUS_SKIPPED = "skipped"
+STATUSES = [STATUS_QUEUED, STATUS_RUNNING, STATUS_COMPLETED, STATUS_FAILED, STATUS_SKIPPED]
+FINISHED_STATUSES = (STATUS_COMPLETED, STATUS_FAILED, STATUS_SKIPPED)
+# EXIT_SYNC_LOCKED of the sync: it exits with this code when another process syncs with the same state database
+EXIT_SYNC_LOCKED = 75
+
+# the columns of a task; everything else a task carries is kept as JSON in `details`
+TASK_COLUMNS = ["status", "image", "command", "shards", "created_at", "started_at", "finished_at", "exit_code",
+                "error"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    image TEXT,
+    command TEXT,
+    shards INTEGER,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    exit_code INTEGER,
+    error TEXT,
+    details TEXT NOT NULL DEFAULT '{}'
+);
+CREATE INDEX IF NOT EXISTS tasks_created_at ON tasks (created_at);
+CREATE TABLE IF NOT EXISTS task_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task_id TEXT NOT NULL,
+    line TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS task_logs_task_id ON task_logs (task_id, id);
+"""
+
+
+def finished_status(exit_codes):
+    """The status of a task whose containers exited with these codes; a task that was only locked out is skipped."""
+    failed = [exit_code for exit_code in exit_codes if exit_code != 0]
+    if failed and all(exit_code == EXIT_SYNC_LOCKED for exit_code in failed):
+        return STATUS_SKIPPED
+    return STATUS_COMPLETED
+
+
+class TaskStore:
+    """The tasks of the service and their log lines, in a SQLite database that survives restarts.
+
+    Every call uses its own connection, so the worker threads of the containers and the request
+    handlers can use the store at the same time.
+    """
+
+    def __init__(self, path, busy_timeout: float = 30):
+        self.path = Path(path)
+        self.busy_timeout = busy_timeout
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout)
+        connection.row_factory = sqlite3.Row
+        return closing(connection)
+
+    def create(self, task_id: str, status: str = STATUS_QUEUED, **fields):
+        columns = {name: fields.pop(name) for name in TASK_COLUMNS if name in fields}
+        columns.update({"id": task_id, "status": status, "created_at": time.time(), "details": json.dumps(fields)})
+        with self._connect() as connection, connection:
+            connection.execute(f"INSERT INTO tasks ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                               list(columns.values()))
+
+    def update(self, task_id: str, **fields):
+        """Change the columns and details of a task; a running or finished task gets its timestamp."""
+        if fields.get("status") == STATUS_RUNNING:
+            fields.setdefault("started_at", time.time())
+        elif fields.get("status") in FINISHED_STATUSES:
+            fields.setdefault("finished_at", time.time())
+        columns = {name: fields.pop(name) for name in TASK_COLUMNS if name in fields}
+        with self._connect() as connection, connection:
+            if fields:
+                row = connection.execute("SELECT details FROM tasks WHERE id = ?", (task_id,)).fetchone()
+                if row is not None:
+                    columns["details"] = json.dumps({**json.loads(row["details"]), **fields})
+            if columns:
+                connection.execute(f"UPDATE tasks SET {', '.join(f'{name} = ?' for name in columns)} WHERE id = ?",
+                                   [*columns.values(), task_id])
+
+    @staticmethod
+    def _task(row):
+        task = {name: row[name] for name in row.keys() if name != "details"}
+        return {**task, **json.loads(row["details"])}
+
+    def get(self, task_id: str):
+        with self._connect() as connection:
+            row = connection.execute("SELECT * FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return self._task(row) if row is not None else None
+
+    def history(self, limit: int = 50, status: str | None = None):
+        """The most recent tasks first."""
+        query, parameters = "SELECT * FROM tasks", []
+        if status is not None:
+            query, parameters = query + " WHERE status = ?", [status]
+        with self._connect() as connection:
+            rows = connection.execute(f"{query} ORDER BY created_at DESC, rowid DESC LIMIT ?",
+                                      [*parameters, limit]).fetchall()
+        return [self._task(row) for row in rows]
+
+    def count_by_status(self):
+        with self._connect() as connection:
+            counts = dict(connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in STATUSES}
+
+    def append_logs(self, task_id: str, lines):
+        with self._connect() as connection, connection:
+            connection.executemany("INSERT INTO task_logs (task_id, line) VALUES (?, ?)",
+                                   [(task_id, line) for line in lines])
+
+    def logs(self, task_id: str, after: int = 0, limit: int = 500):
+        """Up to `limit` (id, line) pairs of the task after log line `after`, oldest first."""
+        with self._connect() as connection:
+            return connection.execute(
+                "SELECT id, line FROM task_logs WHERE task_id = ? AND id > ? ORDER BY id LIMIT ?",
+                (task_id, after, limit)).fetchall()
+
+    def tail(self, task_id: str, lines: int = 100):
+        with self._connect() as connection:
+            rows = connection.execute("SELECT line FROM task_logs WHERE task_id = ? ORDER BY id DESC LIMIT ?",
+                                      (task_id, lines)).fetchall()
+        return [row["line"] for row in reversed(rows)]
+
+    def interrupt_unfinished(self, reason: str):
+        """Fail the tasks a previous process of the service left running; returns how many.
+
+        Queued tasks stay queued, for the scheduler to pick up again.
+        """
+        with self._connect() as connection, connection:
+            return connection.execute("UPDATE tasks SET status = ?, error = ?, finished_at = ? WHERE status = ?",
+                                      (STATUS_FAILED, reason, time.time(), STATUS_RUNNING)).rowcount
+
+    def prune(self, max_age: float, keep: int):
+        """Forget finished tasks older than `max_age` seconds or beyond the `keep` most recent, with their logs."""
+        placeholders = ", ".join("?" * len(FINISHED_STATUSES))
+        with self._connect() as connection, connection:
+            pruned = [row["id"] for row in connection.execute(
+                f"SELECT id FROM tasks WHERE status IN ({placeholders}) AND (created_at < ? OR id NOT IN "
+                f"(SELECT id FROM tasks ORDER BY created_at DESC, rowid DESC LIMIT ?))",
+                (*FINISHED_STATUSES, time.time() - max_age, keep))]
+            connection.executemany("DELETE FROM task_logs WHERE task_id = ?", [(task_id,) for task_id in pruned])
+            connection.executemany("DELETE FROM tasks WHERE id = ?", [(task_id,) for task_id in pruned])
+        return len(pruned)
+
+
+class LogWriter:
+    """Collects the output of a container into lines and stores them in batches."""
+
+    def __init__(self, store: TaskStore, task_id: str, prefix: str = "", batch_lines: int = 50,
+                 batch_seconds: float = 0.5):
+        self.store = store
+        self.task_id = task_id
+        self.prefix = prefix
+        self.batch_lines = batch_lines
+        self.batch_seconds = batch_seconds
+        self._partial = ""
+        self._lines = []
+        self._flushed = time.monotonic()
+
+    def write(self, chunk: bytes):
+        text = self._partial + chunk.decode("utf-8", errors="replace")
+        *lines, self._partial = text.split("\n")
+        self._lines.extend(f"{self.prefix}{line.rstrip(chr(13))}" for line in lines)
+        if len(self._lines) >= self.batch_lines or time.monotonic() - self._flushed >= self.batch_seconds:
+            self.flush()
+
+    def flush(self):
+        if self._lines:
+            self.store.append_logs(self.task_id, self._lines)
+            self._lines = []
+        self._flushed = time.monotonic()
+
+    def close(self):
+        if self._partial:
+            self._lines.append(f"{self.prefix}{self._partial}")
+            self._partial = ""
+        self.flush()
+
+
+def sse_event(data: str, event_id=None, event=None):
+    """One Server-Sent Event; every line of `data` gets its own data field."""
+    fields = []
+    if event_id is not None:
+        fields.append(f"id: {event_id}")
+    if event is not None:
+        fields.append(f"event: {event}")
+    fields.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(fields) + "\n\n"
+
+
+async def stream_task_logs(store: TaskStore, task_id: str, after: int = 0, poll_interval: float = 1.0,
+                           keepalive: float = 15.0):
+    """Yield the log lines of a task as Server-Sent Events until it is finished, then an `end` event.
+
+    Only a batch of lines is held at a time, however long the log. `after` is the id of the last line
+    the client has, from its Last-Event-ID.
+    """
+    idle = 0.0
+    while True:
+        rows = await asyncio.to_thread(store.logs, task_id, after)
+        for row in rows:
+            after = row["id"]
+            yield sse_event(row["line"], event_id=after)
+        if rows:
+            idle = 0.0
+            continue
+        task = await asyncio.to_thread(store.get, task_id)
+        if task is None or task["status"] in FINISHED_STATUSES:
+            # lines stored between the last read and finishing come first
+            rows = await asyncio.to_thread(store.logs, task_id, after)
+            if rows:
+                continue
+            yield sse_event(json.dumps({"status": task["status"] if task else None,
+                                        "exit_code": task["exit_code"] if task else None}), event="end")
+            return
+        if idle >= keepalive:
+            yield ": keepalive\n\n"
+            idle = 0.0
+        await asyncio.sleep(poll_interval)
+        idle += poll_interval
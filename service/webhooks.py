@@ -0,0 +1,85 @@
+import base64
+import hashlib
+import hmac
+import time
+from collections import OrderedDict
+
+# HubSpot's object type of invoices, in the objectTypeId of generic webhook events
+INVOICE_OBJECT_TYPE = "0-53"
+# requests signed longer ago than this are replays
+MAX_SIGNATURE_AGE = 300
+# event ids remembered to drop the retries of HubSpot
+SEEN_EVENTS_LIMIT = 10000
+
+
+def signature_v3(client_secret: str, method: str, url: str, body: bytes, timestamp: str):
+    """The X-HubSpot-Signature-v3 of a request: base64 of the HMAC-SHA256 of method, url, body and timestamp."""
+    message = method.encode("utf-8") + url.encode("utf-8") + body + timestamp.encode("utf-8")
+    digest = hmac.new(client_secret.encode("utf-8"), message, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def valid_signature(client_secret: str, method: str, url: str, body: bytes, timestamp: str, signature: str,
+                    now=None):
+    """Check a v3 signature and that the timestamp (in milliseconds) is recent."""
+    try:
+        age = (now if now is not None else time.time()) - int(timestamp) / 1000
+    except (TypeError, ValueError):
+        return False
+    if age > MAX_SIGNATURE_AGE:
+        return False
+    return hmac.compare_digest(signature_v3(client_secret, method, url, body, timestamp), signature or "")
+
+
+def is_invoice_event(event: dict):
+    return event.get("objectTypeId") == INVOICE_OBJECT_TYPE or \
+        str(event.get("subscriptionType", "")).startswith("invoice.")
+
+
+class EventBatcher:
+    """Collects the invoice ids of webhook events until a sync takes them.
+
+    Retried events (same eventId) are dropped and a burst of events for the same invoice comes out as
+    one id, so a sync started after the burst handles all of it at once.
+    """
+
+    def __init__(self, seen_limit: int = SEEN_EVENTS_LIMIT):
+        self.seen_limit = seen_limit
+        self._seen = OrderedDict()
+        self._pending = {}
+        self.flush_scheduled = False
+        self.received = 0
+        self.duplicates = 0
+
+    def add(self, events):
+        """Add the invoice events of a webhook call; returns True when a flush has to be scheduled."""
+        for event in filter(lambda event: isinstance(event, dict), events):
+            object_id = str(event.get("objectId", ""))
+            # the ids end up on the command line of the sync container
+            if not is_invoice_event(event) or not object_id.isdigit():
+                continue
+            self.received += 1
+            event_id = event.get("eventId")
+            if event_id is not None:
+                if event_id in self._seen:
+                    self.duplicates += 1
+                    continue
+                self._seen[event_id] = True
+                if len(self._seen) > self.seen_limit:
+                    self._seen.popitem(last=False)
+            # keeps the order in which the invoices changed first
+            self._pending.setdefault(object_id, True)
+        if self._pending and not self.flush_scheduled:
+            self.flush_scheduled = True
+            return True
+        return False
+
+    def take(self):
+        """The pending invoice ids; events after this schedule a new flush."""
+        invoice_ids = list(self._pending)
+        self._pending.clear()
+        self.flush_scheduled = False
+        return invoice_ids
+
+    def stats(self):
+        return {"received": self.received, "duplicates": self.duplicates, "pending": len(self._pending)}
@@ -0,0 +1,43 @@
+import hashlib
+import os
+import shutil
+import threading
+from pathlib import Path
+
+# the local copies of the invoice PDFs, stored under their SHA-256 next to the state database, so on the
+# data volume of a container; an empty value keeps no copies
+PDF_ARCHIVE_PATH = os.getenv("PDF_ARCHIVE_PATH", str(Path(os.getenv("APPDATA", "data")) / "WeFactInvoices"))
+CHUNK_SIZE = 64 * 1024
+
+
+def pdf_digest(stream):
+    """The SHA-256 of a binary stream, read in chunks from the start."""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    while chunk := stream.read(CHUNK_SIZE):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def archive_path(pdf_hash: str):
+    return Path(PDF_ARCHIVE_PATH) / pdf_hash[:2] / f"{pdf_hash}.pdf" if PDF_ARCHIVE_PATH else None
+
+
+def archive_pdf(stream, pdf_hash: str):
+    """Keep a copy of the PDF under its hash; a PDF that is archived already is not written again.
+
+    Returns the path of the copy, or None without an archive.
+    """
+    path = archive_path(pdf_hash)
+    if path is None or path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # the rename keeps partial files out of the archive, also with two threads archiving the same PDF
+    temporary = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    stream.seek(0)
+    with open(temporary, "wb") as file:
+        shutil.copyfileobj(stream, file, CHUNK_SIZE)
+    stream.seek(0)
+    os.replace(temporary, path)
+    return path
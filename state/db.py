@@ -1,9 +1,20 @@
+import json
 import os
 import sqlite3
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
+from metrics import SQLITE_OPERATION_SECONDS, timed
 from models.invoice import Invoice
 
+try:
+    import fcntl
+except ImportError:
+    # Windows, which has no shared locks: the shards of a sharded sync cannot run side by side there
+    fcntl = None
+    import msvcrt
 
 INVOICE_STATUS_OPEN = "open"
 INVOICE_STATUS_PAID = "paid"
@@ -15,31 +26,195 @@ ACTION_PROCESSED = "processed"
 ACTION_SKIP = "skip"
 ACTION_ERROR = "error"
 
+SYNC_STATE_WATERMARK = "invoices_last_modified"
+SYNC_STATE_CHECKPOINT = "paging_checkpoint"
 
-def init_db():
-    data_path = os.getenv("APPDATA", "data")
+# with a write-ahead log, NORMAL only syncs at checkpoints and still survives a crash of the process
+DB_SYNCHRONOUS = os.getenv("STATE_DB_SYNCHRONOUS", "NORMAL")
+INTENT_LOG_SUFFIX = "-intents"
+# seconds a connection waits for the write lock of another process (e.g. another shard) before giving up
+DB_BUSY_TIMEOUT = float(os.getenv("STATE_DB_BUSY_TIMEOUT", "60"))
+SYNC_LOCK_SUFFIX = ".lock"
+# seconds before a failed invoice is tried again, doubling with every failure up to the maximum
+RETRY_BACKOFF = float(os.getenv("STATE_RETRY_BACKOFF", "300"))
+RETRY_BACKOFF_MAX = float(os.getenv("STATE_RETRY_BACKOFF_MAX", "86400"))
 
-    db_path = Path(data_path) / "hubspot-wefact.db"
-    connection = sqlite3.connect(db_path)
-    connection.execute(
-        "CREATE TABLE IF NOT EXISTS invoice_ids(invoice_id text, status text, PRIMARY KEY(invoice_id, status))"
-    )
+
+# every entry upgrades the schema by one version; the version is kept in PRAGMA user_version
+MIGRATIONS = [
+    # 1: the original status table and the tables of the incremental sync, caches and WeFact indexes
+    [
+        "CREATE TABLE IF NOT EXISTS invoice_ids(invoice_id text, status text, PRIMARY KEY(invoice_id, status))",
+        "CREATE TABLE IF NOT EXISTS sync_state(key text PRIMARY KEY, value text)",
+        "CREATE TABLE IF NOT EXISTS wefact_index(controller text, code text, identifier integer, fingerprint text, "
+        "PRIMARY KEY(controller, code))",
+        "CREATE TABLE IF NOT EXISTS object_cache(cache text, object_id text, data text, stored_at real, "
+        "PRIMARY KEY(cache, object_id))",
+    ],
+    # 2: the invoice ledger, which holds the status of every invoice from now on, seeded with the statuses so far
+    [
+        "CREATE TABLE invoice_ledger(invoice_id text PRIMARY KEY, status text, wefact_identifier integer, "
+        "payload_hash text, pdf_hash text, hubspot_file_id text, hubspot_note_id text, "
+        "opened_at text, paid_at text, synced_at text)",
+        "INSERT INTO invoice_ledger(invoice_id, status) "
+        "SELECT invoice_id, CASE WHEN SUM(status = 'paid') > 0 THEN 'paid' ELSE 'open' END "
+        "FROM invoice_ids GROUP BY invoice_id",
+    ],
+    # 3: the invoices whose sync failed, to try again after a backoff as the watermark has passed them
+    [
+        "CREATE TABLE invoice_retry(invoice_id text PRIMARY KEY, invoice_number text, attempts integer, "
+        "failed_at text, retry_at text)",
+    ],
+]
+
+LedgerEntry = namedtuple(
+    "ledger_entry",
+    ["wefact_identifier", "payload_hash", "pdf_hash", "hubspot_file_id", "hubspot_note_id"],
+    defaults=[None, None, None, None, None],
+)
+
+
+def schema_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(connection):
+    """Bring the schema up to the latest version, one migration per transaction."""
+    while schema_version(connection) < len(MIGRATIONS):
+        # an explicit transaction, so the DDL and the version bump are applied together or not at all; it takes
+        # the write lock up front, and the version is read again under it, as another shard may have migrated
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            version = schema_version(connection)
+            if version >= len(MIGRATIONS):
+                connection.rollback()
+                return
+            for statement in MIGRATIONS[version]:
+                connection.execute(statement)
+            connection.execute(f"PRAGMA user_version={version + 1}")
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+
+class StateConnection(sqlite3.Connection):
+    """Connection to the state database; `scope` separates the sync state and intent log of shards."""
+
+    scope: str | None = None
+
+
+def _scope(connection):
+    return getattr(connection, "scope", None)
+
+
+def _db_path():
+    return Path(os.getenv("APPDATA", "data")) / "hubspot-wefact.db"
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="init_db")
+def init_db(scope: str | None = None):
+    """Open the state database, shared by all shards; a shard passes its `scope`."""
+    db_path = _db_path()
+    connection = sqlite3.connect(db_path, timeout=DB_BUSY_TIMEOUT, factory=StateConnection)
+    connection.scope = scope
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    migrate(connection)
+    replay_intent_log(connection)
     return connection
 
 
+class SyncLockedError(RuntimeError):
+    """Another process is syncing with the same state database."""
+
+
+def _lock_file(path: Path, shared: bool):
+    handle = open(path, "a+")
+    try:
+        if fcntl is not None:
+            fcntl.flock(handle, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+        else:
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        handle.close()
+        raise SyncLockedError(f"another sync holds {path}")
+    return handle
+
+
+def _unlock_file(handle):
+    if fcntl is not None:
+        fcntl.flock(handle, fcntl.LOCK_UN)
+    else:
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+    handle.close()
+
+
+@contextmanager
+def sync_lock(scope: str | None = None):
+    """Hold the lock of the state database for a sync; raises SyncLockedError when another process has it.
+
+    A sync of all invoices takes the lock exclusively. The shards of a sharded sync share it and each
+    take the lock of their `scope`, so they run side by side but never next to a sync of all invoices or
+    a second run of the same shard. The operating system releases the locks of a process that dies.
+    """
+    db_path = _db_path()
+    handles = [_lock_file(Path(f"{db_path}{SYNC_LOCK_SUFFIX}"), shared=scope is not None)]
+    try:
+        if scope is not None:
+            handles.append(_lock_file(Path(f"{db_path}{SYNC_LOCK_SUFFIX}-{scope}"), shared=False))
+        yield
+    finally:
+        for handle in reversed(handles):
+            _unlock_file(handle)
+
+
+def _intent_log_path(connection):
+    # in-memory databases have no file and therefore no intent log
+    db_file = connection.execute("PRAGMA database_list").fetchone()[2]
+    if not db_file:
+        return None
+    scope = _scope(connection)
+    return Path(db_file + INTENT_LOG_SUFFIX + (f"-{scope}" if scope else ""))
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="replay_intent_log")
+def replay_intent_log(connection):
+    """Save the statuses of a page that was not committed because the previous run died."""
+    intent_log = _intent_log_path(connection)
+    if intent_log is None or not intent_log.exists():
+        return
+    with open(intent_log, encoding="utf-8") as file:
+        # a line that was only partly written before the crash has no tab and is ignored
+        rows = [line.rstrip("\n").split("\t") for line in file if line.endswith("\n") and "\t" in line]
+    # in the order they were reached, so an invoice that was opened and paid ends up paid
+    for invoice_number, status in rows:
+        _record_ledger(connection, invoice_number, status, LedgerEntry())
+    connection.commit()
+    intent_log.unlink()
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="commit_page")
+def commit_page(connection):
+    """Commit the statuses saved with `commit=False` and clear the intent log that protected them."""
+    connection.commit()
+    intent_log = _intent_log_path(connection)
+    if intent_log is not None:
+        intent_log.unlink(missing_ok=True)
+
+
 def is_invoice_id_in_db(connection, invoice: Invoice):
     cursor = connection.cursor()
     cursor.execute(
-        "SELECT invoice_id, status FROM invoice_ids WHERE invoice_id=? AND status=?",
+        "SELECT invoice_id FROM invoice_ledger WHERE invoice_id=? AND status=?",
         (invoice.number, invoice.status),
     )
     return cursor.fetchone() is not None
 
 
-def determine_db_status(connection, invoice):
-    cursor = connection.cursor()
-    cursor.execute("SELECT invoice_id, status FROM invoice_ids WHERE invoice_id=?", (invoice.number,))
-    statuses = [row[1] for row in cursor.fetchall()]
+def _resolve_status(statuses):
     status = INVOICE_STATUS_UNKNOWN
     # status PAID goes before OPEN before UNKNOWN
     if INVOICE_STATUS_OPEN in statuses:
@@ -49,9 +224,247 @@ def determine_db_status(connection, invoice):
     return status
 
 
-def save_invoice_id_in_db(connection, invoice: Invoice):
+@timed(SQLITE_OPERATION_SECONDS, operation="determine_db_status")
+def determine_db_status(connection, invoice):
+    """Return the status the ledger has for the invoice; the ledger is the only source of statuses."""
+    cursor = connection.cursor()
+    cursor.execute("SELECT invoice_id, status FROM invoice_ledger WHERE invoice_id=?", (invoice.number,))
+    statuses = [row[1] for row in cursor.fetchall()]
+    return _resolve_status(statuses)
+
+
+# stay well below SQLite's limit on the number of parameters of one statement
+STATUS_LOOKUP_CHUNK_SIZE = 500
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="determine_db_statuses")
+def determine_db_statuses(connection, invoice_numbers):
+    """Return the resolved status of every invoice number, with one query per 500 numbers.
+
+    Numbers that are not in the database map to INVOICE_STATUS_UNKNOWN.
+    """
+    invoice_numbers = list(dict.fromkeys(invoice_numbers))
+    statuses = {invoice_number: [] for invoice_number in invoice_numbers}
+    cursor = connection.cursor()
+    for start in range(0, len(invoice_numbers), STATUS_LOOKUP_CHUNK_SIZE):
+        chunk = invoice_numbers[start:start + STATUS_LOOKUP_CHUNK_SIZE]
+        cursor.execute(
+            f"SELECT invoice_id, status FROM invoice_ledger WHERE invoice_id IN ({','.join('?' * len(chunk))})",
+            chunk,
+        )
+        for invoice_id, status in cursor.fetchall():
+            statuses[invoice_id].append(status)
+    return {invoice_number: _resolve_status(found) for invoice_number, found in statuses.items()}
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="save_invoice_id_in_db")
+def save_invoice_id_in_db(connection, invoice: Invoice, commit=True):
+    """Record that the invoice reached its status, without anything else about its sync."""
+    record_invoice_ledger(connection, invoice, LedgerEntry(), commit)
+
+
+def _scoped_key(connection, key):
+    scope = _scope(connection)
+    return f"{key}@{scope}" if scope else key
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="get_sync_state")
+def get_sync_state(connection, key):
+    cursor = connection.cursor()
+    cursor.execute("SELECT value FROM sync_state WHERE key=?", (_scoped_key(connection, key),))
+    row = cursor.fetchone()
+    return row[0] if row is not None else None
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="save_sync_state")
+def save_sync_state(connection, key, value):
     connection.execute(
-        "INSERT INTO invoice_ids(invoice_id, status) VALUES(?,?)",
-        (invoice.number, invoice.status),
+        "INSERT INTO sync_state(key, value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (_scoped_key(connection, key), value),
+    )
+    connection.commit()
+
+
+def get_watermark(connection) -> datetime | None:
+    """Return the newest HubSpot modification date handled by a previous complete run, if any."""
+    value = get_sync_state(connection, SYNC_STATE_WATERMARK)
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+def save_watermark(connection, watermark: datetime):
+    save_sync_state(connection, SYNC_STATE_WATERMARK, watermark.isoformat())
+
+
+def get_checkpoint(connection) -> dict | None:
+    """Return the paging position of a run that did not finish, if any."""
+    value = get_sync_state(connection, SYNC_STATE_CHECKPOINT)
+    return json.loads(value) if value is not None else None
+
+
+def save_checkpoint(connection, checkpoint: dict):
+    save_sync_state(connection, SYNC_STATE_CHECKPOINT, json.dumps(checkpoint))
+
+
+def clear_checkpoint(connection):
+    connection.execute("DELETE FROM sync_state WHERE key=?", (_scoped_key(connection, SYNC_STATE_CHECKPOINT),))
+    connection.commit()
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="load_cached_objects")
+def load_cached_objects(connection, cache):
+    """Return the (object_id, data, stored_at) rows persisted for the named cache."""
+    cursor = connection.cursor()
+    cursor.execute("SELECT object_id, data, stored_at FROM object_cache WHERE cache=?", (cache,))
+    return cursor.fetchall()
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="save_cached_objects")
+def save_cached_objects(connection, cache, rows):
+    """Replace the persisted entries of the named cache with (object_id, data, stored_at) rows."""
+    connection.execute("DELETE FROM object_cache WHERE cache=?", (cache,))
+    connection.executemany(
+        "INSERT INTO object_cache(cache, object_id, data, stored_at) VALUES(?,?,?,?)",
+        [(cache, object_id, data, stored_at) for object_id, data, stored_at in rows],
+    )
+    connection.commit()
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="load_wefact_index")
+def load_wefact_index(connection, controller):
+    """Return the (code, identifier, fingerprint) rows known for a WeFact controller."""
+    cursor = connection.cursor()
+    cursor.execute("SELECT code, identifier, fingerprint FROM wefact_index WHERE controller=?", (controller,))
+    return cursor.fetchall()
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="save_wefact_index")
+def save_wefact_index(connection, controller, rows):
+    """Store (code, identifier, fingerprint) rows; a row without identifier removes the code."""
+    connection.executemany(
+        "DELETE FROM wefact_index WHERE controller=? AND code=?",
+        [(controller, code) for code, identifier, _ in rows if identifier is None],
+    )
+    connection.executemany(
+        "INSERT INTO wefact_index(controller, code, identifier, fingerprint) VALUES(?,?,?,?) "
+        "ON CONFLICT(controller, code) DO UPDATE SET identifier=excluded.identifier, fingerprint=excluded.fingerprint",
+        [(controller, code, identifier, fingerprint) for code, identifier, fingerprint in rows if identifier is not None],
     )
     connection.commit()
+
+
+def clear_wefact_index(connection, controller):
+    connection.execute("DELETE FROM wefact_index WHERE controller=?", (controller,))
+    connection.commit()
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="record_invoice_ledger")
+def record_invoice_ledger(connection, invoice: Invoice, entry: LedgerEntry, commit=True):
+    """Record that the invoice reached its status and what was pushed for it.
+
+    Values that are None keep what was known before. With `commit=False` the row is part of the page
+    transaction that `commit_page` commits; until then the status is kept in an append-only intent log
+    so it survives the process dying.
+    """
+    if not commit:
+        intent_log = _intent_log_path(connection)
+        if intent_log is not None:
+            with open(intent_log, "a", encoding="utf-8") as file:
+                file.write(f"{invoice.number}\t{invoice.status}\n")
+    _record_ledger(connection, invoice.number, invoice.status, entry)
+    if commit:
+        connection.commit()
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="record_wefact_push")
+def record_wefact_push(connection, invoice: Invoice, entry: LedgerEntry, commit=True):
+    """Remember what was pushed to WeFact for an invoice whose sync failed afterwards, keeping its status.
+
+    A later sync with the same payload hash then skips looking up and adding the invoice.
+    """
+    connection.execute(
+        "INSERT INTO invoice_ledger(invoice_id, wefact_identifier, payload_hash) VALUES(?,?,?) "
+        "ON CONFLICT(invoice_id) DO UPDATE SET wefact_identifier=excluded.wefact_identifier, "
+        "payload_hash=excluded.payload_hash",
+        (invoice.number, entry.wefact_identifier, entry.payload_hash),
+    )
+    if commit:
+        connection.commit()
+
+
+def _record_ledger(connection, invoice_number, status, entry: LedgerEntry):
+    now = datetime.now(timezone.utc).isoformat()
+    # an invoice that was paid stays paid, like it did when every status reached had its own row
+    connection.execute(
+        "INSERT INTO invoice_ledger(invoice_id, status, wefact_identifier, payload_hash, pdf_hash, hubspot_file_id, "
+        "hubspot_note_id, opened_at, paid_at, synced_at) VALUES(?,?,?,?,?,?,?,?,?,?) "
+        "ON CONFLICT(invoice_id) DO UPDATE SET status=CASE WHEN status = 'paid' THEN status ELSE excluded.status END, "
+        "wefact_identifier=COALESCE(excluded.wefact_identifier, wefact_identifier), "
+        "payload_hash=COALESCE(excluded.payload_hash, payload_hash), "
+        "pdf_hash=COALESCE(excluded.pdf_hash, pdf_hash), "
+        "hubspot_file_id=COALESCE(excluded.hubspot_file_id, hubspot_file_id), "
+        "hubspot_note_id=COALESCE(excluded.hubspot_note_id, hubspot_note_id), "
+        "opened_at=COALESCE(opened_at, excluded.opened_at), "
+        "paid_at=COALESCE(excluded.paid_at, paid_at), "
+        "synced_at=excluded.synced_at",
+        (invoice_number, status, *entry,
+         now if status == INVOICE_STATUS_OPEN else None,
+         now if status == INVOICE_STATUS_PAID else None,
+         now),
+    )
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="get_invoice_ledger")
+def get_invoice_ledger(connection, invoice_number):
+    """Return the ledger row of an invoice as a dict, or None when it was never synced."""
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM invoice_ledger WHERE invoice_id=?", (invoice_number,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in cursor.description], row))
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="get_paid_invoice_numbers")
+def get_paid_invoice_numbers(connection, limit):
+    """Return the numbers of up to `limit` invoices the ledger marks as paid, most recently synced first."""
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT invoice_id FROM invoice_ledger WHERE status=? ORDER BY synced_at DESC, invoice_id LIMIT ?",
+        (INVOICE_STATUS_PAID, limit),
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="mark_invoice_for_retry")
+def mark_invoice_for_retry(connection, invoice: Invoice, commit=True):
+    """Remember that the sync of the invoice failed, so a later run tries it again after a backoff."""
+    cursor = connection.execute("SELECT attempts FROM invoice_retry WHERE invoice_id=?", (invoice.id,))
+    row = cursor.fetchone()
+    attempts = (row[0] if row is not None else 0) + 1
+    now = datetime.now(timezone.utc)
+    backoff = min(RETRY_BACKOFF * 2 ** (attempts - 1), RETRY_BACKOFF_MAX)
+    connection.execute(
+        "INSERT INTO invoice_retry(invoice_id, invoice_number, attempts, failed_at, retry_at) VALUES(?,?,?,?,?) "
+        "ON CONFLICT(invoice_id) DO UPDATE SET invoice_number=excluded.invoice_number, attempts=excluded.attempts, "
+        "failed_at=excluded.failed_at, retry_at=excluded.retry_at",
+        (invoice.id, invoice.number, attempts, now.isoformat(), (now + timedelta(seconds=backoff)).isoformat()),
+    )
+    if commit:
+        connection.commit()
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="clear_invoice_retry")
+def clear_invoice_retry(connection, invoice_id, commit=True):
+    connection.execute("DELETE FROM invoice_retry WHERE invoice_id=?", (invoice_id,))
+    if commit:
+        connection.commit()
+
+
+@timed(SQLITE_OPERATION_SECONDS, operation="get_invoices_to_retry")
+def get_invoices_to_retry(connection, now: datetime | None = None):
+    """Return the (HubSpot id, number) of the failed invoices whose backoff has passed, oldest failure first."""
+    now = now or datetime.now(timezone.utc)
+    cursor = connection.cursor()
+    cursor.execute("SELECT invoice_id, invoice_number FROM invoice_retry WHERE retry_at<=? ORDER BY failed_at",
+                   (now.isoformat(),))
+    return cursor.fetchall()
@@ -0,0 +1,45 @@
+import email
+import hashlib
+import io
+
+from hubspot_api.multipart import MultipartStream
+from state import archive
+from state.archive import archive_pdf, pdf_digest
+
+PDF = b"%PDF-1.4\n" + b"x" * 200_000 + b"\n%%EOF\n"
+
+
+def test_a_pdf_is_archived_once_under_its_hash(monkeypatch, tmp_path):
+    monkeypatch.setattr(archive, "PDF_ARCHIVE_PATH", str(tmp_path))
+    stream = io.BytesIO(PDF)
+    pdf_hash = pdf_digest(stream)
+
+    path = archive_pdf(stream, pdf_hash)
+    assert pdf_hash == hashlib.sha256(PDF).hexdigest()
+    assert path == tmp_path / pdf_hash[:2] / f"{pdf_hash}.pdf"
+    assert path.read_bytes() == PDF
+    modified = path.stat().st_mtime_ns
+
+    assert archive_pdf(io.BytesIO(PDF), pdf_hash) == path
+    assert path.stat().st_mtime_ns == modified
+    assert [file.name for file in path.parent.iterdir()] == [path.name]
+
+
+def test_no_archive_without_a_path(monkeypatch):
+    monkeypatch.setattr(archive, "PDF_ARCHIVE_PATH", "")
+    assert archive_pdf(io.BytesIO(PDF), hashlib.sha256(PDF).hexdigest()) is None
+
+
+def test_the_multipart_body_streams_the_file_and_can_be_sent_again():
+    body = MultipartStream({"fileName": "F1.pdf", "folderPath": "/invoices"}, "file", "F1.pdf", io.BytesIO(PDF),
+                           "application/pdf")
+
+    sent = b"".join(body)
+    assert len(sent) == len(body)
+    assert b"".join(body) == sent
+    message = email.message_from_bytes(f"Content-Type: {body.content_type}\r\n\r\n".encode("ascii") + sent)
+    parts = {part.get_param("name", header="content-disposition"): part for part in message.get_payload()}
+    assert parts["fileName"].get_payload() == "F1.pdf"
+    assert parts["folderPath"].get_payload() == "/invoices"
+    assert parts["file"].get_filename() == "F1.pdf"
+    assert parts["file"].get_payload(decode=True) == PDF
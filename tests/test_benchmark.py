@@ -0,0 +1,225 @@
+import pytest
+
+import hubspot_api.api as hubspot_api
+import main
+import state.archive as archive
+import state.db as state_db
+import wefact_api.api as wefact_api
+import wefact_api.invoice as wefact_invoice
+from benchmark.dataset import INVOICE_ID_BASE, Dataset
+from benchmark.servers import Faults, FakeHubSpot, FakeWeFact
+from hubspot_api.api import COMPANY_CACHE, CONTACT_CACHE, get_api_client, get_invoices, search_invoices
+from wefact_api.api import ProductClient
+from wefact_api.invoice import ResultType
+
+
+@pytest.fixture
+def servers(monkeypatch, tmp_path):
+    dataset = Dataset(25, seed=1)
+    hubspot = FakeHubSpot(dataset).start()
+    wefact = FakeWeFact().start()
+    monkeypatch.setattr(hubspot_api, "HUBSPOT_API_URL", hubspot.url)
+    monkeypatch.setattr(archive, "PDF_ARCHIVE_PATH", str(tmp_path / "archive"))
+    monkeypatch.setattr(wefact_api, "WEFACT_API_URL", wefact.url)
+    monkeypatch.setattr(main, "METRICS_TEXTFILE", str(tmp_path / "hubspot-wefact.prom"))
+    monkeypatch.setenv("APPDATA", str(tmp_path))
+    COMPANY_CACHE.clear()
+    CONTACT_CACHE.clear()
+    yield dataset, hubspot, wefact
+    hubspot.stop()
+    wefact.stop()
+
+
+def test_the_same_seed_generates_the_same_dataset():
+    assert Dataset(100, seed=3).invoice(42) == Dataset(100, seed=3).invoice(42)
+    assert Dataset(100, seed=3).line_item("40000010") != Dataset(100, seed=4).line_item("40000010")
+
+
+def test_fake_hubspot_pages_and_searches_invoices(servers):
+    dataset, _, _ = servers
+    api_client = get_api_client()
+
+    invoices, after = get_invoices(api_client, None)
+    assert [invoice.number for invoice in invoices] == [f"BENCH-{index:06d}" for index in range(10)]
+    invoices, after = get_invoices(api_client, after)
+    assert invoices[0].number == "BENCH-000010"
+
+    invoices, after = search_invoices(api_client, None, dataset.modified_at(20))
+    assert [invoice.number for invoice in invoices] == [f"BENCH-{index:06d}" for index in range(20, 25)]
+    assert after is None
+
+
+def test_injected_errors_and_rate_limits_are_counted(servers):
+    faulty = FakeWeFact(Faults(error_rate=1.0, rate_limit=(1, 60))).start()
+    try:
+        session = wefact_api.build_session()
+        statuses = [session.post(faulty.url, data="{}").status_code for _ in range(2)]
+    finally:
+        faulty.stop()
+
+    assert statuses == [503, 429]
+    assert faulty.throttled == 1
+    assert faulty.errors >= 1
+
+
+def syncable(dataset):
+    return [index for index in range(dataset.size) if dataset.invoice(index)["hs_invoice_status"] in ("open", "paid")]
+
+
+def test_full_run_against_the_fakes_pushes_every_open_and_paid_invoice(servers):
+    dataset, hubspot, wefact = servers
+
+    main.main(["--full"])
+
+    assert 0 < len(syncable(dataset)) < dataset.size
+    assert len(wefact.objects["invoice"]) == len(syncable(dataset))
+    assert len(list(ProductClient().list_all())) == len(wefact.objects["product"])
+    assert hubspot.calls["POST /files/v3/files"] == len(syncable(dataset))
+
+
+def test_server_filter_only_transfers_invoices_that_need_work(servers, monkeypatch):
+    dataset, hubspot, wefact = servers
+    # pages of 10, so the number of pages shows how many invoices were transferred
+    monkeypatch.setattr(hubspot_api, "SEARCH_PAGE_SIZE", 10)
+    retrieved = []
+    build_invoice = hubspot_api._build_invoice
+    monkeypatch.setattr(hubspot_api, "_build_invoice", lambda invoice: retrieved.append(invoice.id) or
+                        build_invoice(invoice))
+
+    main.main(["--full", "--server-filter"])
+    assert len(set(retrieved)) == len(syncable(dataset))
+    # every page after the first comes from a new search, which returns the newest invoice of the page before again
+    assert len(retrieved) - len(set(retrieved)) == hubspot.calls["POST /crm/v3/objects/invoices/search"] - 1
+    assert len(wefact.objects["invoice"]) == len(syncable(dataset))
+
+    retrieved.clear()
+    searches = hubspot.calls["POST /crm/v3/objects/invoices/search"]
+    main.main(["--full", "--server-filter"])
+    paid = [index for index in syncable(dataset) if dataset.invoice(index)["hs_invoice_status"] == "paid"]
+    assert len(set(retrieved)) == len(syncable(dataset)) - len(paid)
+    assert len(retrieved) - len(set(retrieved)) == hubspot.calls["POST /crm/v3/objects/invoices/search"] - searches - 1
+
+
+def test_invoice_ids_only_sync_those_invoices(servers):
+    dataset, hubspot, wefact = servers
+    selected = syncable(dataset)[:3]
+
+    main.main(["--invoice-ids", ",".join(str(INVOICE_ID_BASE + index) for index in selected) + ",1"])
+
+    assert len(wefact.objects["invoice"]) == len(selected)
+    assert hubspot.calls["POST /crm/v3/objects/invoices/batch/read"] == 1
+    assert "GET /crm/v3/objects/invoices" not in hubspot.calls
+
+
+def test_a_selection_only_transfers_and_syncs_the_selected_invoices(servers, monkeypatch):
+    dataset, hubspot, wefact = servers
+    retrieved = []
+    build_invoice = hubspot_api._build_invoice
+    monkeypatch.setattr(hubspot_api, "_build_invoice", lambda invoice: retrieved.append(invoice.id) or
+                        build_invoice(invoice))
+    numbers = [dataset.invoice(index)["hs_number"] for index in syncable(dataset)[:4]]
+    company = dataset.associations(dataset.invoice(syncable(dataset)[0])["hs_object_id"], "companies")[0]
+
+    main.main(["--invoice-numbers", ",".join(numbers), "--company", company])
+
+    selected = [index for index in syncable(dataset)[:4]
+                if company in dataset.associations(dataset.invoice(index)["hs_object_id"], "companies")]
+    assert len(retrieved) == len(wefact.objects["invoice"]) == len(selected)
+    assert "GET /crm/v3/objects/invoices" not in hubspot.calls
+
+    retrieved.clear()
+    main.main(["--invoice-date-from", "2024-01-03", "--invoice-date-to", "2024-01-05"])
+    assert [int(invoice_id) - INVOICE_ID_BASE for invoice_id in retrieved] == [2, 3, 4]
+
+
+def test_a_paid_invoice_with_an_unchanged_pdf_is_not_uploaded_again(servers, monkeypatch):
+    dataset, hubspot, wefact = servers
+    index = next(index for index in syncable(dataset) if dataset.invoice(index)["hs_invoice_status"] == "open")
+    invoice_ids = ["--invoice-ids", str(INVOICE_ID_BASE + index)]
+    main.main(invoice_ids)
+    assert hubspot.calls["POST /files/v3/files"] == 1
+
+    invoice = dataset.invoice
+    monkeypatch.setattr(dataset, "invoice", lambda i: {**invoice(i), "hs_invoice_status": "paid"} if i == index
+                        else invoice(i))
+    main.main(invoice_ids)
+
+    assert wefact.calls["POST /v2/ invoice.download"] == 2
+    assert hubspot.calls["POST /files/v3/files"] == 1
+    assert hubspot.calls["POST /crm/v3/objects/notes"] == 1
+
+
+@pytest.mark.parametrize("mode", [["--concurrency", "4"], ["--pipeline", "--concurrency", "2"]])
+def test_invoices_keep_their_own_line_prices_when_a_sku_has_different_prices(servers, monkeypatch, mode):
+    _, _, wefact = servers
+    # few SKUs, each with another price on every line, so invoices that share a SKU are synced side by side
+    dataset = Dataset(20, seed=2, skus=3, price_spread=0.5)
+    hubspot = FakeHubSpot(dataset).start()
+    monkeypatch.setattr(hubspot_api, "HUBSPOT_API_URL", hubspot.url)
+    try:
+        main.main(["--full", *mode])
+    finally:
+        hubspot.stop()
+
+    assert len(wefact.objects["invoice"]) == len(syncable(dataset))
+    # a product is edited at most once per page after the first, never to the price of each invoice
+    pages = -(-dataset.size // 10)
+    assert len(wefact.objects["product"]) == dataset.skus
+    assert wefact.calls["POST /v2/ product.edit"] <= dataset.skus * (pages - 1)
+    for index in syncable(dataset):
+        invoice_id = dataset.invoice(index)["hs_object_id"]
+        line_items = [dataset.line_item(line_item_id) for line_item_id in dataset.associations(invoice_id, "line_items")]
+        expected = round(sum(float(line_item["price"]) * int(line_item["quantity"]) for line_item in line_items), 2)
+        assert wefact.objects["invoice"][dataset.invoice(index)["hs_number"]]["AmountExcl"] == expected
+
+
+def test_an_invoice_that_failed_is_retried_once_the_watermark_has_passed_it(servers, monkeypatch):
+    dataset, hubspot, wefact = servers
+    failing = dataset.invoice(syncable(dataset)[0])["hs_number"]
+    generate_invoice = main.generate_invoice
+
+    def fail_once(invoice, *args):
+        if invoice.number == failing:
+            return ResultType(persist=False, data={}, errors=["debtor is blocked"])
+        return generate_invoice(invoice, *args)
+
+    monkeypatch.setattr(main, "generate_invoice", fail_once)
+    monkeypatch.setattr(state_db, "RETRY_BACKOFF", 0)
+    main.main(["--full"])
+    assert failing not in wefact.objects["invoice"]
+
+    monkeypatch.setattr(main, "generate_invoice", generate_invoice)
+    # the invoice itself is not modified, e.g. when its company was fixed
+    main.main([])
+
+    assert failing in wefact.objects["invoice"]
+    assert hubspot.calls["POST /crm/v3/objects/invoices/batch/read"] == 1
+
+
+def test_an_invoice_whose_pdf_download_failed_is_not_added_to_wefact_again(servers, monkeypatch):
+    dataset, hubspot, wefact = servers
+    failing = dataset.invoice(syncable(dataset)[0])["hs_number"]
+    download_invoice_pdf = wefact_invoice.download_invoice_pdf
+
+    def fail_download(api_client_invoice, invoice_number):
+        if invoice_number == failing:
+            return None, ["download failed"]
+        return download_invoice_pdf(api_client_invoice, invoice_number)
+
+    monkeypatch.setattr(wefact_invoice, "download_invoice_pdf", fail_download)
+    monkeypatch.setattr(state_db, "RETRY_BACKOFF", 0)
+    main.main(["--full"])
+    assert failing in wefact.objects["invoice"]
+    adds, shows = wefact.calls["POST /v2/ invoice.add"], wefact.calls["POST /v2/ invoice.show"]
+
+    monkeypatch.setattr(wefact_invoice, "download_invoice_pdf", download_invoice_pdf)
+    main.main([])
+
+    assert wefact.calls["POST /v2/ invoice.add"] == adds
+    assert wefact.calls["POST /v2/ invoice.show"] == shows
+    connection = state_db.init_db()
+    try:
+        assert state_db.get_invoice_ledger(connection, failing)["pdf_hash"] is not None
+        assert state_db.get_invoices_to_retry(connection) == []
+    finally:
+        connection.close()
@@ -0,0 +1,65 @@
+from hubspot_api.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_hit_and_miss_counters():
+    cache = TTLCache("companies", maxsize=10, ttl=60)
+    assert cache.get("c1") is None
+    cache.put("c1", "Acme")
+    assert cache.get("c1") == "Acme"
+    assert cache.stats() == {"name": "companies", "size": 1, "hits": 1, "misses": 1}
+
+
+def test_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = TTLCache("companies", maxsize=10, ttl=60, clock=clock)
+    cache.put("c1", "Acme")
+    clock.now += 60
+    assert cache.get("c1") is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TTLCache("companies", maxsize=2, ttl=60)
+    cache.put("c1", "one")
+    cache.put("c2", "two")
+    cache.get("c1")  # c2 is now the least recently used
+    cache.put("c3", "three")
+    assert cache.get("c2") is None
+    assert cache.get("c1") == "one"
+    assert cache.get("c3") == "three"
+
+
+def test_get_or_load_only_loads_on_miss():
+    cache = TTLCache("contacts", maxsize=10, ttl=60)
+    loads = []
+
+    def load():
+        loads.append(1)
+        return "Jansen"
+
+    assert cache.get_or_load("k1", load) == "Jansen"
+    assert cache.get_or_load("k1", load) == "Jansen"
+    assert len(loads) == 1
+
+
+def test_dump_and_load_keep_original_timestamps_and_drop_expired():
+    clock = FakeClock()
+    cache = TTLCache("companies", maxsize=10, ttl=60, clock=clock)
+    cache.put("old", "x", stored_at=clock.now - 59)
+    cache.put("new", "y")
+    entries = cache.dump()
+
+    clock.now += 1
+    restored = TTLCache("companies", maxsize=10, ttl=60, clock=clock)
+    restored.load(entries)
+
+    assert restored.get("old") is None
+    assert restored.get("new") == "y"
@@ -1,13 +1,35 @@
 import sqlite3
+from datetime import datetime, timedelta, timezone
 
 import pytest
 
+import state.db as state_db
 from state.db import (
+    MIGRATIONS,
+    LedgerEntry,
+    RETRY_BACKOFF,
+    SyncLockedError,
     INVOICE_STATUS_OPEN,
     INVOICE_STATUS_PAID,
     INVOICE_STATUS_UNKNOWN,
+    clear_invoice_retry,
+    commit_page,
     determine_db_status,
+    determine_db_statuses,
+    get_checkpoint,
+    get_invoice_ledger,
+    get_invoices_to_retry,
+    get_paid_invoice_numbers,
+    get_watermark,
+    init_db,
+    mark_invoice_for_retry,
+    migrate,
+    record_invoice_ledger,
+    save_checkpoint,
     save_invoice_id_in_db,
+    save_watermark,
+    schema_version,
+    sync_lock,
 )
 
 
@@ -26,10 +48,7 @@ def make_invoice(number="F2024-001", status=INVOICE_STATUS_OPEN):
 @pytest.fixture
 def connection():
     conn = sqlite3.connect(":memory:")
-    conn.execute(
-        "CREATE TABLE IF NOT EXISTS invoice_ids(invoice_id text, status text, "
-        "PRIMARY KEY(invoice_id, status))"
-    )
+    migrate(conn)
     yield conn
     conn.close()
 
@@ -58,3 +77,200 @@ def test_paid_takes_precedence_over_open(connection):
 def test_status_is_scoped_to_the_requested_invoice(connection):
     save_invoice_id_in_db(connection, make_invoice(number="OTHER", status=INVOICE_STATUS_PAID))
     assert determine_db_status(connection, make_invoice(number="F2024-001")) == INVOICE_STATUS_UNKNOWN
+
+
+def test_watermark_round_trip(connection):
+    connection.execute("CREATE TABLE IF NOT EXISTS sync_state(key text PRIMARY KEY, value text)")
+    assert get_watermark(connection) is None
+
+    save_watermark(connection, datetime(2026, 6, 21, 10, tzinfo=timezone.utc))
+    save_watermark(connection, datetime(2026, 6, 22, 10, tzinfo=timezone.utc))
+
+    assert get_watermark(connection) == datetime(2026, 6, 22, 10, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def file_db(tmp_path, monkeypatch):
+    monkeypatch.setenv("APPDATA", str(tmp_path))
+    conn = init_db()
+    yield conn
+    conn.close()
+
+
+def test_init_db_enables_write_ahead_log(file_db):
+    assert file_db.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert file_db.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+
+
+def test_batched_writes_are_committed_per_page(file_db, tmp_path):
+    save_invoice_id_in_db(file_db, make_invoice(number="F1"), commit=False)
+    save_invoice_id_in_db(file_db, make_invoice(number="F2"), commit=False)
+    assert (tmp_path / "hubspot-wefact.db-intents").exists()
+
+    commit_page(file_db)
+
+    assert not (tmp_path / "hubspot-wefact.db-intents").exists()
+    assert determine_db_status(file_db, make_invoice(number="F2")) == INVOICE_STATUS_OPEN
+
+
+def test_intent_log_is_replayed_after_a_crash(file_db, tmp_path):
+    save_invoice_id_in_db(file_db, make_invoice(number="F1"), commit=False)
+    file_db.rollback()  # the process died before the page was committed
+    file_db.close()
+
+    conn = init_db()
+
+    assert determine_db_status(conn, make_invoice(number="F1")) == INVOICE_STATUS_OPEN
+    assert not (tmp_path / "hubspot-wefact.db-intents").exists()
+    conn.close()
+
+
+def test_shards_share_statuses_but_not_sync_state(tmp_path, monkeypatch):
+    monkeypatch.setenv("APPDATA", str(tmp_path))
+    first, second = init_db("shard-1-of-2"), init_db("shard-2-of-2")
+    save_watermark(first, datetime(2024, 1, 1, tzinfo=timezone.utc))
+    save_checkpoint(first, {"after": "100"})
+    save_invoice_id_in_db(second, make_invoice(number="F1"), commit=False)
+
+    assert get_watermark(second) is None
+    assert get_checkpoint(second) is None
+    assert get_checkpoint(first) == {"after": "100"}
+    assert (tmp_path / "hubspot-wefact.db-intents-shard-2-of-2").exists()
+
+    commit_page(second)
+    assert determine_db_status(first, make_invoice(number="F1")) == INVOICE_STATUS_OPEN
+    first.close()
+    second.close()
+
+
+def test_bulk_statuses_resolve_like_single_lookups(connection):
+    save_invoice_id_in_db(connection, make_invoice(number="F1", status=INVOICE_STATUS_OPEN))
+    save_invoice_id_in_db(connection, make_invoice(number="F2", status=INVOICE_STATUS_OPEN))
+    save_invoice_id_in_db(connection, make_invoice(number="F2", status=INVOICE_STATUS_PAID))
+
+    statuses = determine_db_statuses(connection, ["F1", "F2", "F3"])
+
+    assert statuses == {"F1": INVOICE_STATUS_OPEN, "F2": INVOICE_STATUS_PAID, "F3": INVOICE_STATUS_UNKNOWN}
+
+
+def test_bulk_statuses_handle_more_numbers_than_one_query_allows(connection):
+    numbers = [f"F{i}" for i in range(1200)]
+    save_invoice_id_in_db(connection, make_invoice(number="F1100", status=INVOICE_STATUS_PAID))
+
+    statuses = determine_db_statuses(connection, numbers)
+
+    assert len(statuses) == 1200
+    assert statuses["F1100"] == INVOICE_STATUS_PAID
+
+
+def test_migrations_upgrade_an_original_database(tmp_path, monkeypatch):
+    # a database as created before the schema was versioned
+    conn = sqlite3.connect(tmp_path / "hubspot-wefact.db")
+    conn.execute("CREATE TABLE invoice_ids(invoice_id text, status text, PRIMARY KEY(invoice_id, status))")
+    conn.executemany("INSERT INTO invoice_ids VALUES(?,?)", [("F1", "open"), ("F1", "paid"), ("F2", "open")])
+    conn.commit()
+    conn.close()
+    monkeypatch.setenv("APPDATA", str(tmp_path))
+
+    conn = init_db()
+
+    assert schema_version(conn) == len(MIGRATIONS)
+    assert get_invoice_ledger(conn, "F1")["status"] == INVOICE_STATUS_PAID
+    assert get_invoice_ledger(conn, "F2")["status"] == INVOICE_STATUS_OPEN
+    migrate(conn)  # running again is a no-op
+    conn.close()
+
+
+def test_a_migration_another_shard_applied_meanwhile_is_not_applied_again(tmp_path, monkeypatch):
+    first = sqlite3.connect(tmp_path / "hubspot-wefact.db")
+    second = sqlite3.connect(tmp_path / "hubspot-wefact.db")
+    reads = []
+
+    def stale_version(connection):
+        # the second shard read the version just before the first one migrated
+        reads.append(connection)
+        return 0 if len(reads) == 1 else connection.execute("PRAGMA user_version").fetchone()[0]
+
+    migrate(first)
+    monkeypatch.setattr(state_db, "schema_version", stale_version)
+    migrate(second)
+
+    assert len(reads) == 2
+    assert second.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    first.close()
+    second.close()
+
+
+def test_ledger_keeps_earlier_values_and_timestamps(file_db):
+    record_invoice_ledger(file_db, make_invoice(status=INVOICE_STATUS_OPEN),
+                          LedgerEntry(wefact_identifier=5, payload_hash="p", pdf_hash="a", hubspot_file_id="f1"))
+    record_invoice_ledger(file_db, make_invoice(status=INVOICE_STATUS_PAID),
+                          LedgerEntry(pdf_hash="b", hubspot_file_id="f2", hubspot_note_id="n2"))
+
+    ledger = get_invoice_ledger(file_db, "F2024-001")
+
+    assert ledger["status"] == INVOICE_STATUS_PAID
+    assert ledger["wefact_identifier"] == 5
+    assert ledger["payload_hash"] == "p"
+    assert ledger["pdf_hash"] == "b"
+    assert ledger["hubspot_note_id"] == "n2"
+    assert ledger["opened_at"] is not None and ledger["paid_at"] is not None
+    assert get_invoice_ledger(file_db, "unknown") is None
+
+
+def test_paid_invoice_numbers_come_from_the_ledger(file_db):
+    record_invoice_ledger(file_db, make_invoice(number="F1", status=INVOICE_STATUS_PAID), LedgerEntry())
+    record_invoice_ledger(file_db, make_invoice(number="F2", status=INVOICE_STATUS_OPEN), LedgerEntry())
+    record_invoice_ledger(file_db, make_invoice(number="F3", status=INVOICE_STATUS_PAID), LedgerEntry())
+
+    assert sorted(get_paid_invoice_numbers(file_db, 10)) == ["F1", "F3"]
+    assert len(get_paid_invoice_numbers(file_db, 1)) == 1
+
+
+def test_failed_invoices_are_retried_with_a_doubling_backoff(file_db):
+    invoice = make_invoice(number="F1")
+    invoice.id = "101"
+    mark_invoice_for_retry(file_db, invoice)
+    now = datetime.now(timezone.utc)
+
+    assert get_invoices_to_retry(file_db, now) == []
+    assert get_invoices_to_retry(file_db, now + timedelta(seconds=RETRY_BACKOFF + 1)) == [("101", "F1")]
+
+    mark_invoice_for_retry(file_db, invoice)
+    assert get_invoices_to_retry(file_db, now + timedelta(seconds=RETRY_BACKOFF + 1)) == []
+    assert get_invoices_to_retry(file_db, now + timedelta(seconds=2 * RETRY_BACKOFF + 1)) == [("101", "F1")]
+
+    clear_invoice_retry(file_db, "101")
+    assert get_invoices_to_retry(file_db, now + timedelta(days=2)) == []
+
+
+def test_a_sync_of_all_invoices_excludes_every_other_sync(tmp_path, monkeypatch):
+    monkeypatch.setenv("APPDATA", str(tmp_path))
+    with sync_lock():
+        with pytest.raises(SyncLockedError):
+            with sync_lock():
+                pass
+        with pytest.raises(SyncLockedError):
+            with sync_lock("shard-1-of-2"):
+                pass
+    # released again
+    with sync_lock():
+        pass
+
+
+def test_shards_lock_only_their_own_scope(tmp_path, monkeypatch):
+    monkeypatch.setenv("APPDATA", str(tmp_path))
+    with sync_lock("shard-1-of-2"), sync_lock("shard-2-of-2"):
+        with pytest.raises(SyncLockedError):
+            with sync_lock("shard-1-of-2"):
+                pass
+        with pytest.raises(SyncLockedError):
+            with sync_lock():
+                pass
+
+
+def test_a_paid_invoice_stays_paid_in_the_ledger(connection):
+    save_invoice_id_in_db(connection, make_invoice(status=INVOICE_STATUS_PAID))
+    save_invoice_id_in_db(connection, make_invoice(status=INVOICE_STATUS_OPEN))
+    assert determine_db_status(connection, make_invoice()) == INVOICE_STATUS_PAID
+    assert get_invoice_ledger(connection, "F2024-001")["status"] == INVOICE_STATUS_PAID
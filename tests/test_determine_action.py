@@ -1,7 +1,10 @@
+import asyncio
+import sqlite3
 from types import SimpleNamespace
 
 import pytest
 
+import main
 from main import _determine_action
 from state.db import (
     ACTION_OPEN,
@@ -11,7 +14,10 @@ from state.db import (
     INVOICE_STATUS_OPEN,
     INVOICE_STATUS_PAID,
     INVOICE_STATUS_UNKNOWN,
+    LedgerEntry,
+    migrate,
 )
+from wefact_api.invoice import ResultType
 
 
 def invoice(status):
@@ -46,3 +52,44 @@ def test_open_invoice_with_paid_db_is_inconsistent_and_raises():
     # Regressing from paid back to open should never happen; guard it.
     with pytest.raises(ValueError):
         _determine_action(INVOICE_STATUS_PAID, invoice(INVOICE_STATUS_OPEN))
+
+
+def test_async_batch_serialises_invoices_with_the_same_number(monkeypatch):
+    connection = sqlite3.connect(":memory:")
+    migrate(connection)
+    synced = []
+
+    def fake_sync_invoice(api_client, inv, action, *args):
+        synced.append((inv.number, action))
+        job = main.InvoiceJob(inv, action)
+        job.ledger_entry = LedgerEntry()
+        return job
+
+    monkeypatch.setattr(main, "resolve_invoice_associations_async", lambda *args: _done({}))
+    monkeypatch.setattr(main, "read_line_items_async", lambda *args: _done({}))
+    monkeypatch.setattr(main, "associated_line_item_ids", lambda associations: [])
+    monkeypatch.setattr(main, "sync_invoice", fake_sync_invoice)
+    invoices = [
+        SimpleNamespace(id="1", number="F1", status=INVOICE_STATUS_OPEN),
+        SimpleNamespace(id="1", number="F1", status=INVOICE_STATUS_OPEN),
+        SimpleNamespace(id="2", number="F2", status=INVOICE_STATUS_PAID),
+    ]
+
+    asyncio.run(main.process_batch_of_invoices_async(None, connection, invoices, concurrency=4))
+
+    # the duplicate F1 sees the saved OPEN status and is not pushed twice
+    assert sorted(synced) == [("F1", ACTION_OPEN), ("F2", ACTION_OPEN)]
+
+
+async def _done(value):
+    return value
+
+
+def test_an_invoice_without_a_pdf_is_not_saved():
+    job = main.InvoiceJob(SimpleNamespace(id="1", number="F1", status=INVOICE_STATUS_OPEN), INVOICE_STATUS_OPEN)
+    job.result = ResultType(persist=False, data={"pdf": None}, errors=[])
+
+    main.upload_invoice_pdf(None, job)
+
+    assert job.finished
+    assert job.ledger_entry is None
@@ -1,12 +1,21 @@
-from datetime import date
+import io
+from datetime import date, datetime, timezone
 from types import SimpleNamespace
 from unittest.mock import MagicMock
 
+import pytest
+
 from hubspot_api import api
 from hubspot_api.api import _read_first_association_id
 from models.invoice import Invoice
 
 
+@pytest.fixture(autouse=True)
+def empty_object_caches():
+    api.COMPANY_CACHE.clear()
+    api.CONTACT_CACHE.clear()
+
+
 def make_page(results, after=None):
     """Fake HubSpot get_page response."""
     paging = SimpleNamespace(next=SimpleNamespace(after=after)) if after else None
@@ -139,9 +148,13 @@ def _build_client(*, companies, contacts, line_items, line_item_props):
         id="cont-1",
         properties={"hs_object_id": "cont-1", "lastname": "Jansen", "factuur_toelichting": "x"},
     )
-    api_client.crm.line_items.basic_api.get_by_id.side_effect = [
-        SimpleNamespace(properties=props) for props in line_item_props
-    ]
+    line_item_ids = [ref.id for ref in line_items.results[0].to] if line_items and line_items.results else []
+    api_client.crm.line_items.batch_api.read.return_value = SimpleNamespace(
+        results=[
+            SimpleNamespace(id=line_item_id, properties=props)
+            for line_item_id, props in zip(line_item_ids, line_item_props)
+        ]
+    )
     return api_client
 
 
@@ -244,3 +257,219 @@ class TestGetInvoiceDetails:
         assert invoice.line_items[0].hs_sku == "SKU1"
         assert len(errors) == 1
         assert "SKU is NOT set" in errors[0]
+
+
+class TestSearchInvoices:
+    def test_filters_on_last_modified_and_maps_results(self):
+        api_client = MagicMock()
+        api_client.crm.commerce.invoices.search_api.do_search.return_value = make_page(
+            [make_invoice_result("inv-1", hs_lastmodifieddate="2026-06-22T10:00:00Z")], after="100"
+        )
+
+        invoices, after = api.search_invoices(
+            api_client, after=None, modified_since=datetime(2026, 6, 21, tzinfo=timezone.utc)
+        )
+
+        assert after == "100"
+        assert invoices[0].id == "inv-1"
+        assert invoices[0].last_modified == datetime(2026, 6, 22, 10, tzinfo=timezone.utc)
+        request = api_client.crm.commerce.invoices.search_api.do_search.call_args.kwargs[
+            "public_object_search_request"
+        ]
+        search_filter = request.filter_groups[0].filters[0]
+        assert search_filter.property_name == "hs_lastmodifieddate"
+        assert search_filter.operator == "GTE"
+        assert search_filter.value == str(int(datetime(2026, 6, 21, tzinfo=timezone.utc).timestamp() * 1000))
+
+    def test_status_and_excluded_number_filters(self):
+        api_client = MagicMock()
+        api_client.crm.commerce.invoices.search_api.do_search.return_value = make_page([])
+        excluded = [f"F{number}" for number in range(api.SEARCH_EXCLUDED_NUMBERS_LIMIT + 50)]
+
+        api.search_invoices(api_client, after=None, statuses=["open", "paid"], excluded_numbers=excluded)
+
+        request = api_client.crm.commerce.invoices.search_api.do_search.call_args.kwargs[
+            "public_object_search_request"
+        ]
+        filters = request.filter_groups[0].filters
+        assert (filters[0].property_name, filters[0].operator, filters[0].values) == \
+            ("hs_invoice_status", "IN", ["open", "paid"])
+        assert [(f.property_name, f.operator) for f in filters[1:]] == [("hs_number", "NOT_IN")] * 4
+        assert [value for f in filters[1:] for value in f.values] == excluded[:api.SEARCH_EXCLUDED_NUMBERS_LIMIT]
+
+    def test_selection_repeats_its_filters_in_a_group_per_hundred_numbers(self):
+        api_client = MagicMock()
+        api_client.crm.commerce.invoices.search_api.do_search.return_value = make_page([])
+        numbers = [f"F{number}" for number in range(150)]
+
+        api.search_invoices(api_client, after=None, numbers=numbers, company_id="42",
+                            invoice_date_from=date(2024, 1, 1), invoice_date_to=date(2024, 1, 31))
+
+        request = api_client.crm.commerce.invoices.search_api.do_search.call_args.kwargs[
+            "public_object_search_request"
+        ]
+        assert len(request.filter_groups) == 2
+        for group, selected in zip(request.filter_groups, [numbers[:100], numbers[100:]]):
+            company, invoice_date, number = group.filters
+            assert (company.property_name, company.operator, company.value) == ("associations.company", "EQ", "42")
+            assert (invoice_date.property_name, invoice_date.operator) == ("hs_invoice_date", "BETWEEN")
+            assert invoice_date.value == str(int(datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp() * 1000))
+            assert invoice_date.high_value == str(int(datetime(2024, 1, 31, tzinfo=timezone.utc).timestamp() * 1000))
+            assert (number.property_name, number.operator, number.values) == ("hs_number", "IN", selected)
+
+    def test_selecting_too_many_numbers_is_refused(self):
+        with pytest.raises(ValueError):
+            api.search_invoices(MagicMock(), after=None,
+                                numbers=[f"F{number}" for number in range(api.SEARCH_SELECTED_NUMBERS_LIMIT + 1)])
+
+    def test_last_page_has_no_paging_token(self):
+        api_client = MagicMock()
+        api_client.crm.commerce.invoices.search_api.do_search.return_value = make_page([])
+
+        invoices, after = api.search_invoices(
+            api_client, after="200", modified_since=datetime(2026, 6, 21, tzinfo=timezone.utc)
+        )
+
+        assert invoices == []
+        assert after is None
+
+
+def make_multi_association(mapping):
+    """Fake batch association response covering several invoices."""
+    results = [
+        SimpleNamespace(_from=SimpleNamespace(id=from_id), to=[SimpleNamespace(id=i) for i in to_ids])
+        for from_id, to_ids in mapping.items()
+    ]
+    obj = SimpleNamespace(results=results)
+    obj.to_dict = lambda: {"num_errors": None, "errors": None}
+    return obj
+
+
+class TestResolveInvoiceAssociations:
+    def test_one_batch_call_per_object_type(self):
+        api_client = MagicMock()
+        api_client.crm.associations.batch_api.read.side_effect = lambda **kwargs: {
+            "companies": make_multi_association({"inv-1": ["comp-1"], "inv-2": ["comp-2"]}),
+            "contacts": make_multi_association({"inv-1": ["cont-1"]}),
+            "line_items": make_multi_association({"inv-1": ["li-1", "li-2"], "inv-2": ["li-3"]}),
+        }[kwargs["to_object_type"]]
+        invoices = [SimpleNamespace(id="inv-1"), SimpleNamespace(id="inv-2")]
+
+        associations = api.resolve_invoice_associations(api_client, invoices)
+
+        assert api_client.crm.associations.batch_api.read.call_count == 3
+        assert associations["companies"] == {"inv-1": ["comp-1"], "inv-2": ["comp-2"]}
+        assert associations["contacts"] == {"inv-1": ["cont-1"]}
+        assert associations["line_items"]["inv-1"] == ["li-1", "li-2"]
+        batch_input = api_client.crm.associations.batch_api.read.call_args.kwargs["batch_input_public_object_id"]
+        assert [item["id"] for item in batch_input.inputs] == ["inv-1", "inv-2"]
+
+    def test_large_pages_are_split_into_chunks(self):
+        api_client = MagicMock()
+        api_client.crm.associations.batch_api.read.return_value = make_multi_association({})
+        invoice_ids = [f"inv-{i}" for i in range(api.ASSOCIATION_BATCH_SIZE + 1)]
+
+        api.read_associations(api_client, invoice_ids, "companies")
+
+        assert api_client.crm.associations.batch_api.read.call_count == 2
+
+    def test_get_invoice_details_uses_resolved_associations(self):
+        api_client = _build_client(
+            companies=None,
+            contacts=None,
+            line_items=None,
+            line_item_props=[],
+        )
+        associations = {"companies": {"inv-1": ["comp-1"]}, "contacts": {}, "line_items": {}}
+
+        company, contact, errors = api.get_invoice_details(api_client, _invoice(), associations)
+
+        api_client.crm.associations.batch_api.read.assert_not_called()
+        assert company.id == "comp-1"
+        assert contact is None
+        assert errors == []
+
+
+class TestReadLineItems:
+    def test_reads_line_items_in_chunks_with_line_item_properties(self):
+        api_client = MagicMock()
+        api_client.crm.line_items.batch_api.read.side_effect = lambda **kwargs: SimpleNamespace(
+            results=[
+                SimpleNamespace(id=item["id"], properties={"hs_sku": f"SKU-{item['id']}"})
+                for item in kwargs["batch_read_input_simple_public_object_id"].inputs
+            ]
+        )
+        line_item_ids = [f"li-{i}" for i in range(api.LINE_ITEM_BATCH_SIZE + 5)]
+
+        line_items = api.read_line_items(api_client, line_item_ids)
+
+        assert api_client.crm.line_items.batch_api.read.call_count == 2
+        batch_read = api_client.crm.line_items.batch_api.read.call_args.kwargs["batch_read_input_simple_public_object_id"]
+        assert batch_read.properties == api.LINE_ITEM_PROPERTIES
+        assert len(line_items) == len(line_item_ids)
+        assert line_items["li-3"] == {"hs_sku": "SKU-li-3"}
+
+    def test_missing_line_item_is_reported_as_error(self):
+        api_client = _build_client(
+            companies=make_association(["comp-1"]),
+            contacts=make_association(["cont-1"]),
+            line_items=make_association(["li-1"]),
+            line_item_props=[],
+        )
+        invoice = _invoice()
+
+        _, _, errors = api.get_invoice_details(api_client, invoice)
+
+        assert invoice.line_items == []
+        assert len(errors) == 1
+        assert "li-1" in errors[0]
+
+    def test_prefetched_line_items_are_used_without_extra_calls(self):
+        api_client = _build_client(
+            companies=None,
+            contacts=None,
+            line_items=None,
+            line_item_props=[],
+        )
+        associations = {"companies": {}, "contacts": {}, "line_items": {"inv-1": ["li-1"]}}
+        line_item_properties = {
+            "li-1": {"hs_sku": "SKU1", "name": "Widget", "quantity": "1", "amount": "10", "price": "10"}
+        }
+        invoice = _invoice()
+
+        api.get_invoice_details(api_client, invoice, associations, line_item_properties)
+
+        api_client.crm.line_items.batch_api.read.assert_not_called()
+        assert invoice.line_items[0].hs_sku == "SKU1"
+        # the shared page-level properties are left untouched
+        assert line_item_properties["li-1"]["quantity"] == "1"
+
+
+def test_company_and_contact_are_fetched_once_for_several_invoices():
+    api_client = _build_client(
+        companies=make_association(["comp-1"]),
+        contacts=make_association(["cont-1"]),
+        line_items=make_association([]),
+        line_item_props=[],
+    )
+
+    api.get_invoice_details(api_client, _invoice())
+    api.get_invoice_details(api_client, _invoice())
+
+    api_client.crm.companies.basic_api.get_by_id.assert_called_once()
+    api_client.crm.contacts.basic_api.get_by_id.assert_called_once()
+    assert api.COMPANY_CACHE.stats()["hits"] == 1
+
+
+def test_requests_outside_the_sdk_have_a_timeout(monkeypatch):
+    response = MagicMock()
+    response.json.return_value = {"results": [], "id": "1", "url": "https://files.test/1"}
+    sent = MagicMock(return_value=response)
+    monkeypatch.setattr(api.requests, "get", sent)
+    monkeypatch.setattr(api.requests, "post", sent)
+    monkeypatch.setenv("HUBSPOT_ACCESS_TOKEN", "token")
+
+    api.get_taxes(None)
+    api.upload_invoice(None, "F1.pdf", io.BytesIO(b"%PDF"))
+
+    assert [call.kwargs["timeout"] for call in sent.call_args_list] == [api.HUBSPOT_TIMEOUT] * 2
@@ -0,0 +1,317 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from state.db import INVOICE_STATUS_OPEN, determine_db_status, get_checkpoint, get_watermark, migrate, \
+    save_checkpoint, save_invoice_id_in_db, save_wefact_index, sync_lock
+
+
+class Crash(Exception):
+    pass
+
+
+@pytest.fixture
+def connection(monkeypatch, tmp_path):
+    conn = sqlite3.connect(":memory:")
+    monkeypatch.setenv("APPDATA", str(tmp_path))
+    monkeypatch.setattr(main, "METRICS_TEXTFILE", str(tmp_path / "hubspot-wefact.prom"))
+    migrate(conn)
+    monkeypatch.setattr(main, "init_db", lambda scope=None: conn)
+    monkeypatch.setattr(main, "get_api_client", lambda: None)
+    monkeypatch.setattr(main, "_load_wefact_index", lambda *args, **kwargs: main.WeFactIndex("test"))
+    return conn
+
+
+def fake_pages(pages, processed, crash_on=None):
+    """get_invoices stand-in: page cursors are "p1", "p2", ...; None is the first page."""
+
+    def fetch(api_client, after):
+        number = 0 if after is None else int(after[1:])
+        if number == crash_on:
+            raise Crash()
+        next_page = f"p{number + 1}" if number + 1 < pages else None
+        return [SimpleNamespace(number=f"F{number}", last_modified=None)], next_page
+
+    def process(api_client, connection, invoices, *args):
+        processed.extend(invoice.number for invoice in invoices)
+
+    return fetch, process
+
+
+def test_run_resumes_from_the_last_completed_page(connection, monkeypatch):
+    processed = []
+    fetch, process = fake_pages(4, processed, crash_on=2)
+    monkeypatch.setattr(main, "get_invoices", fetch)
+    monkeypatch.setattr(main, "process_batch_of_invoices", process)
+
+    with pytest.raises(Crash):
+        main.main(["--full"])
+    assert get_checkpoint(connection)["after"] == "p2"
+
+    fetch, process = fake_pages(4, processed)
+    monkeypatch.setattr(main, "get_invoices", fetch)
+    monkeypatch.setattr(main, "process_batch_of_invoices", process)
+    main.main(["--full"])
+
+    assert processed == ["F0", "F1", "F2", "F3"]
+    assert get_checkpoint(connection) is None
+
+
+def test_a_search_is_resumed_from_its_watermark(connection, monkeypatch):
+    watermark = datetime(2024, 1, 2, tzinfo=timezone.utc)
+    save_checkpoint(connection, {"run_id": "run", "modified_since": "2024-01-01T00:00:00+00:00",
+                                 "watermark": watermark.isoformat(), "after": "300", "search_filters": None,
+                                 "started_at": None, "mode": "incremental"})
+    searches = []
+
+    def search(api_client, after, modified_since=None, **filters):
+        searches.append((after, modified_since))
+        return [], None
+
+    monkeypatch.setattr(main, "search_invoices", search)
+    main.main([])
+
+    assert searches == [(None, watermark)]
+
+
+def test_a_checkpoint_of_another_kind_of_run_is_not_resumed(connection, monkeypatch):
+    processed = []
+    fetch, process = fake_pages(2, processed)
+    monkeypatch.setattr(main, "get_invoices", fetch)
+    monkeypatch.setattr(main, "process_batch_of_invoices", process)
+    save_checkpoint(connection, {"run_id": "run", "modified_since": "2024-01-01T00:00:00+00:00",
+                                 "watermark": None, "after": "1", "search_filters": None, "started_at": None,
+                                 "mode": "incremental"})
+
+    main.main(["--full"])
+
+    assert processed == ["F0", "F1"]
+    assert get_checkpoint(connection) is None
+
+
+def test_reset_checkpoint_starts_from_the_beginning(connection, monkeypatch):
+    processed = []
+    fetch, process = fake_pages(3, processed, crash_on=2)
+    monkeypatch.setattr(main, "get_invoices", fetch)
+    monkeypatch.setattr(main, "process_batch_of_invoices", process)
+    with pytest.raises(Crash):
+        main.main(["--full"])
+
+    fetch, process = fake_pages(3, processed)
+    monkeypatch.setattr(main, "get_invoices", fetch)
+    monkeypatch.setattr(main, "process_batch_of_invoices", process)
+    main.main(["--full", "--reset-checkpoint"])
+
+    assert processed == ["F0", "F1", "F0", "F1", "F2"]
+
+
+def test_shards_split_the_invoices_between_them():
+    shards = [main.Shard(index, 3) for index in range(1, 4)]
+    numbers = [f"F{number}" for number in range(300)]
+
+    owners = [[shard for shard in shards if main.in_shard(shard, number)] for number in numbers]
+
+    assert all(len(owner) == 1 for owner in owners)
+    assert all(10 < sum(owner == [shard] for owner in owners) for shard in shards)
+
+
+@pytest.mark.parametrize("value", ["0/4", "5/4", "3", "a/b"])
+def test_invalid_shards_are_rejected(value):
+    with pytest.raises(SystemExit):
+        main.parse_args(["--shard", value])
+
+
+def test_shard_pages_hold_only_its_invoices(monkeypatch):
+    processed = []
+    fetch, _ = fake_pages(20, processed)
+    monkeypatch.setattr(main, "get_invoices", fetch)
+    shard = main.Shard(2, 4)
+
+    pages = list(main.iterate_pages(None, "run", None, None, None, shard))
+
+    assert len(pages) == 20
+    assert [invoice.number for page in pages for invoice in page.invoices] == \
+        [f"F{number}" for number in range(20) if main.in_shard(shard, f"F{number}")]
+
+
+def test_an_invoice_modified_while_paging_does_not_hide_another_one(monkeypatch):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    invoices = {f"F{number}": SimpleNamespace(number=f"F{number}", last_modified=start + timedelta(seconds=number))
+                for number in range(5)}
+    searches = []
+
+    def search(api_client, after, modified_since=None, **filters):
+        if searches:
+            # F1 is paid after the first page was read, which moves it to the end of the results
+            invoices["F1"] = SimpleNamespace(number="F1", last_modified=start + timedelta(seconds=9))
+        searches.append(after)
+        offset = int(after or 0)
+        found = sorted((invoice for invoice in invoices.values() if invoice.last_modified >= modified_since),
+                       key=lambda invoice: invoice.last_modified)
+        return found[offset:offset + 2], str(offset + 2) if offset + 2 < len(found) else None
+
+    monkeypatch.setattr(main, "search_invoices", search)
+    pages = main.iterate_pages(None, "run", start, start, None)
+
+    assert [invoice.number for page in pages for invoice in page.invoices] == ["F0", "F1", "F2", "F3", "F4", "F1"]
+
+
+def test_a_search_that_cannot_move_past_its_results_limit_stops(monkeypatch):
+    stuck = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    monkeypatch.setattr(main, "SEARCH_RESULTS_LIMIT", 2)
+
+    def search(api_client, after, modified_since=None, **filters):
+        offset = int(after or 0)
+        return [SimpleNamespace(number=f"F{offset}", last_modified=stuck)], str(offset + 1)
+
+    monkeypatch.setattr(main, "search_invoices", search)
+    pages = main.iterate_pages(None, "run", stuck, stuck, None)
+
+    with pytest.raises(RuntimeError, match="modified at"):
+        for _ in range(10):
+            next(pages)
+
+
+def test_a_refreshed_wefact_index_keeps_the_fingerprints_of_unchanged_identifiers():
+    conn = sqlite3.connect(":memory:")
+    migrate(conn)
+    save_wefact_index(conn, "debtor", [("R1", 11, "fingerprint")])
+    client = SimpleNamespace(_controller="debtor", list_all=lambda: [{"Identifier": "11", "DebtorCode": "R1"}])
+
+    index = main._load_wefact_index(conn, client, "DebtorCode", refresh=True)
+
+    assert index.get("R1") == ("11", "fingerprint")
+
+
+def test_an_invoice_modified_during_a_run_is_found_by_the_next_run(connection, monkeypatch):
+    processed = []
+    before = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    modified = {}
+
+    def fetch(api_client, after):
+        if after is None:
+            return [SimpleNamespace(number="F0", last_modified=before)], "p1"
+        # F0 is paid after its page was read, and F1 is modified later still
+        modified["F0"] = datetime.now(timezone.utc)
+        return [SimpleNamespace(number="F1", last_modified=modified["F0"] + timedelta(seconds=1))], None
+
+    def search(api_client, after, modified_since=None, **filters):
+        invoices = [SimpleNamespace(number="F0", last_modified=modified["F0"])]
+        return [invoice for invoice in invoices if invoice.last_modified >= modified_since], None
+
+    def process(api_client, connection, invoices, *args):
+        processed.extend(invoice.number for invoice in invoices)
+
+    monkeypatch.setattr(main, "get_invoices", fetch)
+    monkeypatch.setattr(main, "search_invoices", search)
+    monkeypatch.setattr(main, "process_batch_of_invoices", process)
+    main.main(["--full"])
+    assert get_watermark(connection) < modified["F0"]
+
+    main.main([])
+
+    assert processed == ["F0", "F1", "F0"]
+
+
+def test_metrics_are_written_after_a_run(connection, monkeypatch, tmp_path):
+    fetch, process = fake_pages(1, [])
+    monkeypatch.setattr(main, "get_invoices", fetch)
+    monkeypatch.setattr(main, "process_batch_of_invoices", process)
+
+    main.main(["--full"])
+
+    assert 'state_db_operation_duration_seconds_count{operation="commit_page"}' in \
+        (tmp_path / "hubspot-wefact.prom").read_text()
+
+
+def test_daemon_keeps_syncing_until_stopped(connection, monkeypatch, tmp_path):
+    processed, opened = [], []
+    stop = threading.Event()
+    fetch, process = fake_pages(2, processed)
+    monkeypatch.setattr(main, "get_invoices", fetch)
+    monkeypatch.setattr(main, "get_api_client", lambda: opened.append(True))
+
+    def process_and_count_cycles(*args):
+        process(*args)
+        if len(processed) == 6:
+            stop.set()
+
+    monkeypatch.setattr(main, "process_batch_of_invoices", process_and_count_cycles)
+    args = main.parse_args(["--daemon", "--full", "--interval", "0",
+                            "--metrics-file", str(tmp_path / "hubspot-wefact.prom")])
+    main.run_daemon(args, stop)
+
+    assert processed == ["F0", "F1"] * 3
+    assert opened == [True]
+    assert 'sync_cycle_duration_seconds_count{outcome="success"}' in (tmp_path / "hubspot-wefact.prom").read_text()
+
+
+def test_daemon_resumes_a_failed_cycle_in_the_next_one(connection, monkeypatch, tmp_path):
+    processed = []
+    stop = threading.Event()
+    crashing, _ = fake_pages(3, processed, crash_on=2)
+    fetch, process = fake_pages(3, processed)
+    fetches = iter([crashing] * 3 + [fetch])
+    monkeypatch.setattr(main, "get_invoices", lambda api_client, after: next(fetches)(api_client, after))
+
+    def process_and_stop(*args):
+        process(*args)
+        if processed[-1] == "F2":
+            stop.set()
+
+    monkeypatch.setattr(main, "process_batch_of_invoices", process_and_stop)
+    main.run_daemon(main.parse_args(["--daemon", "--full", "--interval", "0"]), stop)
+
+    assert processed == ["F0", "F1", "F2"]
+    assert get_checkpoint(connection) is None
+
+
+def test_daemon_keeps_the_statuses_of_a_failed_cycle(monkeypatch, tmp_path):
+    conn = sqlite3.connect(tmp_path / "state.db")
+    migrate(conn)
+    monkeypatch.setenv("APPDATA", str(tmp_path))
+    monkeypatch.setattr(main, "METRICS_TEXTFILE", str(tmp_path / "hubspot-wefact.prom"))
+    monkeypatch.setattr(main, "init_db", lambda scope=None: conn)
+    monkeypatch.setattr(main, "get_api_client", lambda: None)
+    monkeypatch.setattr(main, "_load_wefact_index", lambda *args, **kwargs: main.WeFactIndex("test"))
+    fetch, _ = fake_pages(1, [])
+    monkeypatch.setattr(main, "get_invoices", fetch)
+    stop = threading.Event()
+    statuses = []
+
+    def process(api_client, connection, invoices, *args):
+        if not statuses:
+            # the invoice was pushed, but the cycle fails before its page is committed
+            save_invoice_id_in_db(connection, SimpleNamespace(number="F0", status=INVOICE_STATUS_OPEN), commit=False)
+            statuses.append(None)
+            raise Crash()
+        statuses.append(determine_db_status(connection, SimpleNamespace(number="F0")))
+        stop.set()
+
+    monkeypatch.setattr(main, "process_batch_of_invoices", process)
+    main.run_daemon(main.parse_args(["--daemon", "--full", "--interval", "0"]), stop)
+
+    assert statuses == [None, INVOICE_STATUS_OPEN]
+
+
+def test_a_run_stops_while_another_process_syncs(connection, monkeypatch):
+    processed = []
+    fetch, process = fake_pages(1, processed)
+    monkeypatch.setattr(main, "get_invoices", fetch)
+    monkeypatch.setattr(main, "process_batch_of_invoices", process)
+
+    with sync_lock():
+        with pytest.raises(SystemExit) as exit_info:
+            main.main(["--full"])
+        stop = threading.Event()
+        skipped = main.SYNC_CYCLE_SECONDS.count(outcome="skipped")
+        monkeypatch.setattr(main, "_write_metrics", lambda args: stop.set())
+        main.run_daemon(main.parse_args(["--daemon", "--interval", "0"]), stop)
+
+    assert exit_info.value.code == main.EXIT_SYNC_LOCKED
+    assert main.SYNC_CYCLE_SECONDS.count(outcome="skipped") == skipped + 1
+    assert processed == []
@@ -0,0 +1,87 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from hubspot_api.api import _endpoint
+from metrics import REGISTRY, WEFACT_REQUESTS, WEFACT_REQUEST_SECONDS, Registry, timed
+from wefact_api.api import InvoiceClient, WeFactBase
+
+
+@pytest.fixture(autouse=True)
+def clear_registry():
+    REGISTRY.clear()
+    yield
+    REGISTRY.clear()
+
+
+def test_counters_render_per_label_combination():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ["status"])
+    requests.inc(status=200)
+    requests.inc(status=200)
+    requests.inc(status='say "hi"')
+
+    assert registry.render() == (
+        "# HELP requests_total Requests\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{status="200"} 2\n'
+        'requests_total{status="say \\"hi\\""} 1\n'
+    )
+
+
+def test_histograms_count_cumulative_buckets():
+    registry = Registry()
+    registry.const_labels = {"shard": "1/2"}
+    duration = registry.histogram("duration_seconds", "Duration", buckets=(0.1, 1.0))
+    duration.observe(0.05)
+    duration.observe(0.5)
+    duration.observe(5)
+
+    lines = registry.render().splitlines()
+
+    assert 'duration_seconds_bucket{shard="1/2",le="0.1"} 1' in lines
+    assert 'duration_seconds_bucket{shard="1/2",le="1.0"} 2' in lines
+    assert 'duration_seconds_bucket{shard="1/2",le="+Inf"} 3' in lines
+    assert 'duration_seconds_sum{shard="1/2"} 5.55' in lines
+    assert 'duration_seconds_count{shard="1/2"} 3' in lines
+
+
+def test_timed_records_calls_that_raise():
+    registry = Registry()
+    duration = registry.histogram("operation_seconds", "Duration", ["operation"])
+
+    @timed(duration, operation="fail")
+    def fail():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        fail()
+    assert duration.count(operation="fail") == 1
+
+
+def test_textfile_is_replaced_in_one_go(tmp_path):
+    registry = Registry()
+    registry.counter("runs_total", "Runs").inc()
+    path = tmp_path / "sync.prom"
+    path.write_text("old")
+
+    registry.write_textfile(path)
+
+    assert path.read_text().endswith("runs_total 1\n")
+    assert [file.name for file in tmp_path.iterdir()] == ["sync.prom"]
+
+
+def test_hubspot_endpoints_leave_out_object_ids():
+    assert _endpoint("https://api.hubapi.com/crm/v3/objects/companies/123?properties=name") == \
+        "/crm/v3/objects/companies/{id}"
+
+
+def test_wefact_requests_are_counted_per_controller_and_action(monkeypatch):
+    session = MagicMock()
+    session.post.return_value.json.return_value = {"status": "error"}
+    monkeypatch.setattr(WeFactBase, "_session", session)
+
+    InvoiceClient().show({"InvoiceCode": "F1"})
+
+    assert WEFACT_REQUESTS.value(controller="invoice", action="show", status="error") == 1
+    assert WEFACT_REQUEST_SECONDS.count(controller="invoice", action="show") == 1
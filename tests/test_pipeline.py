@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import main
+from pipeline import Pipeline, Stage
+from state.db import INVOICE_STATUS_OPEN, INVOICE_STATUS_PAID, LedgerEntry, determine_db_status, migrate
+
+
+def test_pages_complete_in_order_after_all_their_items():
+    sunk, done = [], []
+
+    def slow_first(item):
+        if item == 0:
+            time.sleep(0.05)
+        return [item * 10]
+
+    pipeline = Pipeline([Stage("double", lambda item: [item, item]), Stage("slow", slow_first, workers=3)],
+                        sink=sunk.append, on_page_done=lambda page: done.append((page, sorted(sunk))))
+    pipeline.run([[0, 1], [2], []], dispatch=lambda page: page)
+
+    assert [page for page, _ in done] == [[0, 1], [2], []]
+    assert all(sunk_by_then.count(value * 10) == 2 for page, sunk_by_then in done for value in page)
+
+
+def test_dropped_items_complete_their_page():
+    done = []
+    pipeline = Pipeline([Stage("filter", lambda item: [item] if item % 2 else [])], sink=lambda item: None,
+                        on_page_done=done.append)
+    pipeline.run([[1, 2], [4]], dispatch=lambda page: page)
+
+    assert done == [[1, 2], [4]]
+
+
+def test_full_queues_hold_back_the_stage_before():
+    release = threading.Event()
+    started = []
+
+    def blocked(item):
+        release.wait()
+        return [item]
+
+    def record(item):
+        started.append(item)
+        return [item]
+
+    pipeline = Pipeline([Stage("first", record, queue_size=1), Stage("second", blocked, queue_size=1)],
+                        sink=lambda item: None, on_page_done=lambda page: None)
+    runner = threading.Thread(target=pipeline.run, args=([list(range(10))], lambda page: page))
+    runner.start()
+    time.sleep(0.1)
+    # one item in the blocked handler, one in its queue and one waiting to be put there
+    assert len(started) <= 3
+    release.set()
+    runner.join()
+    assert started == list(range(10))
+
+
+def test_worker_errors_are_raised_by_run():
+    def fail(item):
+        raise ValueError(item)
+
+    pipeline = Pipeline([Stage("fail", fail)], sink=lambda item: None, on_page_done=lambda page: None)
+    with pytest.raises(ValueError):
+        pipeline.run([[1]], dispatch=lambda page: page)
+
+
+def test_a_failing_handler_stops_every_thread_of_the_pipeline():
+    def fail_on_five(item):
+        if item == 5:
+            raise ValueError(item)
+        return [item]
+
+    def pages():
+        # more pages than ever fit in the queues
+        page = 0
+        while True:
+            yield list(range(page * 10, page * 10 + 10))
+            page += 1
+
+    pipeline = Pipeline([Stage("first", lambda item: [item], workers=2, queue_size=1),
+                         Stage("fail", fail_on_five, workers=2, queue_size=1),
+                         Stage("slow", lambda item: time.sleep(0.01) or [item], queue_size=1)],
+                        sink=lambda item: None, on_page_done=lambda page: None)
+    threads = set(threading.enumerate())
+    with pytest.raises(ValueError):
+        pipeline.run(pages(), dispatch=lambda page: page)
+
+    assert set(threading.enumerate()) == threads
+
+
+def test_stats_report_every_stage():
+    pipeline = Pipeline([Stage("echo", lambda item: [item], workers=2)], sink=lambda item: None,
+                        on_page_done=lambda page: None)
+    pipeline.run([[1, 2, 3]], dispatch=lambda page: page)
+
+    stats = {report["stage"]: report for report in pipeline.stats()}
+    assert stats["fetch"]["items"] == 1
+    assert stats["echo"]["items"] == 3
+    assert stats["echo"]["workers"] == 2
+
+
+def test_run_pipelined_syncs_transitions_of_one_number_in_order(monkeypatch):
+    connection = sqlite3.connect(":memory:")
+    migrate(connection)
+    in_stages, pushed = set(), []
+    lock = threading.Lock()
+
+    monkeypatch.setattr(main, "resolve_invoice_associations", lambda api_client, invoices: {"line_items": {}})
+    monkeypatch.setattr(main, "read_line_items", lambda api_client, ids: {})
+    monkeypatch.setattr(main, "_save_wefact_index", lambda connection, index: None)
+
+    def enrich(api_client, job):
+        with lock:
+            assert job.invoice.number not in in_stages
+            in_stages.add(job.invoice.number)
+
+    def push(job, debtor_index, product_index):
+        time.sleep(0.01)
+        pushed.append((job.invoice.number, job.action))
+
+    def upload(api_client, job):
+        job.ledger_entry = LedgerEntry()
+        with lock:
+            in_stages.discard(job.invoice.number)
+
+    monkeypatch.setattr(main, "enrich_invoice", enrich)
+    monkeypatch.setattr(main, "push_invoice", push)
+    monkeypatch.setattr(main, "upload_invoice_pdf", upload)
+
+    def invoice(number, status):
+        return SimpleNamespace(id=f"{number}-{status}", number=number, status=status, last_modified=None)
+
+    pages = [
+        main.Page([invoice("F1", INVOICE_STATUS_OPEN), invoice("F2", INVOICE_STATUS_OPEN)], None, {"after": "p1"}),
+        main.Page([invoice("F1", INVOICE_STATUS_PAID), invoice("F3", INVOICE_STATUS_OPEN),
+                   invoice("F3", INVOICE_STATUS_PAID)], None, None),
+    ]
+    main.run_pipelined(None, connection, pages, None, None, concurrency=4, batch_writes=True, watermark=None)
+
+    assert pushed.index(("F1", main.ACTION_OPEN)) < pushed.index(("F1", main.ACTION_PAID))
+    assert pushed.index(("F3", main.ACTION_OPEN)) < pushed.index(("F3", main.ACTION_PAID))
+    assert determine_db_status(connection, invoice("F3", INVOICE_STATUS_PAID)) == INVOICE_STATUS_PAID
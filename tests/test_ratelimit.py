@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+from hubspot_api.ratelimit import RateLimitGovernor
+
+
+class FakeTime:
+    """Clock and sleep that only advance when the governor sleeps."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_governor(fake, **kwargs):
+    return RateLimitGovernor(clock=fake.clock, sleep=fake.sleep, **kwargs)
+
+
+def response(status=200, **headers):
+    return SimpleNamespace(status=status, headers=headers)
+
+
+def test_requests_within_budget_do_not_wait():
+    fake = FakeTime()
+    governor = make_governor(fake, max_requests=10, interval=10)
+    for _ in range(10):
+        governor.acquire()
+    assert fake.sleeps == []
+
+
+def test_exhausted_bucket_waits_for_refill():
+    fake = FakeTime()
+    governor = make_governor(fake, max_requests=10, interval=10)
+    for _ in range(11):
+        governor.acquire()
+    assert sum(fake.sleeps) == 1.0  # one token per second
+
+
+def test_budget_follows_rate_limit_headers():
+    fake = FakeTime()
+    governor = make_governor(fake, max_requests=100, interval=10)
+    governor.update({
+        "X-HubSpot-RateLimit-Max": "190",
+        "X-HubSpot-RateLimit-Interval-Milliseconds": "10000",
+        "X-HubSpot-RateLimit-Remaining": "0",
+        "X-HubSpot-RateLimit-Daily-Remaining": "4242",
+    })
+    governor.acquire()
+    assert governor.max_requests == 190
+    assert governor.daily_remaining == 4242
+    assert fake.sleeps and fake.sleeps[0] > 0
+
+
+def test_too_many_requests_is_retried_after_retry_after():
+    fake = FakeTime()
+    governor = make_governor(fake, max_requests=100, interval=10)
+    responses = iter([response(429, **{"Retry-After": "2"}), response(200)])
+
+    result = governor.call(lambda: next(responses))
+
+    assert result.status == 200
+    assert governor.throttled == 1
+    assert fake.now >= 2
+
+
+def test_requests_responses_are_supported():
+    fake = FakeTime()
+    governor = make_governor(fake, max_requests=100, interval=10)
+    responses = iter([SimpleNamespace(status_code=429, headers={}), SimpleNamespace(status_code=200, headers={})])
+
+    result = governor.call(lambda: next(responses))
+
+    assert result.status_code == 200
+    assert fake.now >= 10  # no Retry-After: wait a full interval
+
+
+def test_gives_up_after_max_retries():
+    fake = FakeTime()
+    governor = make_governor(fake, max_requests=100, interval=10, max_retries=2)
+    calls = []
+
+    def send():
+        calls.append(1)
+        return response(429, **{"Retry-After": "1"})
+
+    assert governor.call(send).status == 429
+    assert len(calls) == 3
@@ -0,0 +1,99 @@
+import threading
+
+from scheduler import Scheduler
+from tasks import TaskStore, STATUS_QUEUED
+
+
+class Runs:
+    """execute() stand-in: every run blocks until it is released."""
+
+    def __init__(self):
+        self.started = []
+        self.released = {}
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def __call__(self, task_id):
+        release = threading.Event()
+        with self.lock:
+            self.started.append(task_id)
+            self.released[task_id] = release
+            if self.closed:
+                release.set()
+        release.wait(5)
+
+    def release(self, task_id):
+        self.released[task_id].set()
+
+    def close(self):
+        """Let the running and all later runs finish at once."""
+        with self.lock:
+            self.closed = True
+            for release in self.released.values():
+                release.set()
+
+    def wait_for(self, count):
+        for _ in range(500):
+            with self.lock:
+                if len(self.started) >= count:
+                    return
+            threading.Event().wait(0.01)
+        raise AssertionError(f"{count} runs did not start")
+
+
+def test_requests_while_a_sync_runs_coalesce_into_one_follow_up(tmp_path):
+    runs = Runs()
+    scheduler = Scheduler(TaskStore(tmp_path / "tasks.db"), runs)
+
+    first, coalesced = scheduler.submit("image", None)
+    assert coalesced is False
+    runs.wait_for(1)
+    follow_up, _ = scheduler.submit("image", None)
+    duplicate, coalesced = scheduler.submit("image", None)
+    sharded, _ = scheduler.submit("image", None, shards=4)
+
+    assert duplicate == follow_up and coalesced is True
+    assert scheduler.active == first
+    assert scheduler.queued == [follow_up, sharded]
+    assert scheduler.queue_depth == 2
+
+    runs.release(first)
+    runs.wait_for(2)
+    assert runs.started == [first, follow_up]
+    # the follow-up left the queue, so a new request queues a new run
+    assert scheduler.submit("image", None)[0] not in (first, follow_up)
+    runs.close()
+
+
+def test_webhook_runs_collect_the_invoice_ids_of_their_requests(tmp_path):
+    runs = Runs()
+    store = TaskStore(tmp_path / "tasks.db")
+    scheduler = Scheduler(store, runs)
+
+    running, _ = scheduler.submit("image", None)
+    runs.wait_for(1)
+    webhook, _ = scheduler.submit("image", None, invoice_ids=["1", "2"])
+    assert scheduler.submit("image", None, invoice_ids=["2", "3"]) == (webhook, True)
+
+    assert store.get(webhook)["invoice_ids"] == ["1", "2", "3"]
+    runs.release(running)
+    runs.wait_for(2)
+    assert runs.started == [running, webhook]
+    runs.close()
+
+
+def test_queued_tasks_of_a_previous_process_are_resumed_in_order(tmp_path):
+    store = TaskStore(tmp_path / "tasks.db")
+    store.create("older", image="image", command=None, shards=1)
+    store.create("newer", image="image", command=None, shards=2)
+    runs = Runs()
+    scheduler = Scheduler(store, runs)
+
+    scheduler.resume(reversed(store.history(status=STATUS_QUEUED)))
+
+    runs.wait_for(1)
+    assert runs.started == ["older"]
+    assert scheduler.queued == ["newer"]
+    runs.release("older")
+    runs.wait_for(2)
+    runs.close()
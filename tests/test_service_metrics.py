@@ -0,0 +1,17 @@
+from prometheus import merge_textfiles
+
+
+def test_shard_textfiles_merge_into_one_family_each():
+    first = '# HELP runs_total Runs\n# TYPE runs_total counter\nruns_total{shard="1/2"} 1\n'
+    second = '# HELP runs_total Runs\n# TYPE runs_total counter\nruns_total{shard="2/2"} 3\n'
+
+    assert merge_textfiles([first, second]) == (
+        "# HELP runs_total Runs\n"
+        "# TYPE runs_total counter\n"
+        'runs_total{shard="1/2"} 1\n'
+        'runs_total{shard="2/2"} 3\n'
+    )
+
+
+def test_nothing_to_merge_gives_an_empty_exposition():
+    assert merge_textfiles([]) == ""
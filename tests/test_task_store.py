@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from tasks import LogWriter, TaskStore, finished_status, stream_task_logs, STATUS_COMPLETED, STATUS_FAILED, \
+    STATUS_QUEUED, STATUS_RUNNING, STATUS_SKIPPED
+
+
+def test_tasks_survive_a_new_store_on_the_same_file(tmp_path):
+    store = TaskStore(tmp_path / "tasks.db")
+    store.create("t1", image="image", command=None, shards=2, invoice_ids=["1"])
+    store.update("t1", status=STATUS_RUNNING)
+    store.update("t1", status=STATUS_COMPLETED, exit_code=0, shard_results=[{"shard": "1/2", "exit_code": 0}])
+
+    task = TaskStore(tmp_path / "tasks.db").get("t1")
+    assert task["status"] == STATUS_COMPLETED
+    assert task["started_at"] <= task["finished_at"]
+    assert task["invoice_ids"] == ["1"]
+    assert task["shard_results"] == [{"shard": "1/2", "exit_code": 0}]
+    assert TaskStore(tmp_path / "tasks.db").get("unknown") is None
+
+
+def test_a_restart_fails_the_tasks_left_running(tmp_path):
+    store = TaskStore(tmp_path / "tasks.db")
+    store.create("queued")
+    store.create("running", status=STATUS_RUNNING)
+    store.create("done", status=STATUS_COMPLETED)
+
+    assert store.interrupt_unfinished("restarted") == 1
+    assert store.count_by_status() == {STATUS_QUEUED: 1, STATUS_RUNNING: 0, STATUS_COMPLETED: 1, STATUS_FAILED: 1,
+                                       STATUS_SKIPPED: 0}
+    assert store.get("running")["error"] == "restarted"
+
+
+def test_pruning_keeps_recent_and_unfinished_tasks(tmp_path):
+    store = TaskStore(tmp_path / "tasks.db")
+    for number in range(4):
+        store.create(f"t{number}", status=STATUS_COMPLETED)
+        store.append_logs(f"t{number}", ["line"])
+    store.create("running", status=STATUS_RUNNING)
+
+    assert store.prune(max_age=3600, keep=3) == 2
+    assert [task["id"] for task in store.history()] == ["running", "t3", "t2"]
+    assert store.logs("t0") == []
+    assert store.prune(max_age=-1, keep=10) == 2
+    assert [task["id"] for task in store.history()] == ["running"]
+
+
+def test_the_log_writer_stores_whole_lines(tmp_path):
+    store = TaskStore(tmp_path / "tasks.db")
+    store.create("t1")
+    writer = LogWriter(store, "t1", prefix="[1/2] ", batch_lines=2, batch_seconds=3600)
+    writer.write(b"first\r\nsec")
+    assert store.tail("t1") == []
+    writer.write(b"ond\nthird")
+    assert store.tail("t1") == ["[1/2] first", "[1/2] second"]
+    writer.close()
+    assert store.tail("t1", lines=2) == ["[1/2] second", "[1/2] third"]
+
+
+def test_logs_stream_as_events_until_the_task_finishes(tmp_path):
+    store = TaskStore(tmp_path / "tasks.db")
+    store.create("t1", status=STATUS_RUNNING)
+    store.append_logs("t1", ["one", "two"])
+
+    async def collect():
+        events = []
+        async for event in stream_task_logs(store, "t1", poll_interval=0.01):
+            events.append(event)
+            if len(events) == 2:
+                store.append_logs("t1", ["three"])
+                store.update("t1", status=STATUS_COMPLETED, exit_code=0)
+        return events
+
+    events = asyncio.run(collect())
+    assert events[:3] == ["id: 1\ndata: one\n\n", "id: 2\ndata: two\n\n", "id: 3\ndata: three\n\n"]
+    assert events[3] == 'event: end\ndata: {"status": "completed", "exit_code": 0}\n\n'
+
+    async def resume():
+        return [event async for event in stream_task_logs(store, "t1", after=2)]
+
+    assert asyncio.run(resume())[0] == "id: 3\ndata: three\n\n"
+
+
+def test_a_task_locked_out_by_another_sync_is_skipped():
+    assert finished_status([0]) == STATUS_COMPLETED
+    assert finished_status([75]) == STATUS_SKIPPED
+    assert finished_status([0, 75]) == STATUS_SKIPPED
+    # a shard that failed makes the task a completed one with its exit code, like before
+    assert finished_status([1, 75]) == STATUS_COMPLETED
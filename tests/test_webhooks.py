@@ -0,0 +1,59 @@
+import json
+import time
+
+from replay import invoice_events, signed_request
+from webhooks import EventBatcher, signature_v3, valid_signature
+
+SECRET = "test-client-secret"
+URL = "https://sync.example.com/webhooks/hubspot"
+
+
+def test_replayed_requests_carry_a_valid_signature():
+    events = invoice_events(["1"], "hs_invoice_status", "paid")
+    request = signed_request("http://localhost:8000/webhooks/hubspot", SECRET, events, signed_url=URL)
+
+    assert valid_signature(SECRET, "POST", URL, request.data, request.get_header("X-hubspot-request-timestamp"),
+                           request.get_header("X-hubspot-signature-v3"))
+
+
+def test_tampered_stale_or_unsigned_requests_are_rejected():
+    body = json.dumps(invoice_events(["1"], "hs_invoice_status", "paid")).encode("utf-8")
+    timestamp = str(int(time.time() * 1000))
+    signature = signature_v3(SECRET, "POST", URL, body, timestamp)
+
+    assert not valid_signature(SECRET, "POST", URL, body.replace(b"paid", b"open"), timestamp, signature)
+    assert not valid_signature("other-secret", "POST", URL, body, timestamp, signature)
+    assert not valid_signature(SECRET, "POST", URL, body, timestamp, signature, now=time.time() + 600)
+    assert not valid_signature(SECRET, "POST", URL, body, None, None)
+
+
+def test_bursts_coalesce_into_one_flush_without_duplicates():
+    batcher = EventBatcher()
+    events = invoice_events(["2", "1", "2"], "hs_invoice_status", "paid")
+
+    assert batcher.add(events) is True
+    # HubSpot retrying the same events does not schedule another flush
+    assert batcher.add(events) is False
+    assert batcher.stats() == {"received": 6, "duplicates": 3, "pending": 2}
+    assert batcher.take() == ["2", "1"]
+
+    assert batcher.add(invoice_events(["3"], "hs_invoice_status", "paid")) is True
+    assert batcher.take() == ["3"]
+
+
+def test_only_invoice_events_with_numeric_ids_are_kept():
+    batcher = EventBatcher()
+    contact = {**invoice_events(["4"], "lastname", "Jansen")[0], "objectTypeId": "0-1"}
+    malformed = {**invoice_events(["5"], "hs_invoice_status", "paid")[0], "objectId": "5; rm -rf /"}
+
+    assert batcher.add([contact, malformed, "not an event"]) is False
+    assert batcher.take() == []
+
+
+def test_remembered_event_ids_are_bounded():
+    batcher = EventBatcher(seen_limit=2)
+    events = invoice_events(["1", "2", "3"], "hs_invoice_status", "paid")
+    batcher.add(events)
+
+    batcher.add(events[:1])
+    assert batcher.stats()["duplicates"] == 0
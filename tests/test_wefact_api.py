@@ -0,0 +1,106 @@
+import base64
+import io
+import json
+from unittest.mock import MagicMock
+
+import pytest
+
+import wefact_api.api as wefact_api
+from wefact_api.api import WEFACT_API_KEY, WEFACT_TIMEOUT, InvoiceClient, ProductClient, WeFactBase, build_session, \
+    session_stats
+from wefact_api.download import Base64FieldDecoder
+from wefact_api.invoice import download_invoice_pdf
+
+
+def test_all_controllers_share_one_session():
+    assert InvoiceClient._session is ProductClient._session is WeFactBase._session
+
+
+def test_request_posts_payload_over_the_shared_session(monkeypatch):
+    session = MagicMock()
+    session.post.return_value.json.return_value = {"status": "success"}
+    monkeypatch.setattr(WeFactBase, "_session", session)
+
+    result = InvoiceClient().show({"InvoiceCode": "F1"})
+
+    assert result == {"status": "success"}
+    url = session.post.call_args.args[0]
+    assert url.endswith("/v2/")
+    assert json.loads(session.post.call_args.kwargs["data"]) == {
+        "api_key": WEFACT_API_KEY, "controller": "invoice", "action": "show", "InvoiceCode": "F1"
+    }
+    assert session.post.call_args.kwargs["timeout"] == WEFACT_TIMEOUT
+
+
+def test_session_pool_and_retries_are_configured():
+    adapter = build_session(pool_size=8).get_adapter("https://api.mijnwefact.nl/v2/")
+
+    assert adapter._pool_maxsize == 8
+    assert adapter.max_retries.connect == 3
+    # an add may have been done already when the gateway gave up, so no status or read retries
+    assert adapter.max_retries.status == 0
+    assert adapter.max_retries.read == 0
+
+
+def test_gateway_errors_are_only_retried_for_read_actions(monkeypatch):
+    monkeypatch.setattr(wefact_api, "WEFACT_RETRY_BACKOFF", 0)
+    session = MagicMock()
+    gateway_error, success = MagicMock(status_code=504), MagicMock(status_code=200)
+    success.json.return_value = {"status": "success"}
+    monkeypatch.setattr(WeFactBase, "_session", session)
+
+    session.post.side_effect = [gateway_error, success]
+    assert InvoiceClient().show({"InvoiceCode": "F1"}) == {"status": "success"}
+    assert session.post.call_count == 2
+
+    session.post.reset_mock()
+    gateway_error.json.return_value = {"status": "error"}
+    session.post.side_effect = [gateway_error, success]
+    assert InvoiceClient().add({"InvoiceCode": "F1"}) == {"status": "error"}
+    assert session.post.call_count == 1
+
+
+def test_fresh_session_has_no_connections():
+    assert session_stats(build_session()) == {"requests": 0, "connections": 0}
+
+
+def test_download_pdf_decodes_the_streamed_base64_into_a_file(monkeypatch):
+    pdf = bytes(range(256)) * 40
+    body = json.dumps({"controller": "invoice", "action": "download", "status": "success",
+                       "invoice": {"Filename": "F1.pdf", "Base64": base64.b64encode(pdf).decode("ascii")}})
+    # like PHP encodes it, with escaped slashes
+    body = body.replace("/", "\\/").encode("utf-8")
+    session = MagicMock()
+    session.post.return_value.iter_content.side_effect = lambda size: (body[i:i + 7] for i in range(0, len(body), 7))
+    monkeypatch.setattr(WeFactBase, "_session", session)
+    file = io.BytesIO()
+
+    result = InvoiceClient().download_pdf({"InvoiceCode": "F1"}, file)
+
+    assert file.getvalue() == pdf
+    assert result == {"controller": "invoice", "action": "download", "status": "success",
+                      "invoice": {"Filename": "F1.pdf", "Base64": ""}}
+    assert session.post.call_args.kwargs["stream"] is True
+    session.post.return_value.close.assert_called_once()
+
+
+def test_a_failed_download_without_errors_still_has_an_error():
+    client = MagicMock()
+    client.download_pdf.return_value = {"status": "error"}
+
+    pdf, errors = download_invoice_pdf(client, "F1")
+
+    assert pdf is None
+    assert errors == ["the PDF of invoice F1 could not be downloaded"]
+
+
+@pytest.mark.parametrize("split", range(1, 12))
+def test_the_base64_field_is_decoded_wherever_the_chunks_split(split):
+    body = b'{"errors": ["\\"Base64\\""], "Base64" : "SGVs\\/G8\\/", "invoice": {"Base64": null}}'
+    file = io.BytesIO()
+    decoder = Base64FieldDecoder("Base64", file)
+    for start in range(0, len(body), split):
+        decoder.feed(body[start:start + split])
+
+    assert file.getvalue() == base64.b64decode("SGVs/G8/")
+    assert decoder.result() == {"errors": ['"Base64"'], "Base64": "", "invoice": {"Base64": None}}
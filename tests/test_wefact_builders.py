@@ -147,7 +147,9 @@ class TestInvoiceBuilders:
         item = make_line_item(quantity=3, btw=21.0, hs_discount_percentage=10.0, kostenplaats=123)
         assert invoice_line_data_from_model(item) == {
             "ProductCode": "SKU1",
+            "Description": "Widget",
             "Number": 3,
+            "PriceExcl": 10.0,
             "TaxPercentage": 21.0,
             "DiscountPercentageType": "line",
             "DiscountPercentage": 10.0,
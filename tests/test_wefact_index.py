@@ -0,0 +1,174 @@
+import sqlite3
+from unittest.mock import MagicMock
+
+from models.company import Company
+from models.line_item import LineItem
+from state.db import load_wefact_index, migrate, save_wefact_index
+from wefact_api.api import DebtorClient
+from wefact_api.debtor import DEBTOR_CODE_KEY, debtor_fingerprint
+from wefact_api.index import WeFactIndex, fingerprint, index_from_list
+from wefact_api.invoice import ensure_debtor, sync_products
+from wefact_api.product import product_fingerprint
+
+
+def make_company(**overrides):
+    data = dict(id="comp-1", relatienummer="R1", name="Acme", address="Main St 1", zip="1011AA",
+                city="Amsterdam", mailadres_factuur="billing@acme.test")
+    data.update(overrides)
+    return Company(**data)
+
+
+def make_debtor_client(show=None, add=None, edit=None):
+    client = MagicMock()
+    client.show.return_value = show or {"status": "error", "errors": ["not found"]}
+    client.add.return_value = add or {"status": "success", "debtor": {"Identifier": 11}}
+    client.edit.return_value = edit or {"status": "success", "debtor": {"Identifier": 11}}
+    return client
+
+
+class TestWeFactIndex:
+    def test_fingerprint_ignores_key_order(self):
+        assert fingerprint({"a": 1, "b": 2}) == fingerprint({"b": 2, "a": 1})
+        assert fingerprint({"a": 1}) != fingerprint({"a": 2})
+
+    def test_fingerprint_hashes_the_identifier_as_a_string(self):
+        assert fingerprint({"Identifier": 11, "a": 1}) == fingerprint({"Identifier": "11", "a": 1})
+        assert fingerprint({"Identifier": 11}) != fingerprint({"Identifier": 12})
+
+    def test_changes_are_collected_once(self):
+        index = WeFactIndex("debtor", [("R1", 1, "x")])
+        index.record("R2", 2, "y")
+        index.forget("R1")
+
+        assert sorted(index.pop_changes()) == [("R1", None, None), ("R2", 2, "y")]
+        assert index.pop_changes() == []
+        assert index.get("R1") is None
+        assert index.get("R2") == (2, "y")
+
+    def test_index_from_list_pages_through_all_debtors(self):
+        client = DebtorClient()
+        client.list = MagicMock(side_effect=[
+            {"status": "success", "totalresults": 3, "debtors": [
+                {"Identifier": 1, "DebtorCode": "R1"}, {"Identifier": 2, "DebtorCode": "R2"}]},
+            {"status": "success", "totalresults": 3, "debtors": [{"Identifier": 3, "DebtorCode": "R3"}]},
+        ])
+
+        index = index_from_list(client, DEBTOR_CODE_KEY)
+
+        assert len(index) == 3
+        assert index.get("R3") == (3, None)
+        assert client.list.call_args_list[1].args[0]["offset"] == 2
+
+
+class TestEnsureDebtor:
+    def test_without_index_shows_then_adds(self):
+        client = make_debtor_client()
+
+        ensure_debtor(client, make_company())
+
+        client.show.assert_called_once()
+        client.add.assert_called_once()
+
+    def test_unchanged_debtor_costs_no_calls(self):
+        company = make_company()
+        index = WeFactIndex("debtor", [("R1", 11, debtor_fingerprint(11, company))])
+        client = make_debtor_client()
+
+        ensure_debtor(client, company, index)
+
+        client.show.assert_not_called()
+        client.add.assert_not_called()
+        client.edit.assert_not_called()
+
+    def test_changed_debtor_is_edited_without_show(self):
+        index = WeFactIndex("debtor", [("R1", 11, None)])
+        client = make_debtor_client()
+        company = make_company(city="Utrecht")
+
+        ensure_debtor(client, company, index)
+
+        client.show.assert_not_called()
+        assert client.edit.call_args.args[0]["Identifier"] == 11
+        assert index.get("R1") == (11, debtor_fingerprint(11, company))
+
+    def test_new_debtor_is_added_and_recorded(self):
+        index = WeFactIndex("debtor")
+        client = make_debtor_client(add={"status": "success", "debtor": {"Identifier": 42}})
+        company = make_company()
+
+        ensure_debtor(client, company, index)
+
+        client.add.assert_called_once()
+        assert index.get("R1") == (42, debtor_fingerprint(42, company))
+
+    def test_a_debtor_from_the_state_database_is_not_edited_again(self):
+        connection = sqlite3.connect(":memory:")
+        migrate(connection)
+        index = WeFactIndex("debtor")
+        # WeFact returns the Identifier as a string
+        ensure_debtor(make_debtor_client(add={"status": "success", "debtor": {"Identifier": "11"}}), make_company(),
+                      index)
+        save_wefact_index(connection, "debtor", index.pop_changes())
+        client = make_debtor_client()
+
+        ensure_debtor(client, make_company(), WeFactIndex("debtor", load_wefact_index(connection, "debtor")))
+
+        client.edit.assert_not_called()
+
+    def test_stale_entry_falls_back_to_show(self):
+        index = WeFactIndex("debtor", [("R1", 11, None)])
+        client = make_debtor_client(
+            edit={"status": "error", "errors": ["unknown debtor"]},
+        )
+
+        ensure_debtor(client, make_company(), index)
+
+        client.show.assert_called_once()
+        client.add.assert_called_once()
+        assert index.get("R1")[0] == 11
+
+
+def make_line_item(**overrides):
+    data = dict(hs_sku="SKU1", name="Widget", amount=10.0, quantity=1, price=10.0, btw=21.0, kostenplaats="123")
+    data.update(overrides)
+    return LineItem(**data)
+
+
+def make_product_client():
+    client = MagicMock()
+    client.show.return_value = {"status": "error", "errors": ["not found"]}
+    client.add.return_value = {"status": "success", "product": {"Identifier": 7}}
+    client.edit.return_value = {"status": "success", "product": {"Identifier": 7}}
+    return client
+
+
+class TestSyncProducts:
+    def test_every_sku_is_pushed_once(self):
+        client = make_product_client()
+        index = WeFactIndex("product")
+
+        sync_products(client, [make_line_item(), make_line_item(), make_line_item(hs_sku="SKU2")], index)
+
+        assert client.add.call_count == 2
+        assert index.get("SKU1") == (7, product_fingerprint(7, make_line_item()))
+
+    def test_unchanged_products_are_skipped_on_the_next_batch(self):
+        client = make_product_client()
+        index = WeFactIndex("product")
+        sync_products(client, [make_line_item()], index)
+        client.reset_mock()
+
+        sync_products(client, [make_line_item()], index)
+
+        client.show.assert_not_called()
+        client.add.assert_not_called()
+        client.edit.assert_not_called()
+
+    def test_changed_price_is_edited(self):
+        client = make_product_client()
+        index = WeFactIndex("product", [("SKU1", 7, product_fingerprint(7, make_line_item()))])
+
+        sync_products(client, [make_line_item(price=12.5)], index)
+
+        client.show.assert_not_called()
+        assert client.edit.call_args.args[0]["PriceExcl"] == 12.5
@@ -1,32 +1,121 @@
 import json
 import logging
 import os
+import time
 from abc import ABC
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
 
-WEFACT_API_URL: str = "https://api.mijnwefact.nl/v2/"
+from metrics import WEFACT_REQUESTS, WEFACT_REQUEST_SECONDS
+from wefact_api.download import DOWNLOAD_CHUNK_SIZE, Base64FieldDecoder
+
+WEFACT_API_URL: str = os.getenv("WEFACT_API_URL", "https://api.mijnwefact.nl/v2/")
 WEFACT_API_KEY: str = os.environ["WEFACT_API_KEY"]
+# (connect, read) timeouts in seconds; downloads of large invoices need the longer read timeout
+WEFACT_TIMEOUT = (float(os.getenv("WEFACT_CONNECT_TIMEOUT", "5")), float(os.getenv("WEFACT_READ_TIMEOUT", "60")))
+# large enough for every worker of a concurrent run to keep its own connection open
+WEFACT_POOL_SIZE = int(os.getenv("WEFACT_POOL_SIZE", "16"))
+# WeFact returns at most 1000 objects per list call
+WEFACT_LIST_PAGE_SIZE = 1000
+# actions that change nothing in WeFact, so they can be sent again after a gateway error; an add or
+# sendbyemail may have been done already when the gateway gave up waiting
+WEFACT_READ_ACTIONS = frozenset({"show", "list", "download"})
+WEFACT_RETRY_STATUSES = (502, 503, 504)
+WEFACT_READ_RETRIES = 3
+WEFACT_RETRY_BACKOFF = 0.5
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def build_session(pool_size: int = WEFACT_POOL_SIZE):
+    """Return a keep-alive session that retries failed connections with backoff.
+
+    A request that failed to connect never reached WeFact, so that is safe for every action; gateway
+    errors are only retried for read actions, by `WeFactBase`.
+    """
+    retry = Retry(
+        total=3,
+        connect=3,
+        read=0,
+        status=0,
+        other=0,
+        backoff_factor=WEFACT_RETRY_BACKOFF,
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+    return session
+
+
+def session_stats(session):
+    """Return how many requests were sent over how many connections, to see how well connections are reused."""
+    pools = [adapter.poolmanager.pools[key] for adapter in session.adapters.values()
+             for key in adapter.poolmanager.pools.keys()]
+    return {"requests": sum(pool.num_requests for pool in pools),
+            "connections": sum(pool.num_connections for pool in pools)}
+
+
 class WeFactBase(ABC):
     _controller: str | None = None
+    # key of the objects in a list response
+    _list_key: str | None = None
+    # one pool of connections shared by all controllers
+    _session = build_session()
 
     def __init__(self):
         self._url = WEFACT_API_URL
 
+    @classmethod
+    def connection_stats(cls):
+        return session_stats(cls._session)
+
     def _build_request(self, action):
         return {"api_key": WEFACT_API_KEY, "controller": self._controller, "action": action}
 
     def request(self, action, data: dict | None = None):
-        payload = self._build_request(action) | (data or {})
-        return requests.post(self._url, data=json.dumps(payload)).json()
+        return self._call(action, data, lambda response: response.json())
 
-    def list(self):
-        return self.request("list", {})
+    def _call(self, action, data, read, stream=False):
+        """Post an action and return what `read` makes of the response."""
+        payload = self._build_request(action) | (data or {})
+        status = "exception"
+        try:
+            with WEFACT_REQUEST_SECONDS.time(controller=self._controller, action=action):
+                for attempt in range(WEFACT_READ_RETRIES + 1):
+                    response = self._session.post(self._url, data=json.dumps(payload), timeout=WEFACT_TIMEOUT,
+                                                  stream=stream)
+                    if action not in WEFACT_READ_ACTIONS or response.status_code not in WEFACT_RETRY_STATUSES \
+                            or attempt == WEFACT_READ_RETRIES:
+                        break
+                    logger.warning(f"WeFact {self._controller} {action} returned {response.status_code}, retrying")
+                    response.close()
+                    time.sleep(WEFACT_RETRY_BACKOFF * 2 ** attempt)
+                try:
+                    result = read(response)
+                finally:
+                    response.close()
+            status = result.get("status", "unknown") if isinstance(result, dict) else "unknown"
+            return result
+        finally:
+            WEFACT_REQUESTS.inc(controller=self._controller, action=action, status=status)
+
+    def list(self, data: dict | None = None):
+        return self.request("list", data or {})
+
+    def list_all(self, page_size: int = WEFACT_LIST_PAGE_SIZE):
+        """Yield every object of this controller, paging through `list` with offset and limit."""
+        offset = 0
+        while True:
+            result = self.list({"offset": offset, "limit": page_size})
+            if result["status"] != "success":
+                raise RuntimeError(f"listing {self._list_key} failed: {result.get('errors')}")
+            items = result.get(self._list_key) or []
+            yield from items
+            offset += len(items)
+            if len(items) == 0 or offset >= int(result.get("totalresults", 0)):
+                return
 
     def show(self, data):
         return self.request("show", data)
@@ -40,17 +129,33 @@ class WeFactBase(ABC):
 
 class InvoiceClient(WeFactBase):
     _controller = "invoice"
+    _list_key = "invoices"
 
     def download(self, invoice):
         return self.request("download", invoice)
 
+    def download_pdf(self, invoice, file):
+        """Download the PDF of an invoice into the binary `file`, decoding it while it arrives.
+
+        Returns the response without its Base64 field, so the PDF is never in memory as a whole.
+        """
+        def read(response):
+            decoder = Base64FieldDecoder("Base64", file)
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                decoder.feed(chunk)
+            return decoder.result()
+
+        return self._call("download", invoice, read, stream=True)
+
     def sendbyemail(self, invoice):
         return self.request("sendbyemail", invoice)
 
 
 class DebtorClient(WeFactBase):
     _controller = "debtor"
+    _list_key = "debtors"
 
 
 class ProductClient(WeFactBase):
     _controller = "product"
+    _list_key = "products"
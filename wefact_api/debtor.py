@@ -1,4 +1,7 @@
 from models.company import Company
+from wefact_api.index import fingerprint
+
+DEBTOR_CODE_KEY = "DebtorCode"
 
 
 def debtor_data_id(code):
@@ -25,3 +28,7 @@ def debtor_data_add_from_model(company: Company):
 def debtor_data_edit_from_model(id: int, company: Company):
     return debtor_data_edit(id, company.relatienummer, company.name, company.address, company.zip, company.city,
                            company.mailadres_factuur)
+
+
+def debtor_fingerprint(id: int, company: Company):
+    return fingerprint(debtor_data_edit_from_model(id, company))
@@ -0,0 +1,91 @@
+import binascii
+import json
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+WHITESPACE = b" \t\r\n"
+
+_OUTSIDE, _STRING, _KEY, _VALUE, _BASE64 = range(5)
+
+
+class Base64FieldDecoder:
+    """Decode the base64 string of one field of a JSON response while the response arrives in chunks.
+
+    The decoded bytes are written to `out` as they come in. The rest of the response is kept, with an
+    empty string for the field, so only the other fields and a chunk of the response are in memory,
+    however large the field is.
+    """
+
+    def __init__(self, field: str, out):
+        self.out = out
+        self.found = False
+        self._field = field.encode("utf-8")
+        self._document = bytearray()
+        self._state = _OUTSIDE
+        self._escaped = False
+        self._token = bytearray()
+        # base64 characters of an incomplete group of four, or an escape split over two chunks
+        self._pending = b""
+
+    def feed(self, chunk: bytes):
+        position = 0
+        while position < len(chunk):
+            if self._state == _BASE64:
+                position = self._feed_base64(chunk, position)
+            else:
+                position = self._feed_json(chunk, position)
+
+    def _feed_json(self, chunk, position):
+        """Keep the JSON outside the field, until the string value of the field starts."""
+        for position in range(position, len(chunk)):
+            byte = chunk[position:position + 1]
+            self._document += byte
+            if self._state == _STRING:
+                if self._escaped:
+                    self._escaped = False
+                    # no escapes in the name of the field, so this string is not it
+                    self._token += b"\\"
+                elif byte == b"\\":
+                    self._escaped = True
+                elif byte == b'"':
+                    self._state = _KEY if self._token == self._field else _OUTSIDE
+                elif len(self._token) <= len(self._field):
+                    self._token += byte
+            elif byte in WHITESPACE:
+                continue
+            elif self._state == _KEY and byte == b":":
+                self._state = _VALUE
+            elif self._state == _VALUE and byte == b'"':
+                self._state = _BASE64
+                self.found = True
+                return position + 1
+            elif byte == b'"':
+                self._state = _STRING
+                self._token = bytearray()
+            else:
+                self._state = _OUTSIDE
+        return len(chunk)
+
+    def _feed_base64(self, chunk, position):
+        """Decode the field up to its closing quote, in groups of four characters."""
+        end = chunk.find(b'"', position)
+        data = self._pending + chunk[position:len(chunk) if end < 0 else end]
+        # an escape that continues in the next chunk
+        trailing = len(data) - len(data.rstrip(b"\\"))
+        held = b"\\" if trailing % 2 and end < 0 else b""
+        data = data[:len(data) - len(held)]
+        # PHP escapes the slashes of base64 in JSON, and line breaks may come as escapes as well
+        data = data.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+        if b"\\" in data:
+            raise ValueError("unexpected escape in a base64 field")
+        complete = len(data) - len(data) % 4 if end < 0 else len(data)
+        self.out.write(binascii.a2b_base64(data[:complete]))
+        self._pending = data[complete:] + held
+        if end < 0:
+            return len(chunk)
+        self._document += b'"'
+        self._state = _OUTSIDE
+        return end + 1
+
+    def result(self):
+        """The response without the field, once every chunk is fed."""
+        return json.loads(self._document)
@@ -0,0 +1,63 @@
+import hashlib
+import json
+import threading
+
+
+def fingerprint(data: dict) -> str:
+    """Return a stable hash of a WeFact payload, to detect whether it changed since it was pushed.
+
+    WeFact returns the Identifier as a string and the state database as an integer, so it is hashed as a string.
+    """
+    if data.get("Identifier") is not None:
+        data = {**data, "Identifier": str(data["Identifier"])}
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class WeFactIndex:
+    """Map of WeFact object code -> (Identifier, fingerprint of the data last pushed).
+
+    A fingerprint of None means the object exists in WeFact but we do not know what its data looks
+    like. Changes are collected so the caller can write them to the state database.
+    """
+
+    def __init__(self, controller: str, entries=()):
+        self.controller = controller
+        self._entries = {code: (identifier, data_fingerprint) for code, identifier, data_fingerprint in entries}
+        self._changes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, code):
+        with self._lock:
+            return self._entries.get(code)
+
+    def record(self, code, identifier, data_fingerprint=None):
+        with self._lock:
+            self._entries[code] = (identifier, data_fingerprint)
+            self._changes[code] = (identifier, data_fingerprint)
+
+    def forget(self, code):
+        with self._lock:
+            self._entries.pop(code, None)
+            self._changes[code] = (None, None)
+
+    def pop_changes(self):
+        """Return and reset the (code, identifier, fingerprint) rows changed since the last call.
+
+        A row with identifier None means the object was forgotten.
+        """
+        with self._lock:
+            changes = [(code, identifier, data_fingerprint)
+                       for code, (identifier, data_fingerprint) in self._changes.items()]
+            self._changes = {}
+            return changes
+
+
+def index_from_list(client, code_key: str) -> WeFactIndex:
+    """Build an index of every object of the client's controller from paginated WeFact list calls."""
+    index = WeFactIndex(client._controller)
+    for item in client.list_all():
+        index.record(item[code_key], item["Identifier"])
+    return index
@@ -1,4 +1,5 @@
-import base64
+import os
+import tempfile
 from collections import namedtuple
 from enum import IntEnum
 
@@ -6,14 +7,20 @@ from models.company import Company
 from models.invoice import Invoice
 from models.line_item import LineItem
 from wefact_api.api import InvoiceClient, DebtorClient, ProductClient
-from wefact_api.debtor import debtor_data_id_from_model, debtor_data_add_from_model, debtor_data_edit_from_model
-from wefact_api.product import product_data_add_from_model, product_data_edit_from_model, product_data_id_from_model
+from wefact_api.debtor import debtor_data_id_from_model, debtor_data_add_from_model, debtor_data_edit_from_model, \
+    debtor_fingerprint
+from wefact_api.index import WeFactIndex, fingerprint
+from wefact_api.product import product_data_add_from_model, product_data_edit_from_model, product_data_id_from_model, \
+    product_fingerprint
 
 WEFACT_STATUS_SUCCESS = "success"
 WEFACT_STATUS_ERROR = "error"
 
 ResultType = namedtuple("result", ["persist", "data", "errors"], defaults=[False, {}, []])
 
+# a downloaded PDF stays in memory up to this many bytes, a larger one goes to a temporary file
+PDF_SPOOL_SIZE = int(os.getenv("WEFACT_PDF_SPOOL_SIZE", str(1024 * 1024)))
+
 
 class InvoiceStatus(IntEnum):
     Concept = 0
@@ -55,13 +62,16 @@ def invoice_data_from_model(invoice: Invoice, company: Company):
     return invoice_data(invoice.number, company.relatienummer, invoice.invoice_date, term, invoice.korting, invoice_lines, custom_fields, invoice.land)
 
 
-def invoice_line_data(code, number, tax_percentage, discount_percentage, cost_center):
-    return {"ProductCode": code, "Number": number, "TaxPercentage": tax_percentage, "DiscountPercentageType": "line",
-            "DiscountPercentage": discount_percentage, "AccountingCostCentre": cost_center}
+def invoice_line_data(code, number, tax_percentage, discount_percentage, cost_center, price, description):
+    # the price and description of the line itself, as the product record may carry the price of another invoice
+    return {"ProductCode": code, "Description": description, "Number": number, "PriceExcl": price,
+            "TaxPercentage": tax_percentage, "DiscountPercentageType": "line", "DiscountPercentage": discount_percentage,
+            "AccountingCostCentre": cost_center}
 
 
 def invoice_line_data_from_model(line_item: LineItem):
-    return invoice_line_data(line_item.hs_sku, line_item.quantity, line_item.btw, line_item.hs_discount_percentage, line_item.kostenplaats)
+    return invoice_line_data(line_item.hs_sku, line_item.quantity, line_item.btw, line_item.hs_discount_percentage,
+                             line_item.kostenplaats, line_item.price, line_item.name)
 
 
 def invoice_update_paid(code):
@@ -71,51 +81,146 @@ def invoice_update_paid(code):
     api_client_invoice = InvoiceClient()
     invoice_number = f"{code}"
     invoice = api_client_invoice.show(invoice_data_id(invoice_number))
-    download_result = api_client_invoice.download(invoice_data_id(invoice_number))
     if invoice["status"] == "success":
-        pdf = base64.b64decode(download_result["invoice"]["Base64"])
+        result.data["Identifier"] = invoice["invoice"]["Identifier"]
+        pdf, errors = download_invoice_pdf(api_client_invoice, invoice_number)
         result.data["pdf"] = pdf
+        result.errors.extend(errors)
     else:
         result.errors.extend(invoice['errors'])
     return result
 
 
-def generate_invoice(invoice_object: Invoice, company_object: Company):
+def download_invoice_pdf(api_client_invoice: InvoiceClient, invoice_number):
+    """Return the PDF of an invoice as an open binary file at its start, or None and the errors of the download.
+
+    The PDF is decoded while it is downloaded, so memory use is bounded by PDF_SPOOL_SIZE whatever its size.
+    """
+    pdf = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_SIZE)
+    try:
+        download_result = api_client_invoice.download_pdf(invoice_data_id(invoice_number), pdf)
+    except BaseException:
+        pdf.close()
+        raise
+    if download_result.get("status") != WEFACT_STATUS_SUCCESS:
+        pdf.close()
+        # a failed download always has an error, so the invoice is not taken for synced
+        return None, download_result.get("errors") or [f"the PDF of invoice {invoice_number} could not be downloaded"]
+    pdf.seek(0)
+    return pdf, []
+
+
+def ensure_debtor(api_client_debtor: DebtorClient, company_object: Company, debtor_index: WeFactIndex | None = None):
+    """Add or update the WeFact debtor of a company.
+
+    With a debtor index, a debtor whose data has not changed since it was last pushed costs no calls
+    at all, and a known debtor is edited without looking it up first.
+    """
+    code = company_object.relatienummer
+    entry = debtor_index.get(code) if debtor_index is not None else None
+    if entry is not None:
+        identifier, data_fingerprint = entry
+        new_fingerprint = debtor_fingerprint(identifier, company_object)
+        if data_fingerprint == new_fingerprint:
+            return
+        debtor = api_client_debtor.edit(debtor_data_edit_from_model(identifier, company_object))
+        if debtor["status"] == WEFACT_STATUS_SUCCESS:
+            debtor_index.record(code, identifier, new_fingerprint)
+            return
+        # the index is out of date, e.g. the debtor was removed in WeFact
+        debtor_index.forget(code)
+    company = api_client_debtor.show(debtor_data_id_from_model(company_object))
+    if company["status"] == WEFACT_STATUS_ERROR:
+        # debtor not found
+        debtor = api_client_debtor.add(debtor_data_add_from_model(company_object))
+        identifier = debtor.get("debtor", {}).get("Identifier")
+    else:
+        identifier = company["debtor"]["Identifier"]
+        debtor = api_client_debtor.edit(debtor_data_edit_from_model(identifier, company_object))
+    if debtor_index is not None and debtor["status"] == WEFACT_STATUS_SUCCESS and identifier is not None:
+        debtor_index.record(code, identifier, debtor_fingerprint(identifier, company_object))
+
+
+def ensure_product(api_client_product: ProductClient, line_item: LineItem, product_index: WeFactIndex | None = None):
+    """Add or update the WeFact product of a line item, skipping it when the product index shows no change."""
+    code = line_item.hs_sku
+    entry = product_index.get(code) if product_index is not None else None
+    if entry is not None:
+        identifier, data_fingerprint = entry
+        new_fingerprint = product_fingerprint(identifier, line_item)
+        if data_fingerprint == new_fingerprint:
+            return
+        product = api_client_product.edit(product_data_edit_from_model(identifier, line_item))
+        if product["status"] == WEFACT_STATUS_SUCCESS:
+            product_index.record(code, identifier, new_fingerprint)
+            return
+        # the index is out of date, e.g. the product was removed in WeFact
+        product_index.forget(code)
+    product = api_client_product.show(product_data_id_from_model(line_item))
+    identifier = None
+    if product["status"] == WEFACT_STATUS_ERROR:
+        # product not found
+        product = api_client_product.add(product_data_add_from_model(line_item))
+        identifier = product.get("product", {}).get("Identifier")
+    elif product["status"] == WEFACT_STATUS_SUCCESS:
+        identifier = product["product"]["Identifier"]
+        product = api_client_product.edit(product_data_edit_from_model(identifier, line_item))
+    if product_index is not None and product["status"] == WEFACT_STATUS_SUCCESS and identifier is not None:
+        product_index.record(code, identifier, product_fingerprint(identifier, line_item))
+
+
+def sync_products(api_client_product: ProductClient, line_items, product_index: WeFactIndex | None = None):
+    """Make sure the products of the line items exist in WeFact, handling every SKU only once."""
+    # the last line item of a SKU wins, like it would when the invoices were pushed one by one
+    products = {line_item.hs_sku: line_item for line_item in line_items}
+    for line_item in products.values():
+        ensure_product(api_client_product, line_item, product_index)
+
+
+def generate_invoice(invoice_object: Invoice, company_object: Company, debtor_index: WeFactIndex | None = None,
+                     product_index: WeFactIndex | None = None, previous: dict | None = None):
+    """Add the invoice to WeFact and download its PDF.
+
+    `previous` is the ledger row of an earlier sync; when WeFact has this very invoice already, as with a
+    PDF download that failed, the invoice is not looked up or added again and only its PDF is downloaded.
+    """
     result = ResultType(persist=False, data={}, errors=[])
     api_client_invoice = InvoiceClient()
     invoice_number = f"{invoice_object.number}"
     invoice_object.number = invoice_number
+    invoice_payload = invoice_data_from_model(invoice_object, company_object)
+    previous = previous or {}
+    if previous.get("wefact_identifier") is not None and previous.get("payload_hash") == fingerprint(invoice_payload):
+        result.data["Identifier"] = previous["wefact_identifier"]
+        result.data["payload_hash"] = previous["payload_hash"]
+        pdf, errors = download_invoice_pdf(api_client_invoice, invoice_number)
+        result.data["pdf"] = pdf
+        result.errors.extend(errors)
+        return result
     invoice = api_client_invoice.show(invoice_data_id(invoice_number))
     if invoice["status"] != WEFACT_STATUS_ERROR:
         # invoice was found (= no error)
         result = ResultType(persist=True, data={}, errors=[])
+        result.data["Identifier"] = invoice.get("invoice", {}).get("Identifier")
         result.errors.append("invoice already exists")
         return result
     # make sure the debtor exists which is used on the invoice
-    api_client_debtor = DebtorClient()
-    company = api_client_debtor.show(debtor_data_id_from_model(company_object))
-    if company["status"] == WEFACT_STATUS_ERROR:
-        # debtor not found
-        api_client_debtor.add(debtor_data_add_from_model(company_object))
-    else:
-        api_client_debtor.edit(debtor_data_edit_from_model(company["debtor"]["Identifier"], company_object))
-    # make sure the products exist that are used on the invoice
-    api_client_product = ProductClient()
-    for line_item in invoice_object.line_items:
-        product = api_client_product.show(product_data_id_from_model(line_item))
-        if product["status"] == WEFACT_STATUS_ERROR:
-            # product not found
-            api_client_product.add(product_data_add_from_model(line_item))
-        elif product["status"] == WEFACT_STATUS_SUCCESS:
-            api_client_product.edit(product_data_edit_from_model(product["product"]["Identifier"], line_item))
-    # now build the invoice line items
-    invoice = api_client_invoice.add(invoice_data_from_model(invoice_object, company_object))
+    ensure_debtor(DebtorClient(), company_object, debtor_index)
+    # make sure the products exist that are used on the invoice; the lines carry their own price, so with a
+    # product index only products it does not know yet are pushed, instead of editing a product to the price
+    # of this invoice and back again for the next
+    line_items = invoice_object.line_items
+    if product_index is not None:
+        line_items = [line_item for line_item in line_items if product_index.get(line_item.hs_sku) is None]
+    sync_products(ProductClient(), line_items, product_index)
+    invoice = api_client_invoice.add(invoice_payload)
     if invoice["status"] == WEFACT_STATUS_ERROR:
         result.errors.append("error processing invoice:")
         result.errors.extend(invoice['errors'])
         return result
-    download_result = api_client_invoice.download(invoice_data_id(invoice_number))
-    if invoice["status"] == WEFACT_STATUS_SUCCESS:
-        pdf = base64.b64decode(download_result["invoice"]["Base64"])
-        result.data["pdf"] = pdf
+    result.data["Identifier"] = invoice.get("invoice", {}).get("Identifier")
+    result.data["payload_hash"] = fingerprint(invoice_payload)
+    pdf, errors = download_invoice_pdf(api_client_invoice, invoice_number)
+    result.data["pdf"] = pdf
+    result.errors.extend(errors)
     return result
@@ -1,4 +1,7 @@
 from models.line_item import LineItem
+from wefact_api.index import fingerprint
+
+PRODUCT_CODE_KEY = "ProductCode"
 
 
 def product_data_id(code):
@@ -49,3 +52,7 @@ def product_data_edit_from_model(id, line_item: LineItem):
         line_item.price,
         line_item.kostenplaats,
     )
+
+
+def product_fingerprint(id, line_item: LineItem):
+    return fingerprint(product_data_edit_from_model(id, line_item))